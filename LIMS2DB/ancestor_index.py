@@ -0,0 +1,263 @@
+"""Local, read-only copy of the artifact_ancestor_map closure in a memory-mapped file"""
+
+import bisect
+import fcntl
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+# An index file holds native 64 bits integers: the header, the sorted ancestor artifactids,
+# their len + 1 offsets in the descendant artifactids, then the descendant artifactids,
+# sorted for each ancestor
+MAGIC = b"LAAMIDX1"
+# magic, number of ancestors, number of descendants, build time (epoch)
+HEADER = struct.Struct("=8sqqd")
+# Artifacts modified this long before the previous build are fetched again on refresh,
+# to catch rows committed by transactions that were still running at that time
+REFRESH_MARGIN = timedelta(minutes=10)
+# Size of the delta file, relative to the index, above which a refresh folds it into the index
+DELTA_MAX_RATIO = 0.1
+
+
+def write_index(path, pairs, built_at):
+    """Writes an index file from (ancestorid, artifactid) pairs sorted by ancestor then artifact.
+    The file is written to a temporary file next to path and moved in place, so readers never see
+    a partial file.
+    :param str path: destination of the index
+    :param pairs: iterable of sorted (ancestorid, artifactid) tuples, duplicates are dropped
+    :param float built_at: epoch of the database time at which the pairs were read
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=directory)
+    try:
+        with open(tmp_fd, "wb") as fh:
+            with tempfile.TemporaryFile(dir=directory) as ids_file:
+                _write_arrays(fh, ids_file, pairs, built_at)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _write_arrays(fh, ids_file, pairs, built_at):
+    keys = array("q")
+    offsets = array("q", [0])
+    n_ids = 0
+    last_pair = None
+    buf = array("q")
+    for pair in pairs:
+        if pair == last_pair:
+            continue
+        if last_pair is None or pair[0] != last_pair[0]:
+            if last_pair is not None:
+                offsets.append(n_ids)
+            keys.append(pair[0])
+        last_pair = pair
+        buf.append(pair[1])
+        n_ids += 1
+        if len(buf) >= 65536:
+            buf.tofile(ids_file)
+            buf = array("q")
+    buf.tofile(ids_file)
+    if last_pair is not None:
+        offsets.append(n_ids)
+    fh.write(HEADER.pack(MAGIC, len(keys), n_ids, built_at))
+    keys.tofile(fh)
+    offsets.tofile(fh)
+    ids_file.seek(0)
+    shutil.copyfileobj(ids_file, fh)
+
+
+def stream_pairs(session, query, batch_size=100000, **params):
+    result = (
+        session.connection()
+        .execution_options(stream_results=True)
+        .execute(text(query), params)
+    )
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield (row[0], row[1])
+
+
+def database_time(session):
+    return session.execute(text("select localtimestamp;")).scalar()
+
+
+def delta_path(path):
+    return "{}.delta".format(path)
+
+
+@contextmanager
+def index_lock(path):
+    """Holds an exclusive lock on the index, for the runs writing it at the same time"""
+    with open("{}.lock".format(path), "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+class IndexFile:
+    """Read-only view of an index file.
+    :param str path: path of a file written by write_index
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n_keys, n_ids, self.built_at = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not an ancestor index".format(path))
+        self.view = memoryview(self.mm)
+        start = HEADER.size
+        self.keys = self.view[start : start + 8 * n_keys].cast("q")
+        start += 8 * n_keys
+        self.offsets = self.view[start : start + 8 * (n_keys + 1)].cast("q")
+        start += 8 * (n_keys + 1)
+        self.ids = self.view[start : start + 8 * n_ids].cast("q")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def descendants(self, artifactid):
+        """Returns the sorted list of artifactids descending from artifactid
+        :param int artifactid: ancestor artifactid
+        """
+        i = bisect.bisect_left(self.keys, artifactid)
+        if i < len(self.keys) and self.keys[i] == artifactid:
+            return self.ids[self.offsets[i] : self.offsets[i + 1]].tolist()
+        return []
+
+    def pairs(self):
+        """Iterates over all (ancestorid, artifactid) pairs, in the order of the file"""
+        for i, ancestorid in enumerate(self.keys):
+            for artifactid in self.ids[self.offsets[i] : self.offsets[i + 1]]:
+                yield (ancestorid, artifactid)
+
+    def close(self):
+        for view in (self.keys, self.offsets, self.ids, self.view):
+            view.release()
+        self.mm.close()
+
+
+class AncestorIndex:
+    """Read-only view of an index, with the delta file of its refreshes if there is one.
+    :param str path: path of the index written by AncestorIndex.build or AncestorIndex.refresh
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.base = IndexFile(path)
+        self.delta = None
+        try:
+            self.delta = IndexFile(delta_path(path))
+        except FileNotFoundError:
+            # no refresh since the last full build
+            pass
+        self.built_at = max(f.built_at for f in self.files())
+
+    def files(self):
+        return [f for f in (self.base, self.delta) if f is not None]
+
+    def __len__(self):
+        return sum(len(f) for f in self.files())
+
+    def descendants(self, artifactid):
+        """Returns the sorted list of artifactids descending from artifactid
+        :param int artifactid: ancestor artifactid
+        """
+        found = self.base.descendants(artifactid)
+        if self.delta is not None:
+            added = self.delta.descendants(artifactid)
+            if added:
+                found = sorted(set(found).union(added))
+        return found
+
+    def pairs(self):
+        """Iterates over all (ancestorid, artifactid) pairs in order, the ones of the delta can be repeated"""
+        return heapq.merge(*(f.pairs() for f in self.files()))
+
+    def close(self):
+        for f in self.files():
+            f.close()
+
+    @classmethod
+    def build(cls, session, path):
+        """Builds the index from a full scan of artifact_ancestor_map and opens it
+        :param session: genologics_sql session
+        :param str path: destination of the index
+        """
+        with index_lock(path):
+            return cls._build(session, path)
+
+    @classmethod
+    def _build(cls, session, path):
+        built_at = database_time(session)
+        write_index(
+            path,
+            stream_pairs(
+                session,
+                "select aam.ancestorartifactid, aam.artifactid from artifact_ancestor_map aam \
+                order by aam.ancestorartifactid, aam.artifactid;",
+            ),
+            built_at.timestamp(),
+        )
+        if os.path.exists(delta_path(path)):
+            os.remove(delta_path(path))
+        return cls(path)
+
+    @classmethod
+    def refresh(cls, session, path):
+        """Adds the ancestry of the artifacts modified since the last build or refresh to the delta file
+        of the index, and opens it. Builds it from scratch if there is no index at path yet.
+        Pairs are only ever added, a periodical full build drops the ones that disappeared from the LIMS.
+        :param session: genologics_sql session
+        :param str path: path of the index
+        """
+        with index_lock(path):
+            if not os.path.exists(path):
+                return cls._build(session, path)
+            return cls._refresh(session, path)
+
+    @classmethod
+    def _refresh(cls, session, path):
+        old = cls(path)
+        built_at = database_time(session)
+        since = datetime.fromtimestamp(old.built_at) - REFRESH_MARGIN
+        new_pairs = sorted(
+            stream_pairs(
+                session,
+                "select aam.ancestorartifactid, aam.artifactid from artifact_ancestor_map aam \
+                inner join artifact art on art.artifactid=aam.artifactid \
+                where art.lastmodifieddate > :since;",
+                since=since,
+            )
+        )
+        if not new_pairs:
+            return old
+        delta_size = len(new_pairs) + (len(old.delta) if old.delta is not None else 0)
+        if delta_size > DELTA_MAX_RATIO * len(old.base):
+            write_index(path, heapq.merge(old.pairs(), new_pairs), built_at.timestamp())
+            if old.delta is not None:
+                os.remove(delta_path(path))
+        else:
+            delta_pairs = new_pairs
+            if old.delta is not None:
+                delta_pairs = heapq.merge(old.delta.pairs(), new_pairs)
+            write_index(delta_path(path), delta_pairs, built_at.timestamp())
+        old.close()
+        return cls(path)
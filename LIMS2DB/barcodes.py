@@ -0,0 +1,119 @@
+"""Barcode extraction from reagent label names, with an in-memory copy of the reagent types"""
+
+import bisect
+import re
+from functools import lru_cache
+
+from genologics_sql.tables import ReagentType
+from sqlalchemy.orm.exc import MultipleResultsFound
+
+from LIMS2DB.utils import like_match
+
+BARCODE_PAT = re.compile(r"[ATCG\-]{4,}")
+BARCODE_UNDERSCORE_PAT = re.compile(r"[ATCG\-\_]{4,}")
+LABEL_PAT = re.compile(r"\(([A-Z\-]+)\)")
+LABEL_UNDERSCORE_PAT = re.compile(r"\(([A-Z\-\_]+)\)")
+TENX_SINGLE_PAT = re.compile("SI-(?:GA|NA)-[A-H][1-9][0-2]?")
+TENX_DUAL_PAT = re.compile("SI-(?:TT|NT|NN|TN|TS)-[A-H][1-9][0-2]?")
+SMARTSEQ_PAT = re.compile("SMARTSEQ[1-9]?-[1-9][0-9]?[A-P]")
+
+
+class BarcodeResolver:
+    """Extracts barcodes from reagent label names.
+    :param session: genologics_sql session, only used to load the reagent types
+    :param int maxsize: number of resolved labels to remember
+    """
+
+    def __init__(self, session, maxsize=8192):
+        self.names = []
+        self.metas = []
+        for name, meta in session.query(ReagentType.name, ReagentType.meta_data):
+            # a NULL name never matches a LIKE
+            if name is not None:
+                self.names.append(name)
+                self.metas.append(meta)
+        # all the names in one string, starts[i] being the offset of names[i]
+        self.text = "\0".join(self.names)
+        self.starts = []
+        offset = 0
+        for name in self.names:
+            self.starts.append(offset)
+            offset += len(name) + 1
+        self.extract = lru_cache(maxsize=maxsize)(self._extract)
+
+    def matching(self, barcode):
+        """Indexes of the reagent types whose name is LIKE '%barcode%'"""
+        if "%" in barcode or "_" in barcode:
+            pattern = "%{}%".format(barcode)
+            return [i for i, name in enumerate(self.names) if like_match(pattern, name)]
+        found = []
+        pos = self.text.find(barcode)
+        while pos != -1 and self.names:
+            i = bisect.bisect_right(self.starts, pos) - 1
+            end = self.starts[i] + len(self.names[i])
+            if pos + len(barcode) <= end:
+                found.append(i)
+                # one match per name is enough
+                pos = end + 1
+            else:
+                pos += 1
+            pos = self.text.find(barcode, pos)
+        return found
+
+    def meta_data(self, barcode):
+        """Same result as the scalar() of ReagentType.meta_data filtered on name LIKE '%barcode%' :
+        None when nothing matches, MultipleResultsFound when several reagent types match.
+        """
+        found = self.matching(barcode)
+        if len(found) > 1:
+            raise MultipleResultsFound(
+                "Multiple reagent types match {}".format(barcode)
+            )
+        return self.metas[found[0]] if found else None
+
+    def _extract(self, chain, underscores=False):
+        """Returns the barcode of a reagent label.
+        :param str chain: reagent label name
+        :param bool underscores: accept underscores in barcodes, and turn them into dashes
+        """
+        bcp = BARCODE_UNDERSCORE_PAT if underscores else BARCODE_PAT
+        barcode = ""
+        if "NoIndex" in chain:
+            return chain
+        if (
+            TENX_SINGLE_PAT.match(chain)
+            or TENX_DUAL_PAT.match(chain)
+            or SMARTSEQ_PAT.match(chain)
+        ):
+            return chain
+        if "(" not in chain:
+            barcode = chain
+        else:
+            pattern = LABEL_UNDERSCORE_PAT if underscores else LABEL_PAT
+            matches = pattern.search(chain)
+            if matches.group(1):
+                barcode = matches.group(1)
+                if underscores:
+                    barcode = barcode.replace("_", "-")
+        matches = bcp.match(barcode)
+        if not matches:
+            # raises TypeError when no reagent type matches, like the query it replaces
+            matches = bcp.search(self.meta_data(barcode))
+            if matches:
+                barcode = matches.group(0)
+                if underscores:
+                    barcode = barcode.replace("_", "-")
+        return barcode
+
+
+_resolver = None
+
+
+def barcode_resolver(session):
+    """BarcodeResolver of the current process, loaded on first use
+    :param session: genologics_sql session
+    """
+    global _resolver
+    if _resolver is None:
+        _resolver = BarcodeResolver(session)
+    return _resolver
@@ -2,24 +2,37 @@ from genologics_sql.tables import (
     Artifact,
     Container,
     EscalationEvent,
-    GlsFile,
     Process,
     Project,
-    Researcher,
-    ReagentType,
+    Sample,
 )
-from genologics_sql.queries import get_children_processes, get_processes_in_history
-from LIMS2DB.diff import diff_objects
-from requests import get as rget
-from sqlalchemy import text
+from LIMS2DB.couch_bulk import (
+    BUILD_STATE_FIELD,
+    SAMPLES_DB,
+    SAMPLES_FIELD,
+    assemble_project_doc,
+    notify_project_saved,
+    prepare_project_doc,
+    save_project_doc,
+    save_sample_docs,
+    split_project_doc,
+)
+from LIMS2DB.lineage import LineageGraph, ProjectLineage
+from LIMS2DB import order_portal, profiling, statements
+from LIMS2DB.barcodes import barcode_resolver
+from LIMS2DB.researchers import get_researcher
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from datetime import datetime
-from LIMS2DB.utils import send_mail
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from genologics_sql.utils import get_session
+from LIMS2DB.utils import like_match
+from sqlalchemy.orm import selectinload
 
 import LIMS2DB.objectsDB.process_categories as pc_cg
-import re
 import six.moves.http_client as http_client
 import copy
+import queue
 
 
 class Workset:
@@ -255,47 +268,54 @@ class LimsCrawler:
                 self.crawl(starting_step=step)
 
 
+def workset_artifact_loads():
+    """Loader options of the relationships of the artifacts read by Workset_SQL, so that they are
+    loaded with the artifacts of its graph. Built on use, some relationships are backrefs set up once
+    the mappers are configured.
+    """
+    return (
+        selectinload(Artifact.states),
+        selectinload(Artifact.udfs),
+        selectinload(Artifact.reagentlabels),
+        selectinload(Artifact.containerplacement),
+        selectinload(Artifact.samples).selectinload(Sample.udfs),
+    )
+
+
+def copy_workset_sample(sample_obj):
+    """Copy of a sample of a workset document for one of its replicates.
+    The build replaces the dicts kept in the library, sequencing and rec_ctrl of a sample rather
+    than modifying them, so only the two first levels are copied.
+    """
+    return {
+        key: dict(value) if isinstance(value, dict) else value
+        for key, value in sample_obj.items()
+    }
+
+
 class Workset_SQL:
-    def __init__(self, session, log, step):
+    def __init__(self, session, log, step, graph=None, ancestor_index=None):
         self.log = log
         self.start = step
         self.name = set()
         self.session = session
+        # LineageGraph of the step loaded with LineageGraph.for_processes(session, [step]),
+        # False to query the outputs, aggregates and sequencing runs of each input instead
+        if graph is None:
+            graph = LineageGraph.for_processes(
+                session,
+                [step],
+                ancestor_index=ancestor_index,
+                artifact_loads=workset_artifact_loads(),
+            )
+        self.graph = graph
+        # optional local AncestorIndex, replaces the artifact_ancestor_map joins
+        self.ancestor_index = ancestor_index
         self.obj = {}
         self.build()
 
     def extract_barcode(self, chain):
-        barcode = ""
-        bcp = re.compile("[ATCG\-]{4,}")
-        TENX_SINGLE_PAT = re.compile("SI-(?:GA|NA)-[A-H][1-9][0-2]?")
-        TENX_DUAL_PAT = re.compile("SI-(?:TT|NT|NN|TN|TS)-[A-H][1-9][0-2]?")
-        SMARTSEQ_PAT = re.compile("SMARTSEQ[1-9]?-[1-9][0-9]?[A-P]")
-        if "NoIndex" in chain:
-            return chain
-        if (
-            TENX_SINGLE_PAT.match(chain)
-            or TENX_DUAL_PAT.match(chain)
-            or SMARTSEQ_PAT.match(chain)
-        ):
-            return chain
-        if "(" not in chain:
-            barcode = chain
-        else:
-            pattern = re.compile("\(([A-Z\-]+)\)")
-            matches = pattern.search(chain)
-            if matches.group(1):
-                barcode = matches.group(1)
-        matches = bcp.match(barcode)
-        if not matches:
-            meta = (
-                self.session.query(ReagentType.meta_data)
-                .filter(ReagentType.name.like("%{}%".format(barcode)))
-                .scalar()
-            )
-            matches = bcp.search(meta)
-            if matches:
-                barcode = matches.group(0)
-        return barcode
+        return barcode_resolver(self.session).extract(chain)
 
     def build(self):
         self.obj["id"] = self.start.luid
@@ -305,32 +325,23 @@ class Workset_SQL:
         else:
             self.obj["date_run"] = None
 
-        query = "select distinct co.* from processiotracker pio \
-                inner join outputmapping om on om.trackerid=pio.trackerid \
-                inner join containerplacement cp on cp.processartifactid=om.outputartifactid \
-                inner join container co on cp.containerid=co.containerid \
-                where pio.processid = {0};".format(self.start.processid)
-        self.container = self.session.query(Container).from_statement(text(query)).one()
+        self.container = statements.fetch_one(
+            self.session, Container, "workset_container", processid=self.start.processid
+        )
         self.obj["name"] = self.container.name
 
-        query = "select rs.email from principals pr \
-                inner join researcher rs on rs.researcherid=pr.researcherid \
-                where principalid=:pid;"
-        technician_email = (
-            self.session.query(Researcher.email)
-            .from_statement(text(query))
-            .params(pid=self.start.ownerid)
-            .scalar()
-        )
+        technician = get_researcher(self.session, self.start.ownerid)
+        technician_email = technician.email if technician else None
         self.obj["technician"] = technician_email.split("@")[0] if technician_email else ""
 
         # main part
         self.obj["projects"] = {}
-        query = "select art.* from artifact art \
-                inner join processiotracker piot on piot.inputartifactid=art.artifactid \
-                where piot.processid = {0}".format(self.start.processid)
-
-        input_arts = self.session.query(Artifact).from_statement(text(query)).all()
+        if self.graph:
+            input_arts = self.graph.inputs_of(self.start)
+        else:
+            input_arts = statements.fetch_all(
+                self.session, Artifact, "process_inputs", processid=self.start.processid
+            )
 
         for inp in input_arts:
             sample = inp.samples[0]
@@ -380,27 +391,32 @@ class Workset_SQL:
                 "status"
             ] = inp.qc_flag
 
-            query = "select art.* from artifact art \
-            inner join outputmapping om on om.outputartifactid=art.artifactid \
-            inner join processiotracker piot on piot.trackerid=om.trackerid \
-            where piot.inputartifactid={inp_art} and art.artifacttypeid=2 and piot.processid={start_id};".format(
-                inp_art=inp.artifactid, start_id=self.start.processid
-            )
-
             # When one input artifact generates multiple output artifacts,
             # expand the input artifact with postfix _1, _2, etc
-            outs = self.session.query(Artifact).from_statement(text(query)).all()
+            if self.graph:
+                outs = [
+                    art
+                    for art in self.graph.outputs_of(self.start, inp.artifactid)
+                    if art.artifacttypeid == 2
+                ]
+            else:
+                outs = statements.fetch_all(
+                    self.session,
+                    Artifact,
+                    "workset_outputs",
+                    inputid=inp.artifactid,
+                    processid=self.start.processid,
+                )
             rep_counter = 1
             for out in outs:
                 if len(outs) > 1:
                     if self.obj["projects"][project_luid]["samples"].get(sample.name):
-                        org_sample_obj = copy.deepcopy(
-                            self.obj["projects"][project_luid]["samples"][sample.name]
-                        )
-                        del self.obj["projects"][project_luid]["samples"][sample.name]
+                        org_sample_obj = self.obj["projects"][project_luid][
+                            "samples"
+                        ].pop(sample.name)
                     sample_name = sample.name + "_" + str(rep_counter)
                     self.obj["projects"][project_luid]["samples"][sample_name] = (
-                        copy.deepcopy(org_sample_obj)
+                        copy_workset_sample(org_sample_obj)
                     )
                     rep_counter += 1
                 else:
@@ -410,17 +426,28 @@ class Workset_SQL:
                     "location"
                 ] = out.containerplacement.api_string
 
-                query = "select pc.* from process pc \
-                        inner join processiotracker piot on piot.processid=pc.processid \
-                        inner join artifact_ancestor_map aam on aam.artifactid=piot.inputartifactid \
-                        where pc.typeid in ({agr_qc}) and aam.ancestorartifactid={out_art} order by daterun;".format(
-                    agr_qc=",".join(list(pc_cg.AGRLIBVAL.keys())),
-                    out_art=out.artifactid,
-                )
+                if not self.graph:
+                    descending, descendant_params = statements.descending(
+                        "process_inputs_descending", out.artifactid, self.ancestor_index
+                    )
+                    consuming, consumer_params = statements.descending(
+                        "processes_using_descendants",
+                        out.artifactid,
+                        self.ancestor_index,
+                    )
 
-                aggregates = (
-                    self.session.query(Process).from_statement(text(query)).all()
-                )
+                if self.graph:
+                    aggregates = self.graph.descendant_consumers(
+                        out.artifactid, pc_cg.AGRLIBVAL, "daterun"
+                    )
+                else:
+                    aggregates = statements.fetch_all(
+                        self.session,
+                        Process,
+                        consuming,
+                        typeids=statements.typeids(pc_cg.AGRLIBVAL),
+                        **consumer_params,
+                    )
 
                 for agr in aggregates:
                     self.obj["projects"][project_luid]["samples"][sample_name][
@@ -449,16 +476,21 @@ class Workset_SQL:
                             "library"
                         ][agr.luid]["date"] = None
 
-                    query = "select art.* from artifact art \
-                            inner join processiotracker piot on piot.inputartifactid=art.artifactid \
-                            inner join artifact_ancestor_map aam on aam.artifactid=art.artifactid \
-                            where piot.processid={processid} and aam.ancestorartifactid={ancestorid};".format(
-                        processid=agr.processid, ancestorid=out.artifactid
-                    )
-
-                    agr_inp = (
-                        self.session.query(Artifact).from_statement(text(query)).one()
-                    )
+                    if self.graph:
+                        agr_inps = self.graph.descendant_inputs(agr, out.artifactid)
+                        if not agr_inps:
+                            raise NoResultFound()
+                        if len(agr_inps) > 1:
+                            raise MultipleResultsFound()
+                        agr_inp = agr_inps[0]
+                    else:
+                        agr_inp = statements.fetch_one(
+                            self.session,
+                            Artifact,
+                            descending,
+                            processid=agr.processid,
+                            **descendant_params,
+                        )
                     if agr.typeid == 806 and agr_inp.qc_flag == "UNKNOWN":
                         self.obj["projects"][project_luid]["samples"][sample_name][
                             "library"
@@ -499,37 +531,34 @@ class Workset_SQL:
                             "library"
                         ][agr.luid]["size"] = round(agr_inp.udf_dict["Size (bp)"], 2)
 
-                    # Fetch index (reagent_label) information
+                    # Fetch index (reagent_label) information, from the only input of the
+                    # aggregate descending from out
                     try:
-                        artifacts = (
-                            self.session.query(Artifact)
-                            .from_statement(text(query))
-                            .all()
-                        )
-                        for art in artifacts:
-                            if (
-                                art.reagentlabels is not None
-                                and len(art.reagentlabels) == 1
-                            ):
-                                # If there are more than one reagent label, then I can't guess which one is the right one : the artifact is probably a pool
-                                self.obj["projects"][project_luid]["samples"][
-                                    sample_name
-                                ]["library"][agr.luid]["index"] = self.extract_barcode(
-                                    art.reagentlabels[0].name
-                                )
+                        if (
+                            agr_inp.reagentlabels is not None
+                            and len(agr_inp.reagentlabels) == 1
+                        ):
+                            # If there are more than one reagent label, then I can't guess which one is the right one : the artifact is probably a pool
+                            self.obj["projects"][project_luid]["samples"][sample_name][
+                                "library"
+                            ][agr.luid]["index"] = self.extract_barcode(
+                                agr_inp.reagentlabels[0].name
+                            )
                     except AssertionError:
                         pass
 
-                query = "select pc.* from process pc \
-                        inner join processiotracker piot on piot.processid=pc.processid \
-                        inner join artifact_ancestor_map aam on aam.artifactid=piot.inputartifactid \
-                        where pc.typeid in ({seq}) and aam.ancestorartifactid={out_art} order by daterun;".format(
-                    seq=",".join(list(pc_cg.SEQUENCING.keys())), out_art=out.artifactid
-                )
-
-                sequencing = (
-                    self.session.query(Process).from_statement(text(query)).all()
-                )
+                if self.graph:
+                    sequencing = self.graph.descendant_consumers(
+                        out.artifactid, pc_cg.SEQUENCING, "daterun"
+                    )
+                else:
+                    sequencing = statements.fetch_all(
+                        self.session,
+                        Process,
+                        consuming,
+                        typeids=statements.typeids(pc_cg.SEQUENCING),
+                        **consumer_params,
+                    )
                 for seq in sequencing:
                     if seq.daterun is not None:
                         self.obj["projects"][project_luid]["samples"][sample_name][
@@ -539,18 +568,18 @@ class Workset_SQL:
                             "sequencing"
                         ][seq.luid]["date"] = seq.daterun.strftime("%Y-%m-%d")
 
-                        query = "select art.* from artifact art \
-                                inner join processiotracker piot on piot.inputartifactid=art.artifactid \
-                                inner join artifact_ancestor_map aam on aam.artifactid=art.artifactid \
-                                where piot.processid={processid} and aam.ancestorartifactid={ancestorid};".format(
-                            processid=seq.processid, ancestorid=out.artifactid
-                        )
-
-                        seq_inputs = (
-                            self.session.query(Artifact)
-                            .from_statement(text(query))
-                            .all()
-                        )
+                        if self.graph:
+                            seq_inputs = self.graph.descendant_inputs(
+                                seq, out.artifactid
+                            )
+                        else:
+                            seq_inputs = statements.fetch_all(
+                                self.session,
+                                Artifact,
+                                descending,
+                                processid=seq.processid,
+                                **descendant_params,
+                            )
                         seq_qc_flag = "UNKNOWN"
                         for seq_inp in seq_inputs:
                             if (
@@ -567,9 +596,32 @@ class Workset_SQL:
                         ] = seq_qc_flag
 
 
+# Samples modified this long before the previous save are rebuilt too by incremental updates,
+# to catch changes committed by transactions that were still running at that time
+INCREMENTAL_MARGIN = timedelta(minutes=10)
+# key of the build state: sample whose last sequencing run gave sequencing_finished, the last one
+# in the project order
+SEQUENCING_FINISHED_SAMPLE = "sequencing_finished_sample"
+# samples built together by a sample worker, their documents are merged as soon as they are built
+SAMPLE_CHUNK_SIZE = 16
+
+
 class ProjectSQL:
     def __init__(
-        self, session, log, pid, host="genologics.scilifelab.se", couch=None, oconf=None
+        self,
+        session,
+        log,
+        pid,
+        host="genologics.scilifelab.se",
+        couch=None,
+        oconf=None,
+        lineage_graph=False,
+        ancestor_index=None,
+        incremental=False,
+        sample_workers=1,
+        output=None,
+        orders=None,
+        doc_ids=None,
     ):
         self.log = log
         self.pid = pid
@@ -578,22 +630,181 @@ class ProjectSQL:
         self.session = session
         self.couch = couch
         self.oconf = oconf
+        # resolve the library prep lineage with a LineageGraph of the project instead of ProjectLineage
+        self.lineage_graph = lineage_graph
+        # optional local AncestorIndex, replaces the artifact_ancestor_map joins
+        self.ancestor_index = ancestor_index
+        # only rebuild the samples modified since the document in couch was last saved
+        self.incremental = incremental
+        # number of threads building the samples, each with its own session
+        self.sample_workers = sample_workers
+        # rows of the project wide statements and lineage of the project, shared with the sample workers
+        self.project_rows = {}
+        self.lineage = None
+        # set on the builders of the sample workers, see reduce
+        self.recorded_updates = None
+        self.current_sample = None
+        # kept in the couch document for the next incremental build, not in the document built
+        self.build_state = {}
+        # set when documents of samples of the project are missing in couch, they are saved again
+        self.sample_docs_missing = False
+        # optional ProjectJSONWriter, the document is written to it while it is built
+        self.output = output
+        # order details prefetched by portal id, see order_portal.prefetch_orders
+        self.orders = orders
+        # couch document ids by project luid, see couch_bulk.fetch_project_doc_ids
+        self.doc_ids = doc_ids
         self.genstat_proj_url = "https://genomics-status.scilifelab.se/project/"
         self.obj = {}
+        self.profile = profiling.BuildProfile(pid)
         self.project = (
             self.session.query(Project).filter(Project.luid == self.pid).one()
         )
         self.build()
+        self.log_profile()
 
+    @profiling.phase
     def build(self):
         self.get_project_level()
         self.get_project_summary()
         self.get_escalations()
-        self.get_samples()
+        previous = self.get_previous_doc() if self.incremental else None
+        if previous:
+            self.update_samples(previous)
+        else:
+            self.get_samples()
         self.set_status()
+        if self.output is not None:
+            self.output.finish(self.obj)
+
+    def log_profile(self):
+        """Logs the build profile, with the structured record in the profile attribute of the log record"""
+        self.log.info(
+            "Build profile of project {}: {}".format(self.pid, self.profile.summary()),
+            extra={"profile": self.profile.as_dict()},
+        )
 
-    def save(self, update_modification_time=True):
+    def get_previous_doc(self):
+        """Returns the current couch document of the project if it can be updated incrementally, None otherwise"""
+        if not self.couch:
+            return None
+        doc = self.get_doc(self.couch["projects"])
+        if doc and SAMPLES_FIELD in doc:
+            # the samples are saved in their own documents
+            try:
+                doc = assemble_project_doc(doc, self.couch[SAMPLES_DB])
+            except Exception as e:
+                self.log.error(
+                    "Cannot read the sample documents of project {}, rebuilding and saving all its "
+                    "samples: {!r}".format(self.pid, e)
+                )
+                self.sample_docs_missing = True
+                return None
+        if not doc or "samples" not in doc:
+            return None
+        try:
+            datetime.fromisoformat(doc["modification_time"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        return doc
+
+    def update_samples(self, previous):
+        """Rebuilds the samples modified since the previous document was saved, and the ones it lacks.
+        The other samples are copied from it. The project fields computed over all samples that do not
+        depend on their order are copied too and updated by the rebuilt samples. sequencing_finished
+        comes from the last sample of the project giving one, which is a rebuilt sample or the one that
+        gave it in the previous document. When that cannot be told, all the samples are rebuilt.
+        :param dict previous: current couch document of the project
+        """
+        since = (
+            datetime.fromisoformat(previous["modification_time"]) - INCREMENTAL_MARGIN
+        )
+        modified = set(
+            row[0]
+            for row in statements.fetch_rows(
+                self.session,
+                "project_modified_samples",
+                projectid=self.project.projectid,
+                since=since,
+            )
+        )
+        samples = [
+            sample
+            for sample in self.project.samples
+            if sample.processid in modified or sample.name not in previous["samples"]
+        ]
+        # keep the order of a full build
+        self.obj["samples"] = {
+            sample.name: previous["samples"].get(sample.name)
+            for sample in self.project.samples
+        }
+        for field in ["first_initial_qc", "isFinishedLib"]:
+            if field in previous:
+                self.obj[field] = previous[field]
+        self.log.info(
+            "Rebuilding {} out of {} samples of project {}".format(
+                len(samples), len(self.project.samples), self.pid
+            )
+        )
+        # the updates of the project fields are recorded, to be applied in the order of the samples
+        self.recorded_updates = []
+        try:
+            self.get_samples(samples)
+            recorded = self.recorded_updates
+        finally:
+            self.recorded_updates = None
+        sequencing_finished = {}
+        for sample_name, update, args in recorded:
+            if update == "update_sequencing_finished":
+                sequencing_finished[sample_name] = args
+            else:
+                getattr(self, update)(*args)
+        position = {sample.name: i for i, sample in enumerate(self.project.samples)}
+        last_rebuilt = max(sequencing_finished, key=position.get, default=None)
+        if "sequencing_finished" in previous:
+            # the samples after the previous one giving sequencing_finished gave none, and the ones
+            # before it did not matter, unless it was rebuilt
+            last_copied = previous.get(BUILD_STATE_FIELD, {}).get(
+                SEQUENCING_FINISHED_SAMPLE
+            )
+            rebuilt = set(sample.name for sample in samples)
+            if last_copied not in position or (
+                last_copied in rebuilt
+                and (
+                    last_rebuilt is None
+                    or position[last_rebuilt] < position[last_copied]
+                )
+            ):
+                self.log.info(
+                    "Cannot tell which sample gives sequencing_finished, rebuilding all the "
+                    "samples of project {}".format(self.pid)
+                )
+                for field in ["first_initial_qc", "isFinishedLib"]:
+                    self.obj.pop(field, None)
+                self.get_samples()
+                return
+            if last_copied not in rebuilt and (
+                last_rebuilt is None or position[last_rebuilt] < position[last_copied]
+            ):
+                self.obj["sequencing_finished"] = previous["sequencing_finished"]
+                self.build_state[SEQUENCING_FINISHED_SAMPLE] = last_copied
+                return
+        if last_rebuilt is not None:
+            self.current_sample = last_rebuilt
+            self.update_sequencing_finished(*sequencing_finished[last_rebuilt])
+
+    def get_doc(self, db):
+        """Returns the current couch document of the project, or None"""
+        if self.doc_ids is not None and self.pid in self.doc_ids:
+            return db.get(self.doc_ids[self.pid])
         doc = None
+        for row in db.view("project/project_id")[self.pid]:
+            doc = db.get(row.id)
+        return doc
+
+    def save(
+        self, update_modification_time=True, delta_min_size=None, split_samples=False
+    ):
         # When running for a single project, sometimes the connection is lost so retry
         try:
             self.couch["projects"]
@@ -605,106 +816,21 @@ class ProjectSQL:
             )
             pass
         db = self.couch["projects"]
-        view = db.view("project/project_id")
-        for row in view[self.pid]:
-            doc = db.get(row.id)
-        if doc:
-            fields_saved = [
-                "_id",
-                "_rev",
-                "modification_time",
-                "creation_time",
-                "staged_files",
-                "agreement_doc_id",
-                "invoice_spec_generated",
-                "invoice_spec_downloaded",
-                "delivery_projects",
-            ]
-            details_saved = ["running_notes", "snic_checked", "latest_sticky_note"]
-
-            fields_added_back = {}
-            details_added_back = {}
-
-            for field in fields_saved:
-                fields_added_back[field] = doc.pop(field, None)
-
-            for field in details_saved:
-                details_added_back[field] = doc["details"].pop(field, None)
-
-            diffs = diff_objects(doc, self.obj)
-            if diffs:
-                for field in fields_added_back:
-                    if update_modification_time and field == "modification_time":
-                        self.obj[field] = datetime.now().isoformat()
-                        continue
-                    if fields_added_back[field]:
-                        self.obj[field] = fields_added_back[field]
-
-                for field in details_added_back:
-                    if details_added_back[field]:
-                        self.obj["details"][field] = details_added_back[field]
-
-                # Don't overwrite order portal details if have not been able to fetch them this round
-                if self.obj["order_details"] == {} and doc["order_details"] != {}:
-                    self.log.warn(
-                        "Preventing order details to be overwritten since no details were fetched from order portal this round"
-                    )
-                    self.obj["order_details"] = doc["order_details"]
-
-                self.log.info("Trying to save new doc for project {}".format(self.pid))
-                db.save(self.obj)
-                if self.obj.get("details", {}).get("type", "") == "Application":
-                    lib_method_text = f"Library method: {self.obj['details'].get('library_construction_method', 'N/A')}"
-                    application = self.obj.get('details', {}).get('application', '')
-                    is_single_cell =  application == 'RNA-seq (single cell)'
-                    if is_single_cell:
-                        single_cell_text = f"[Application: {application}]"
-                    if "key  details contract_received" in diffs.keys():
-                        genstat_url = f'{self.genstat_proj_url}{self.obj["project_id"]}'
-                        if diffs["key  details contract_received"][1] == "missing":
-                            old_contract_received = diffs[
-                                "key  details contract_received"
-                            ][0]
-                            msg = f"Contract received on {old_contract_received} deleted for applications project "
-                            msg += f'<a href="{genstat_url}">{self.obj["project_id"]}, {self.obj["project_name"]}</a>[{lib_method_text}]\
-                            { single_cell_text if is_single_cell else "" }.'
-                        else:
-                            contract_received = diffs["key  details contract_received"][
-                                1
-                            ]
-                            msg = "Contract received for applications project "
-                            msg += f'<a href="{genstat_url}">{self.obj["project_id"]}, {self.obj["project_name"]}</a>[{lib_method_text}]\
-                            { single_cell_text if is_single_cell else "" } on {contract_received}.'
-
-                        if is_single_cell:
-                            send_mail(f'Contract updated for single cell Project {self.obj["project_name"]}',
-                                       msg, 
-                                       'ngi_singlecell_projects@scilifelab.se')
-                        else:
-                            send_mail(
-                                f'Contract updated for GA Project {self.obj["project_name"]}',
-                                msg,
-                                "ngi_ga_projects@scilifelab.se",
-                            )
-            else:
-                self.log.info("No modifications found for project {}".format(self.pid))
-
-        else:
-            self.obj["creation_time"] = datetime.now().isoformat()
-            self.obj["modification_time"] = self.obj["creation_time"]
+        doc = self.get_doc(db)
+        obj = self.obj
+        if split_samples:
+            obj, sample_docs = split_project_doc(self.obj)
+        save, diffs = prepare_project_doc(
+            obj, doc, self.log, update_modification_time, self.build_state
+        )
+        if split_samples and (save or self.sample_docs_missing):
+            save_sample_docs(self.couch[SAMPLES_DB], self.pid, sample_docs, self.log)
+        if save:
             self.log.info("Trying to save new doc for project {}".format(self.pid))
-            db.save(self.obj)
-            if self.obj.get("details", {}).get("type", "") == "Application":
-                genstat_url = f'{self.genstat_proj_url}{self.obj["project_id"]}'
-                lib_method_text = f"Library method: {self.obj['details'].get('library_construction_method', 'N/A')}"
-                msg = "New applications project created "
-                msg += f'<a href="{genstat_url}">{self.obj["project_id"]}, {self.obj["project_name"]}</a>[{lib_method_text}].'
-                send_mail(
-                    f'GA Project created {self.obj["project_name"]}',
-                    msg,
-                    "ngi_ga_projects@scilifelab.se",
-                )
+            save_project_doc(db, obj, doc, self.log, delta_min_size)
+            notify_project_saved(obj, diffs, self.genstat_proj_url)
 
+    @profiling.phase
     def get_project_level(self):
         self.obj["entity_type"] = "project_summary"
         self.obj["source"] = "lims"
@@ -730,17 +856,17 @@ class ProjectSQL:
         if self.project.priority:
             self.obj["priority"] = lims_priority.get(self.project.priority, None)
 
+    @profiling.phase
     def get_project_summary(self):
         # get project summaries from project
-        query = "select distinct pr.* from process pr \
-            inner join processiotracker piot on piot.processid=pr.processid \
-            inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
-            inner join sample sa on sa.processid=asm.processid \
-            where sa.projectid = {pjid} and pr.typeid={tid} order by createddate desc;".format(
-            pjid=self.project.projectid, tid=list(pc_cg.SUMMARY.keys())[0]
-        )
         try:
-            pjs = self.session.query(Process).from_statement(text(query)).all()
+            pjs = statements.fetch_all(
+                self.session,
+                Process,
+                "project_summaries",
+                projectid=self.project.projectid,
+                typeid=int(list(pc_cg.SUMMARY.keys())[0]),
+            )
             self.obj["project_summary"] = self.make_normalized_dict(pjs[0].udf_dict)
             self.obj["project_summary_links"] = []
             for pj in pjs:
@@ -756,36 +882,21 @@ class ProjectSQL:
                 "No project summary found for project {}".format(self.project.projectid)
             )
 
+    @profiling.phase
     def get_escalations(self):
         # get EscalationEvents from Project
-        query = "select distinct esc.* from escalationevent esc \
-                inner join processiotracker piot on piot.processid=esc.processid \
-                inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
-                inner join sample sa on sa.processid=asm.processid \
-                where esc.reviewdate is NULL and sa.projectid = {pjid};".format(
-            pjid=self.project.projectid
-        )
-        escalations = (
-            self.session.query(EscalationEvent).from_statement(text(query)).all()
+        escalations = statements.fetch_all(
+            self.session,
+            EscalationEvent,
+            "project_escalations",
+            projectid=self.project.projectid,
         )
         if escalations:
             esc_list = []
             for esc in escalations:
                 # get requester and reviewer
-                query = "select distinct r.* \
-                        from researcher r \
-                        inner join principals pr on pr.researcherid=r.researcherid \
-                        where pr.principalid={requesterid};"
-                requester = (
-                    self.session.query(Researcher)
-                    .from_statement(text(query.format(requesterid=esc.ownerid)))
-                    .all()[0]
-                )
-                reviewer = (
-                    self.session.query(Researcher)
-                    .from_statement(text(query.format(requesterid=esc.reviewerid)))
-                    .all()[0]
-                )
+                requester = get_researcher(self.session, esc.ownerid)
+                reviewer = get_researcher(self.session, esc.reviewerid)
                 esc_list.append(
                     [
                         str(esc.processid),
@@ -802,60 +913,18 @@ class ProjectSQL:
             ret[key] = kv[1]
         return ret
 
+    @profiling.phase
     def get_project_order(self):
         # get project order details from orderportal
         proj_order_info = {}
         if self.oconf:
             try:
-                proj_order_url = "{}/{}".format(
-                    self.oconf["api_get_order_url"].rstrip("/"),
-                    self.obj["details"]["portal_id"],
-                )
-                api_header = {"X-OrderPortal-API-key": self.oconf["api_token"]}
-                full_order_info = rget(proj_order_url, headers=api_header).json()
-                filter_keys = [
-                    "created",
-                    "modified",
-                    "site",
-                    "title",
-                    "identifier",
-                    {
-                        "owner": ["name", "email"],
-                        "fields": [
-                            "seq_readlength_hiseqx",
-                            "library_readymade",
-                            "bx_exp",
-                            "seq_instrument",
-                            "project_lab_email",
-                            "project_bx_email",
-                            "project_lab_name",
-                            "bx_data_delivery",
-                            "sample_no",
-                            "bioinformatics",
-                            "sequencing",
-                            "project_pi_name",
-                            "bx_bp",
-                            "project_desc",
-                            "project_pi_email",
-                        ],
-                    },
-                ]
-                for fk in filter_keys:
-                    if isinstance(fk, dict):
-                        for k, vals in fk.items():
-                            if k not in proj_order_info:
-                                proj_order_info[k] = {}
-                            for vk in vals:
-                                proj_order_info[k][vk] = full_order_info.get(k, {}).get(
-                                    vk
-                                )
-                    else:
-                        proj_order_info[fk] = full_order_info.get(fk)
-                owner_url = full_order_info["owner"]["links"]["api"]["href"]
-                owner_affiliation = (
-                    rget(owner_url, headers=api_header).json().get("university", "")
+                portal_id = self.obj["details"]["portal_id"]
+                if self.orders and portal_id in self.orders:
+                    return self.orders[portal_id]
+                order_portal.client(self.oconf).fill_order_info(
+                    portal_id, proj_order_info
                 )
-                proj_order_info["owner"]["affiliation"] = owner_affiliation
             except Exception as e:
                 self.log.warn(
                     "Not able to get update order info for project {}".format(
@@ -864,10 +933,30 @@ class ProjectSQL:
                 )
         return proj_order_info
 
-    def get_samples(self):
+    @profiling.phase
+    def get_samples(self, samples=None):
+        """Builds the given samples, all the samples of the project by default"""
         self.obj["no_of_samples"] = len(self.project.samples)
-        self.obj["samples"] = {}
-        for sample in self.project.samples:
+        if samples is None:
+            samples = self.project.samples
+            self.obj["samples"] = {}
+            if self.output is not None:
+                # full build, each sample can be written as soon as it is built
+                self.output.start_samples(self.obj)
+        if not samples:
+            return
+        if self.sample_workers > 1 and len(samples) > 1:
+            self.get_samples_parallel(samples)
+        else:
+            self.build_samples(samples)
+
+    def build_samples(self, samples):
+        """Builds the given samples in this thread"""
+        self.prefetch_initial_qc(samples)
+        if self.lineage is None:
+            self.load_lineage()
+        for sample in samples:
+            self.current_sample = sample.name
             self.obj["samples"][sample.name] = {}
             self.obj["samples"][sample.name]["scilife_name"] = sample.name
             self.obj["samples"][sample.name]["customer_name"] = sample.udf_dict.get(
@@ -879,20 +968,246 @@ class ProjectSQL:
 
             self.get_initial_qc(sample)
             self.get_library_preps(sample)
+            self.sample_done(sample)
+
+    def get_samples_parallel(self, samples):
+        """Builds the samples with sample_workers threads, each with its own session.
+        The samples are built by chunks, merged in the order of the samples as soon as they are built,
+        so the result is the same as a sequential build and streamed samples are not kept in memory.
+        """
+        samples = list(samples)
+        nb_workers = min(self.sample_workers, len(samples))
+        chunk_size = min(SAMPLE_CHUNK_SIZE, -(-len(samples) // nb_workers))
+        chunks = iter(
+            [samples[i : i + chunk_size] for i in range(0, len(samples), chunk_size)]
+        )
+        self.log.info(
+            "Building {} samples of project {} with {} workers".format(
+                len(samples), self.pid, nb_workers
+            )
+        )
+        # the project wide statements and the lineage are run once here,
+        # the workers load the entities of their samples with their sessions
+        self.prefetch_initial_qc([])
+        if self.lineage is None:
+            self.load_lineage()
+        # the workers count in the phases open here
+        phases = profiling.current_phases()
+        # copies of the builder made by sample_worker, reused by the next chunks
+        workers = []
+        idle = queue.SimpleQueue()
+
+        def build_chunk(chunk):
+            with profiling.inherited_phases(phases):
+                try:
+                    worker = idle.get_nowait()
+                except queue.Empty:
+                    worker = self.sample_worker()
+                    workers.append(worker)
+                try:
+                    return worker.build_sample_chunk(
+                        [sample.processid for sample in chunk]
+                    )
+                finally:
+                    idle.put(worker)
+
+        try:
+            with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+                # chunks being built, at most two per worker are built ahead of the one merged
+                pending = deque()
+                try:
+                    for chunk in chunks:
+                        pending.append((chunk, executor.submit(build_chunk, chunk)))
+                        if len(pending) < 2 * nb_workers:
+                            continue
+                        self.merge_sample_chunk(*pending.popleft())
+                    while pending:
+                        self.merge_sample_chunk(*pending.popleft())
+                except BaseException:
+                    for _, future in pending:
+                        future.cancel()
+                    raise
+        finally:
+            for worker in workers:
+                worker.session.close()
+
+    def merge_sample_chunk(self, chunk, future):
+        """Adds the samples built by a worker to the document, and replays their updates of the project fields"""
+        built, updates = future.result()
+        recorded = {}
+        for sample_name, update, args in updates:
+            recorded.setdefault(sample_name, []).append((update, args))
+        for sample in chunk:
+            self.obj["samples"][sample.name] = built[sample.name]
+            self.current_sample = sample.name
+            for update, args in recorded.get(sample.name, []):
+                self.reduce(getattr(self, update), *args)
+            self.sample_done(sample)
+
+    def load_lineage(self):
+        if self.lineage_graph:
+            self.lineage = LineageGraph.for_project(self.session, self.project)
+        else:
+            self.lineage = ProjectLineage(self.session, self.project)
+
+    def sample_done(self, sample):
+        """Writes a built sample to the output and drops it from the document, if the samples are streamed"""
+        if self.output is not None and self.output.streaming:
+            self.output.write_sample(sample.name, self.obj["samples"].pop(sample.name))
+
+    def sample_worker(self):
+        """Copy of this builder using a new session, to build samples in another thread.
+        ORM objects are bound to their session, so the copy loads its own project, and the entities of
+        the prefetched rows and of the lineage of its samples.
+        """
+        session = get_session()
+        worker = copy.copy(self)
+        worker.session = session
+        worker.sample_workers = 1
+        worker.output = None
+        worker.obj = {"details": self.obj["details"], "samples": {}}
+        worker.project = session.query(Project).filter(Project.luid == self.pid).one()
+        worker.samples_by_processid = {
+            sample.processid: sample for sample in worker.project.samples
+        }
+        if self.lineage_graph:
+            worker.lineage = self.lineage.with_session(session)
+        else:
+            worker.lineage = self.lineage.with_session(session, set())
+        return worker
+
+    def build_sample_chunk(self, processids):
+        """Builds some samples in a builder made by sample_worker.
+        Returns the sample documents and the recorded updates of the project fields.
+        :param list processids: processids of the samples to build
+        """
+        self.obj["samples"] = {}
+        self.recorded_updates = []
+        if not self.lineage_graph:
+            self.lineage.load_samples(set(processids))
+        self.build_samples([self.samples_by_processid[pid] for pid in processids])
+        return self.obj["samples"], self.recorded_updates
+
+    def reduce(self, update, *args):
+        """Updates a project field computed over all the samples with a value of the current sample.
+        The copies used by the sample workers record the update instead, the main builder replays it.
+        :param update: one of the update_* methods
+        """
+        if self.recorded_updates is None:
+            update(*args)
+        else:
+            self.recorded_updates.append((self.current_sample, update.__name__, args))
+
+    def update_first_initial_qc(self, daterun, createddate):
+        """Keeps the oldest initial QC run date, or the creation date of the first QC if it was not run"""
+        try:
+            if (
+                daterun
+                and datetime.strptime(self.obj["first_initial_qc"], "%Y-%m-%d")
+                > daterun
+            ):
+                self.obj["first_initial_qc"] = daterun.strftime("%Y-%m-%d")
+        except KeyError:
+            try:
+                self.obj["first_initial_qc"] = daterun.strftime("%Y-%m-%d")
+            except AttributeError:
+                self.obj["first_initial_qc"] = createddate.strftime("%Y-%m-%d")
+
+    def update_finished_lib(self):
+        self.obj["isFinishedLib"] = True
+
+    def update_sequencing_finished(self, finish_date):
+        self.obj["sequencing_finished"] = finish_date
+        self.build_state[SEQUENCING_FINISHED_SAMPLE] = self.current_sample
 
+    def fetch_project_rows(self, name, **params):
+        """Runs a project wide statement, once for the builder and its sample workers"""
+        key = (name, repr(sorted(params.items())))
+        if key not in self.project_rows:
+            self.project_rows[key] = statements.fetch_rows(
+                self.session, name, projectid=self.project.projectid, **params
+            )
+        return self.project_rows[key]
+
+    def fetch_by_sample(self, samples, name, entity, key, **params):
+        """Runs a project wide statement selecting the sample processid and the id of an entity
+        as the two first columns. Returns a dict sample processid -> list of (entity, row) for the
+        given sample processids, in the order of the query. The entities are loaded with a single
+        extra query.
+        """
+        rows = [
+            row for row in self.fetch_project_rows(name, **params) if row[0] in samples
+        ]
+        entities = {}
+        ids = set(row[1] for row in rows)
+        if ids:
+            for ent in self.session.query(entity).filter(key.in_(ids)).all():
+                entities[getattr(ent, key.key)] = ent
+        by_sample = {}
+        for row in rows:
+            by_sample.setdefault(row[0], []).append((entities[row[1]], row))
+        return by_sample
+
+    def fetch_rows_by_sample(self, name, **params):
+        """Runs a project wide statement selecting the sample processid as the first column.
+        Returns a dict sample processid -> list of rows, in the order of the query.
+        """
+        by_sample = {}
+        for row in self.fetch_project_rows(name, **params):
+            by_sample.setdefault(row[0], []).append(row)
+        return by_sample
+
+    @profiling.phase
+    def prefetch_initial_qc(self, samples):
+        """Fetches the data needed by get_initial_qc for all the given samples at once,
+        instead of running the same queries for every sample.
+        """
+        processids = set(sample.processid for sample in samples)
+        self.initial_qc_prefetch = {}
+        # initial artifacts
+        self.initial_qc_prefetch["initial_artifact"] = self.fetch_by_sample(
+            processids, "project_initial_artifacts", Artifact, Artifact.artifactid
+        )
+        # initial QC processes, oldest first
+        self.initial_qc_prefetch["initial_qc"] = self.fetch_by_sample(
+            processids,
+            "project_sample_processes",
+            Process,
+            Process.processid,
+            typeids=statements.typeids(pc_cg.INITALQC, pc_cg.INITALQCFINISHEDLIB),
+        )
+        # initial QC aggregates, youngest first
+        self.initial_qc_prefetch["aggregate"] = self.fetch_by_sample(
+            processids,
+            "project_sample_processes_desc",
+            Process,
+            Process.processid,
+            typeids=statements.typeids(pc_cg.AGRINITQC),
+        )
+        # Fragment Analyzer and Caliper files of the initial QC and of the library preps,
+        # youngest first, the sample name and the input artifact are matched in python
+        self.initial_qc_prefetch["result_files"] = self.fetch_rows_by_sample(
+            "project_result_files",
+            typeids=statements.typeids(pc_cg.FRAGMENT_ANALYZER, pc_cg.CALIPER),
+        )
+
+    @profiling.sample_phase
     def get_initial_qc(self, sample):
         self.obj["samples"][sample.name]["initial_qc"] = {}
         # Get initial artifact for given sample
-        query = "select art.* from artifact art \
-            inner join artifact_sample_map asm on asm.artifactid=art.artifactid \
-            inner join sample sa on sa.processid=asm.processid \
-            where sa.processid = {sapid} and art.isoriginal=True".format(
-            sapid=sample.processid
-        )
         try:
-            initial_artifact = (
-                self.session.query(Artifact).from_statement(text(query)).one()
+            initial_artifacts = self.initial_qc_prefetch["initial_artifact"].get(
+                sample.processid, []
             )
+            if not initial_artifacts:
+                raise NoResultFound()
+            if len(initial_artifacts) > 1:
+                raise MultipleResultsFound(
+                    "Multiple initial artifacts found for sample {}".format(
+                        sample.name
+                    )
+                )
+            initial_artifact = initial_artifacts[0][0]
             self.obj["samples"][sample.name]["initial_plate_id"] = (
                 initial_artifact.containerplacement.container.luid
             )
@@ -910,21 +1225,11 @@ class ProjectSQL:
                 "did not find the initial artifact of sample {}".format(sample.name)
             )
         # get all initial QC processes for sample
-        query = "select pr.* from process pr \
-                inner join processiotracker piot on piot.processid=pr.processid \
-                inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
-                inner join sample sa on sa.processid=asm.processid \
-                where sa.processid = {sapid} and pr.typeid in ({tid}) \
-                order by pr.daterun;".format(
-            sapid=sample.processid,
-            tid=",".join(
-                list(pc_cg.INITALQC.keys()) + list(pc_cg.INITALQCFINISHEDLIB.keys())
-            ),
-        )
         try:
-            oldest_qc = self.session.query(Process).from_statement(text(query)).first()
-            if not oldest_qc:
+            initial_qcs = self.initial_qc_prefetch["initial_qc"].get(sample.processid)
+            if not initial_qcs:
                 return None
+            oldest_qc = initial_qcs[0][0]
             try:
                 self.obj["samples"][sample.name]["initial_qc"]["start_date"] = (
                     oldest_qc.daterun.strftime("%Y-%m-%d")
@@ -940,38 +1245,14 @@ class ProjectSQL:
                     oldest_qc.createddate.strftime("%Y-%m-%d")
                 )
 
-            try:
-                if (
-                    oldest_qc.daterun
-                    and datetime.strptime(self.obj["first_initial_qc"], "%Y-%m-%d")
-                    > oldest_qc.daterun
-                ):
-                    self.obj["first_initial_qc"] = oldest_qc.daterun.strftime(
-                        "%Y-%m-%d"
-                    )
-            except KeyError:
-                try:
-                    self.obj["first_initial_qc"] = oldest_qc.daterun.strftime(
-                        "%Y-%m-%d"
-                    )
-                except AttributeError:
-                    self.obj["first_initial_qc"] = oldest_qc.createddate.strftime(
-                        "%Y-%m-%d"
-                    )
+            self.reduce(
+                self.update_first_initial_qc, oldest_qc.daterun, oldest_qc.createddate
+            )
 
             # get aggregate from init qc for sample
-            query = "select pr.* from process pr \
-                inner join processiotracker piot on piot.processid=pr.processid \
-                inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
-                inner join sample sa on sa.processid=asm.processid \
-                where sa.processid = {sapid} and pr.typeid in ({tid}) \
-                order by pr.daterun desc;".format(
-                sapid=sample.processid, tid=",".join(list(pc_cg.AGRINITQC.keys()))
-            )
             try:
-                youngest_aggregate = (
-                    self.session.query(Process).from_statement(text(query)).first()
-                )
+                aggregates = self.initial_qc_prefetch["aggregate"].get(sample.processid)
+                youngest_aggregate = aggregates[0][0] if aggregates else None
                 try:
                     self.obj["samples"][sample.name]["initial_qc"]["finish_date"] = (
                         youngest_aggregate.daterun.strftime("%Y-%m-%d")
@@ -992,44 +1273,14 @@ class ProjectSQL:
                 "Did not find any initial QC for sample {}".format(sample.name)
             )
         # get GlsFile for output artifact of a Fragment Analyzer process where its input is the initial artifact of a given sample
-        query = "select gf.* from glsfile gf \
-            inner join resultfile rf on rf.glsfileid=gf.fileid \
-            inner join artifact art on rf.artifactid=art.artifactid \
-            inner join outputmapping om on art.artifactid=om.outputartifactid \
-            inner join processiotracker piot on piot.trackerid=om.trackerid \
-            inner join artifact art2 on piot.inputartifactid=art2.artifactid \
-            inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
-            inner join process pr on piot.processid=pr.processid \
-            inner join sample sa on sa.processid=asm.processid \
-            where sa.processid = {sapid} and pr.typeid in ({tid}) and art2.isoriginal=True and art.name like '%Fragment Analyzer%{sname}' \
-            order by pr.daterun desc;".format(
-            sapid=sample.processid,
-            tid=",".join(list(pc_cg.FRAGMENT_ANALYZER.keys())),
-            sname=sample.name,
+        frag_an_file = self.find_result_file(
+            sample, pc_cg.FRAGMENT_ANALYZER, "%Fragment Analyzer%{}".format(sample.name)
         )
-        frag_an_file = self.session.query(GlsFile).from_statement(text(query)).first()
         # Special case for the OmniC Tissue and Lysate QC protocol
         if not frag_an_file:
-            query = "select gf.* from glsfile gf \
-                inner join resultfile rf on rf.glsfileid=gf.fileid \
-                inner join artifact art on rf.artifactid=art.artifactid \
-                inner join outputmapping om on art.artifactid=om.outputartifactid \
-                inner join processiotracker piot on piot.trackerid=om.trackerid \
-                inner join artifact art2 on piot.inputartifactid=art2.artifactid \
-                inner join artifact_sample_map asm on art2.artifactid=asm.artifactid \
-                inner join sample sa on sa.processid=asm.processid \
-                inner join process pr on piot.processid=pr.processid \
-                inner join processtype pt on pt.typeid=pr.typeid \
-                inner join protocolstep ps on ps.processtypeid=pt.typeid \
-                inner join labprotocol lp on lp.protocolid=ps.protocolid \
-                where sa.processid = {sapid} and art.name like '%Fragment Analyzer%{sname}' and pr.typeid in ({tid}) and lp.protocolname='Tissue and Lysate QC' \
-                order by pr.daterun desc;".format(
-                sapid=sample.processid,
-                tid=",".join(list(pc_cg.FRAGMENT_ANALYZER.keys())),
-                sname=sample.name,
-            )
-            frag_an_file = (
-                self.session.query(GlsFile).from_statement(text(query)).first()
+            frag_an_file = self.first_named_like(
+                self.omnic_result_files().get(sample.processid, []),
+                "%Fragment Analyzer%{}".format(sample.name),
             )
         if frag_an_file:
             self.obj["samples"][sample.name]["initial_qc"]["frag_an_image"] = (
@@ -1044,22 +1295,9 @@ class ProjectSQL:
                 )
             )
         # get GlsFile for output artifact of a Caliper process where its input is the initial artifact of a given sample
-        query = "select gf.* from glsfile gf \
-            inner join resultfile rf on rf.glsfileid=gf.fileid \
-            inner join artifact art on rf.artifactid=art.artifactid \
-            inner join outputmapping om on art.artifactid=om.outputartifactid \
-            inner join processiotracker piot on piot.trackerid=om.trackerid \
-            inner join artifact art2 on piot.inputartifactid=art2.artifactid \
-            inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
-            inner join process pr on piot.processid=pr.processid \
-            inner join sample sa on sa.processid=asm.processid \
-            where sa.processid = {sapid} and pr.typeid in ({tid}) and art2.isoriginal=True and art.name like '%CaliperGX%{sname}' \
-            order by pr.daterun desc;".format(
-            sapid=sample.processid,
-            tid=",".join(list(pc_cg.CALIPER.keys())),
-            sname=sample.name,
+        caliper_file = self.find_result_file(
+            sample, pc_cg.CALIPER, "%CaliperGX%{}".format(sample.name)
         )
-        caliper_file = self.session.query(GlsFile).from_statement(text(query)).first()
         if caliper_file:
             self.obj["samples"][sample.name]["initial_qc"]["caliper_image"] = (
                 "sftp://{host}/home/glsftp/{uri}".format(
@@ -1071,35 +1309,64 @@ class ProjectSQL:
                 "Did not find an initial QC Caliper for sample {}".format(sample.name)
             )
 
+    def find_result_file(self, sample, categories, pattern, input_artifact=None):
+        """Returns the youngest prefetched result file of a sample, produced by a process of the given
+        categories and named like pattern. The file has to be generated from input_artifact if it is given,
+        from the original artifact of the sample otherwise.
+        """
+        for row in self.initial_qc_prefetch["result_files"].get(sample.processid, []):
+            if str(row.typeid) not in categories:
+                continue
+            if input_artifact is None and not row.isoriginal:
+                continue
+            if input_artifact is not None and row.inputid != input_artifact:
+                continue
+            if like_match(pattern, row.name):
+                return row
+        return None
+
+    def omnic_result_files(self):
+        """Fragment Analyzer files of the OmniC Tissue and Lysate QC protocol, only fetched
+        the first time a sample has no regular initial QC Fragment Analyzer file.
+        """
+        if "frag_an_omnic" not in self.initial_qc_prefetch:
+            self.initial_qc_prefetch["frag_an_omnic"] = self.fetch_rows_by_sample(
+                "project_omnic_result_files",
+                typeids=statements.typeids(pc_cg.FRAGMENT_ANALYZER),
+                pattern="%Fragment Analyzer%",
+            )
+        return self.initial_qc_prefetch["frag_an_omnic"]
+
+    def first_named_like(self, rows, pattern):
+        """Returns the first of the prefetched rows whose name (last column) matches the LIKE pattern"""
+        for row in rows:
+            if like_match(pattern, row[-1]):
+                return row
+        return None
+
+    @profiling.sample_phase
     def get_library_preps(self, sample):
         # first steps are either SetupWorksetPlate or Library Pooling Finished Libraries
-        query = "select pr.* from process pr \
-                inner join processiotracker piot on piot.processid=pr.processid \
-                inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
-                inner join sample sa on sa.processid=asm.processid \
-                where sa.processid = {sapid} and pr.typeid in ({tid}) \
-                order by pr.daterun;".format(
-            sapid=sample.processid,
-            tid=",".join(
-                list(pc_cg.WORKSET.keys()) + list(pc_cg.PREPSTARTFINLIB.keys())
-            ),
+        lp_starts = statements.fetch_all(
+            self.session,
+            Process,
+            "sample_processes",
+            sampleid=sample.processid,
+            typeids=statements.typeids(pc_cg.WORKSET, pc_cg.PREPSTARTFINLIB),
         )  # Applications Generic Process
-        lp_starts = self.session.query(Process).from_statement(text(query)).all()
         prepid = 64
         for one_libprep in lp_starts:
             if "library_prep" not in self.obj["samples"][sample.name]:
                 self.obj["samples"][sample.name]["library_prep"] = {}
 
             # get all the output  artifacts of the libprep that match our sample
-            query = "select art.* from artifact art \
-            inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
-            inner join outputmapping om  on om.outputartifactid=art.artifactid \
-            inner join processiotracker piot on piot.trackerid=om.trackerid \
-            inner join sample sa on sa.processid=asm.processid \
-            where sa.processid = {sapid} and piot.processid = {libid} and art.artifacttypeid = 2".format(
-                sapid=sample.processid, libid=one_libprep.processid
+            lp_out_arts = statements.fetch_all(
+                self.session,
+                Artifact,
+                "sample_process_outputs",
+                sampleid=sample.processid,
+                processid=one_libprep.processid,
             )
-            lp_out_arts = self.session.query(Artifact).from_statement(text(query)).all()
             for one_libprep_art in lp_out_arts:
                 prepid += 1
                 prepname = chr(prepid)
@@ -1116,15 +1383,14 @@ class ProjectSQL:
                 ] = one_libprep.luid
 
                 if str(one_libprep.typeid) in pc_cg.PREPSTARTFINLIB:
-                    self.obj["isFinishedLib"] = True
+                    self.reduce(self.update_finished_lib)
 
                 # get a list of all libprep start steps
                 try:
-                    libp = get_children_processes(
-                        self.session,
+                    libp = self.lineage.children(
                         one_libprep.processid,
                         pc_cg.PREPSTART,
-                        sample=sample.processid,
+                        sample.processid,
                     )
                     older = libp[0]
                     for l in libp:
@@ -1176,11 +1442,10 @@ class ProjectSQL:
                         self.obj["samples"][sample.name]["library_prep"][prepname][
                             "prep_start_date"
                         ] = one_libprep.daterun.strftime("%Y-%m-%d")
-                pend = get_children_processes(
-                    self.session,
+                pend = self.lineage.children(
                     one_libprep.processid,
                     pc_cg.PREPEND,
-                    sample=sample.processid,
+                    sample.processid,
                 )
                 try:
                     recent = pend[0]
@@ -1203,8 +1468,7 @@ class ProjectSQL:
                     )
 
                 try:
-                    agrlibvals = get_children_processes(
-                        self.session,
+                    agrlibvals = self.lineage.children(
                         one_libprep.processid,
                         list(pc_cg.AGRLIBVAL.keys()),
                         sample.processid,
@@ -1215,18 +1479,13 @@ class ProjectSQL:
                         # for small rna (and maybe others), there is more than one agrlibval, and I should not get the latest one,
                         # but the latest one that ran at sample level, not a pool level.
                         # get input artifact of a given process that belongs to sample
-                        query = "select art.* from artifact art \
-                            inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
-                            inner join processiotracker piot on piot.inputartifactid=art.artifactid \
-                            inner join sample sa on sa.processid=asm.processid \
-                            where sa.processid = {sapid} and piot.processid = {agrid}".format(
-                            sapid=sample.processid, agrid=agrlv.processid
-                        )
                         try:
-                            inp_artifact = (
-                                self.session.query(Artifact)
-                                .from_statement(text(query))
-                                .first()
+                            inp_artifact = statements.fetch_first(
+                                self.session,
+                                Artifact,
+                                "sample_process_inputs",
+                                sampleid=sample.processid,
+                                processid=agrlv.processid,
                             )
 
                             # Only skip the TruSeq small RNA protocol because we want the QC results of individual sample, not library pool
@@ -1254,17 +1513,17 @@ class ProjectSQL:
                     # try and get seqruns for this library, this should work for most of the cases
                     # but not entirely sure if it would work for edgy cases
                     try:
-                        query = "select distinct pro.* from process pro \
-                                 inner join processiotracker piot on piot.processid = pro.processid \
-                                 inner join artifact_ancestor_map aam on piot.inputartifactid = aam.artifactid \
-                                 where pro.typeid in ({seq_step_id}) and aam.ancestorartifactid = {lib_art}".format(
-                            seq_step_id=",".join(pc_cg.SEQUENCING.keys()),
-                            lib_art=inp_artifact.artifactid,
+                        consuming, consumer_params = statements.descending(
+                            "distinct_processes_using_descendants",
+                            inp_artifact.artifactid,
+                            self.ancestor_index,
                         )
-                        seq_fcs = (
-                            self.session.query(Process)
-                            .from_statement(text(query))
-                            .all()
+                        seq_fcs = statements.fetch_all(
+                            self.session,
+                            Process,
+                            consuming,
+                            typeids=statements.typeids(pc_cg.SEQUENCING),
+                            **consumer_params,
                         )
                         for seq in seq_fcs:
                             seq_fc_id = seq.udf_dict.get("Run ID")
@@ -1294,17 +1553,12 @@ class ProjectSQL:
                         in self.obj["details"]["library_construction_method"].lower()
                     ):
                         # Get initial artifact for given sample
-                        query = "select art.* from artifact art \
-                            inner join artifact_sample_map asm on asm.artifactid=art.artifactid \
-                            inner join sample sa on sa.processid=asm.processid \
-                            where sa.processid = {sapid} and art.isoriginal=True".format(
-                            sapid=sample.processid
-                        )
                         try:
-                            initial_artifact = (
-                                self.session.query(Artifact)
-                                .from_statement(text(query))
-                                .one()
+                            initial_artifact = statements.fetch_one(
+                                self.session,
+                                Artifact,
+                                "sample_original_artifact",
+                                sampleid=sample.processid,
                             )
                             self.obj["samples"][sample.name]["library_prep"][prepname][
                                 "reagent_label"
@@ -1335,32 +1589,31 @@ class ProjectSQL:
                         "initials"
                     ] = agrlibval.technician.researcher.initials
                     # get input artifact of a given process that belongs to sample and descends from one_lp_art
-                    query = "select art.* from artifact art \
-                        inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
-                        inner join processiotracker piot on piot.inputartifactid=art.artifactid \
-                        inner join sample sa on sa.processid=asm.processid \
-                        inner join artifact_ancestor_map aam on art.artifactid=aam.artifactid \
-                        where sa.processid = {sapid} \
-                        and piot.processid = {agrid} \
-                        and aam.ancestorartifactid={lp_art}".format(
-                        sapid=sample.processid,
-                        agrid=agrlibval.processid,
-                        lp_art=one_libprep_art.artifactid,
+                    descending, descendant_params = statements.descending(
+                        "sample_process_inputs_descending",
+                        one_libprep_art.artifactid,
+                        self.ancestor_index,
                     )
                     try:
                         try:
-                            inp_artifact = (
-                                self.session.query(Artifact)
-                                .from_statement(text(query))
-                                .one()
+                            inp_artifact = statements.fetch_one(
+                                self.session,
+                                Artifact,
+                                descending,
+                                sampleid=sample.processid,
+                                processid=agrlibval.processid,
+                                **descendant_params,
                             )
                         except MultipleResultsFound:
                             # this might happen when samples have been requeued and end up in the same aggragate QC as the originals.
                             # Select the artifact that has been routed to the next step. If there is more than one, take the most recent one.
-                            artifacts = (
-                                self.session.query(Artifact)
-                                .from_statement(text(query))
-                                .all()
+                            artifacts = statements.fetch_all(
+                                self.session,
+                                Artifact,
+                                descending,
+                                sampleid=sample.processid,
+                                processid=agrlibval.processid,
+                                **descendant_params,
                             )
                             inp_artifact = None
                             date_routed = None
@@ -1382,17 +1635,12 @@ class ProjectSQL:
                                 continue
                         except NoResultFound:
                             # for the case of finished Libraries
-                            query = "select art.* from artifact art \
-                                inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
-                                inner join processiotracker piot on piot.inputartifactid=art.artifactid \
-                                inner join sample sa on sa.processid=asm.processid \
-                                where sa.processid = {sapid} and piot.processid = {agrid}".format(
-                                sapid=sample.processid, agrid=agrlv.processid
-                            )
-                            inp_artifact = (
-                                self.session.query(Artifact)
-                                .from_statement(text(query))
-                                .first()
+                            inp_artifact = statements.fetch_first(
+                                self.session,
+                                Artifact,
+                                "sample_process_inputs",
+                                sampleid=sample.processid,
+                                processid=agrlv.processid,
                             )
 
                         self.obj["samples"][sample.name]["library_prep"][prepname][
@@ -1456,17 +1704,12 @@ class ProjectSQL:
                                         iaa.reagentlabels[0].name
                                     )
                         # get libval steps from the same input art
-                        query = "select pr.* from process pr \
-                            inner join processiotracker piot on piot.processid=pr.processid \
-                            where pr.typeid in ({dem}) and piot.inputartifactid={iaid} \
-                            order by pr.daterun;".format(
-                            dem=",".join(list(pc_cg.LIBVAL.keys())),
-                            iaid=inp_artifact.artifactid,
-                        )
-                        libvals = (
-                            self.session.query(Process)
-                            .from_statement(text(query))
-                            .all()
+                        libvals = statements.fetch_all(
+                            self.session,
+                            Process,
+                            "processes_using_artifact",
+                            typeids=statements.typeids(pc_cg.LIBVAL),
+                            artifactid=inp_artifact.artifactid,
                         )
                         try:
                             self.obj["samples"][sample.name]["library_prep"][prepname][
@@ -1493,26 +1736,11 @@ class ProjectSQL:
                                     "start_date"
                                 ] = agrlibval.createddate.strftime("%Y-%m-%d")
                         # get GlsFile for output artifact of a Fragment Analyzer process where its input is the initial artifact of a given sample
-                        query = "select gf.* from glsfile gf \
-                            inner join resultfile rf on rf.glsfileid=gf.fileid \
-                            inner join artifact art on rf.artifactid=art.artifactid \
-                            inner join outputmapping om on art.artifactid=om.outputartifactid \
-                            inner join processiotracker piot on piot.trackerid=om.trackerid \
-                            inner join artifact art2 on piot.inputartifactid=art2.artifactid \
-                            inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
-                            inner join process pr on piot.processid=pr.processid \
-                            inner join sample sa on sa.processid=asm.processid \
-                            where sa.processid = {sapid} and pr.typeid in ({tid}) and art2.artifactid={inpid} and art.name like '%Fragment Analyzer%{sname}' \
-                            order by pr.daterun desc;".format(
-                            sapid=sample.processid,
-                            tid=",".join(list(pc_cg.FRAGMENT_ANALYZER.keys())),
-                            inpid=inp_artifact.artifactid,
-                            sname=sample.name,
-                        )
-                        frag_an_file = (
-                            self.session.query(GlsFile)
-                            .from_statement(text(query))
-                            .first()
+                        frag_an_file = self.find_result_file(
+                            sample,
+                            pc_cg.FRAGMENT_ANALYZER,
+                            "%Fragment Analyzer%{}".format(sample.name),
+                            inp_artifact.artifactid,
                         )
                         if frag_an_file:
                             self.obj["samples"][sample.name]["library_prep"][prepname][
@@ -1529,16 +1757,12 @@ class ProjectSQL:
                                 )
                             )
                         # Get Ratio(%) from Fragment Analyzer QC
-                        query = "select art.* from artifact art \
-                            inner join artifact_sample_map asm on art.artifactid=asm.artifactid \
-                            inner join sample sa on sa.processid=asm.processid \
-                            where sa.processid={sapid} and art.name like 'Fragment Analyzer%{sname}';".format(
-                            sapid=sample.processid, sname=sample.name
-                        )
-                        frag_an_artifact = (
-                            self.session.query(Artifact)
-                            .from_statement(text(query))
-                            .all()
+                        frag_an_artifact = statements.fetch_all(
+                            self.session,
+                            Artifact,
+                            "sample_artifacts_named",
+                            sampleid=sample.processid,
+                            pattern="Fragment Analyzer%{}".format(sample.name),
                         )
                         if frag_an_artifact:
                             frag_an_ratio = frag_an_artifact[0].udf_dict.get(
@@ -1551,27 +1775,12 @@ class ProjectSQL:
                                     "frag_an_ratio"
                                 ] = frag_an_ratio
                         # get GlsFile for output artifact of a Caliper process where its input is given
-                        query = "select gf.* from glsfile gf \
-                            inner join resultfile rf on rf.glsfileid=gf.fileid \
-                            inner join artifact art on rf.artifactid=art.artifactid \
-                            inner join outputmapping om on art.artifactid=om.outputartifactid \
-                            inner join processiotracker piot on piot.trackerid=om.trackerid \
-                            inner join artifact art2 on piot.inputartifactid=art2.artifactid \
-                            inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
-                            inner join process pr on piot.processid=pr.processid \
-                            inner join sample sa on sa.processid=asm.processid \
-                            where sa.processid = {sapid} and pr.typeid in ({tid}) and art2.artifactid={inpid} and art.name like '%CaliperGX%{sname}' \
-                            order by pr.daterun desc;".format(
-                            sapid=sample.processid,
-                            inpid=inp_artifact.artifactid,
-                            tid=",".join(list(pc_cg.CALIPER.keys())),
-                            sname=sample.name,
-                        )
                         try:
-                            caliper_file = (
-                                self.session.query(GlsFile)
-                                .from_statement(text(query))
-                                .first()
+                            caliper_file = self.find_result_file(
+                                sample,
+                                pc_cg.CALIPER,
+                                "%CaliperGX%{}".format(sample.name),
+                                inp_artifact.artifactid,
                             )
                             self.obj["samples"][sample.name]["library_prep"][prepname][
                                 "library_validation"
@@ -1604,26 +1813,15 @@ class ProjectSQL:
                                 pass
 
                             # get output resultfile named like the sample of a Neoprep QC
-                            query = "select art.* from artifact art \
-                                inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
-                                inner join outputmapping om on art.artifactid=om.outputartifactid \
-                                inner join processiotracker piot on piot.trackerid=om.trackerid \
-                                inner join sample sa on sa.processid=asm.processid \
-                                where art.artifacttypeid = 1 \
-                                and art.name like '%{saname}%' \
-                                and sa.processid = {sapid}\
-                                and piot.processid = {agrid} \
-                                and piot.inputartifactid = {inpid}".format(
-                                saname=sample.name,
-                                sapid=sample.processid,
-                                agrid=agrlibval.processid,
-                                inpid=inp_artifact.artifactid,
-                            )
                             try:
-                                out_art = (
-                                    self.session.query(Artifact)
-                                    .from_statement(text(query))
-                                    .one()
+                                out_art = statements.fetch_one(
+                                    self.session,
+                                    Artifact,
+                                    "sample_result_outputs_named",
+                                    pattern="%{}%".format(sample.name),
+                                    sampleid=sample.processid,
+                                    processid=agrlibval.processid,
+                                    inputid=inp_artifact.artifactid,
                                 )
                                 self.obj["samples"][sample.name]["library_prep"][
                                     prepname
@@ -1674,23 +1872,15 @@ class ProjectSQL:
                 # and sa.processid = {sapid} \
                 # and piot.processid = {agrid} \
                 # and aam.ancestorartifactid = {libartid}".format(sapid=sample.processid, agrid=one_libprep.processid, libartid=one_libprep_art.artifactid)
-                query = "select art.* from artifact art \
-                    inner join artifact_sample_map asm on art.artifactid=asm.artifactid \
-                    inner join outputmapping om on om.outputartifactid=art.artifactid \
-                    inner join processiotracker piot on piot.trackerid=om.trackerid \
-                    inner join sample sa on sa.processid=asm.processid \
-                    where sa.processid = {sapid} \
-                    and piot.processid = {libid} \
-                    and art.artifacttypeid = 2".format(
-                    sapid=sample.processid, libid=one_libprep.processid
-                )
                 try:
                     # out_artifact = self.session.query(Artifact).from_statement(text(query)).one() This is with the old query from Denis
-                    out_artifact = (
-                        self.session.query(Artifact)
-                        .from_statement(text(query))
-                        .all()[0]
-                    )
+                    out_artifact = statements.fetch_all(
+                        self.session,
+                        Artifact,
+                        "sample_process_outputs",
+                        sampleid=sample.processid,
+                        processid=one_libprep.processid,
+                    )[0]
                     self.obj["samples"][sample.name]["library_prep"][prepname][
                         "workset_name"
                     ] = out_artifact.containerplacement.container.name
@@ -1714,18 +1904,13 @@ class ProjectSQL:
                         )
                     )
                 # preprep
-                query = "select pr.* from process pr \
-                    inner join processiotracker piot on piot.processid=pr.processid \
-                    inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
-                    inner join sample sa on sa.processid=asm.processid \
-                    where sa.processid = {sapid} and pr.typeid in ({tid}) \
-                    order by pr.daterun;".format(
-                    sapid=sample.processid,
-                    tid=",".join(list(pc_cg.PREPREPSTART.keys())),
-                )
                 try:
-                    preprep = (
-                        self.session.query(Process).from_statement(text(query)).first()
+                    preprep = statements.fetch_first(
+                        self.session,
+                        Process,
+                        "sample_processes",
+                        sampleid=sample.processid,
+                        typeids=statements.typeids(pc_cg.PREPREPSTART),
                     )
                     self.obj["samples"][sample.name]["library_prep"][prepname][
                         "pre_prep_start_date"
@@ -1747,11 +1932,10 @@ class ProjectSQL:
                     )
 
                 # get seqruns
-                seqs = get_children_processes(
-                    self.session,
+                seqs = self.lineage.children(
                     one_libprep.processid,
                     list(pc_cg.SEQUENCING.keys()),
-                    sample=sample.processid,
+                    sample.processid,
                 )
                 for seq in seqs:
                     if (
@@ -1763,33 +1947,29 @@ class ProjectSQL:
                         self.obj["samples"][sample.name]["library_prep"][prepname][
                             "sample_run_metrics"
                         ] = {}
-                    seqstarts = get_processes_in_history(
-                        self.session,
+                    seqstarts = self.lineage.history(
                         seq.processid,
                         list(pc_cg.SEQSTART.keys()),
-                        sample=sample.processid,
+                        sample.processid,
                     )
-                    dilstarts = get_processes_in_history(
-                        self.session,
+                    dilstarts = self.lineage.history(
                         seq.processid,
                         list(pc_cg.DILSTART.keys()),
-                        sample=sample.processid,
+                        sample.processid,
                     )
                     # get all the input artifacts of the seqrun that match our sample and our libprep
-                    query = "select art.* from artifact art \
-                    inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
-                    inner join processiotracker piot on piot.inputartifactid=art.artifactid \
-                    inner join sample sa on sa.processid=asm.processid \
-                    inner join artifact_ancestor_map aam on aam.artifactid=art.artifactid \
-                    where sa.processid = {sapid} \
-                    and piot.processid = {seqid} \
-                    and aam.ancestorartifactid = {libpartid}".format(
-                        sapid=sample.processid,
-                        seqid=seq.processid,
-                        libpartid=one_libprep_art.artifactid,
+                    descending, descendant_params = statements.descending(
+                        "sample_process_inputs_descending",
+                        one_libprep_art.artifactid,
+                        self.ancestor_index,
                     )
-                    inp_arts = (
-                        self.session.query(Artifact).from_statement(text(query)).all()
+                    inp_arts = statements.fetch_all(
+                        self.session,
+                        Artifact,
+                        descending,
+                        sampleid=sample.processid,
+                        processid=seq.processid,
+                        **descendant_params,
                     )
                     for art in inp_arts:
                         # 2559 is ONT
@@ -1799,8 +1979,9 @@ class ProjectSQL:
                                 lane = art.containerplacement.api_string.split(":")[1]
                             else:
                                 lane = art.containerplacement.api_string.split(":")[0]
-                            self.obj["sequencing_finished"] = seq.udf_dict.get(
-                                "Finish Date"
+                            self.reduce(
+                                self.update_sequencing_finished,
+                                seq.udf_dict.get("Finish Date"),
                             )
                             try:
                                 run_id = seq.udf_dict["Run ID"]
@@ -1861,17 +2042,15 @@ class ProjectSQL:
                                         )
                                     )
                                 # get the associated demultiplexing step
-                                query = "select pr.* from process pr \
-                                        inner join processiotracker piot on piot.processid=pr.processid \
-                                        where pr.typeid={dem} and piot.inputartifactid={iaid};".format(
-                                    dem=list(pc_cg.DEMULTIPLEX.keys())[0],
-                                    iaid=art.artifactid,
-                                )
                                 try:
-                                    dem = (
-                                        self.session.query(Process)
-                                        .from_statement(text(query))
-                                        .one()
+                                    dem = statements.fetch_one(
+                                        self.session,
+                                        Process,
+                                        "processes_using_artifact",
+                                        typeids=statements.typeids(
+                                            list(pc_cg.DEMULTIPLEX.keys())[:1]
+                                        ),
+                                        artifactid=art.artifactid,
                                     )
                                     try:
                                         self.obj["samples"][sample.name][
@@ -1885,26 +2064,19 @@ class ProjectSQL:
                                         pass
 
                                     # get output resultfile named like the sample of a Demultiplex step
-                                    query = "select art.* from artifact art \
-                                        inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
-                                        inner join outputmapping om on art.artifactid=om.outputartifactid \
-                                        inner join processiotracker piot on piot.trackerid=om.trackerid \
-                                        inner join sample sa on sa.processid=asm.processid \
-                                        inner join artifact_ancestor_map aam on art.artifactid= aam.artifactid \
-                                        where art.artifacttypeid = 1 \
-                                        and art.name like '%{saname}%' \
-                                        and sa.processid = {sapid} \
-                                        and piot.processid = {dem}\
-                                        and aam.ancestorartifactid = {artid};".format(
-                                        saname=sample.name,
-                                        sapid=sample.processid,
-                                        dem=dem.processid,
-                                        artid=art.artifactid,
+                                    demux, demux_params = statements.descending(
+                                        "sample_result_outputs_named_descending",
+                                        art.artifactid,
+                                        self.ancestor_index,
                                     )
-                                    out_arts = (
-                                        self.session.query(Artifact)
-                                        .from_statement(text(query))
-                                        .all()
+                                    out_arts = statements.fetch_all(
+                                        self.session,
+                                        Artifact,
+                                        demux,
+                                        pattern="%{}%".format(sample.name),
+                                        sampleid=sample.processid,
+                                        processid=dem.processid,
+                                        **demux_params,
                                     )
                                     cumulated_flag = "FAILED"
                                     for art in out_arts:
@@ -1961,38 +2133,9 @@ class ProjectSQL:
                             ] = f"{date[:4]}-{date[4:6]}-{date[6:]}"
 
     def extract_barcode(self, chain):
-        barcode = ""
-        bcp = re.compile("[ATCG\-\_]{4,}")
-        TENX_SINGLE_PAT = re.compile("SI-(?:GA|NA)-[A-H][1-9][0-2]?")
-        TENX_DUAL_PAT = re.compile("SI-(?:TT|NT|NN|TN|TS)-[A-H][1-9][0-2]?")
-        SMARTSEQ_PAT = re.compile("SMARTSEQ[1-9]?-[1-9][0-9]?[A-P]")
-        if "NoIndex" in chain:
-            return chain
-        if (
-            TENX_SINGLE_PAT.match(chain)
-            or TENX_DUAL_PAT.match(chain)
-            or SMARTSEQ_PAT.match(chain)
-        ):
-            return chain
-        if "(" not in chain:
-            barcode = chain
-        else:
-            pattern = re.compile("\(([A-Z\-\_]+)\)")
-            matches = pattern.search(chain)
-            if matches.group(1):
-                barcode = matches.group(1).replace("_", "-")
-        matches = bcp.match(barcode)
-        if not matches:
-            meta = (
-                self.session.query(ReagentType.meta_data)
-                .filter(ReagentType.name.like("%{}%".format(barcode)))
-                .scalar()
-            )
-            matches = bcp.search(meta)
-            if matches:
-                barcode = matches.group(0).replace("_", "-")
-        return barcode
+        return barcode_resolver(self.session).extract(chain, underscores=True)
 
+    @profiling.phase
     def set_status(self):
         proj_details = self.obj.get("details")
         status_fields = {}
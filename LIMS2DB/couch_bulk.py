@@ -0,0 +1,609 @@
+"""Saving of the project documents, one at a time or in _bulk_docs batches"""
+
+import hashlib
+import json
+from collections import ChainMap
+from datetime import datetime
+
+from LIMS2DB.diff import MISSING, DiffEngine
+from LIMS2DB.utils import send_mail
+
+GENSTAT_PROJ_URL = "https://genomics-status.scilifelab.se/project/"
+
+# fields of the couch document that are not built from the LIMS
+FIELDS_SAVED = [
+    "_id",
+    "_rev",
+    "modification_time",
+    "creation_time",
+    "staged_files",
+    "agreement_doc_id",
+    "invoice_spec_generated",
+    "invoice_spec_downloaded",
+    "delivery_projects",
+]
+DETAILS_SAVED = ["running_notes", "snic_checked", "latest_sticky_note"]
+HASH_FIELD = "lims_hash"
+# state of the build kept in the couch document for the next incremental build, not built from the LIMS
+BUILD_STATE_FIELD = "lims2db_build_state"
+
+PROJECT_DIFF = DiffEngine(
+    ignore=[(BUILD_STATE_FIELD,), (HASH_FIELD,)],
+    remove_first=[(field,) for field in FIELDS_SAVED]
+    + [("details", field) for field in DETAILS_SAVED],
+)
+
+# exact changes of a document, the revision is the one of the couch document
+DELTA_DIFF = DiffEngine(ignore=[("_id",), ("_rev",)], strict=True)
+DELTA_HANDLER = "lims2db/apply_delta"
+
+
+SAMPLES_DB = "project_samples"
+# names of the samples of a project document whose samples are split
+SAMPLES_FIELD = "sample_documents"
+
+
+def content_hash(obj):
+    """sha1 of the canonical JSON of a built document, without its hash field"""
+    canonical = json.dumps(
+        {key: value for key, value in obj.items() if key != HASH_FIELD},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def set_content_hash(obj):
+    """Sets the hash of a built document about to be saved, unless it has one, and returns it"""
+    if HASH_FIELD not in obj:
+        obj[HASH_FIELD] = content_hash(obj)
+    return obj[HASH_FIELD]
+
+
+def prepare_project_doc(obj, doc, log, update_modification_time=True, build_state=None):
+    """Completes a built project document with the fields kept from the one in couch.
+    :param dict obj: built document, updated in place, its lims_hash is set
+    :param doc: current couch document of the project, or None
+    :param log: logger
+    :param bool update_modification_time: set the modification time of a changed document to now
+    :param dict build_state: state of the build saved with a changed document, see ProjectSQL.build_state
+    :returns: (whether obj has to be saved, diffs with doc, None for a new document)
+    """
+    lims_hash = set_content_hash(obj)
+    if not doc:
+        obj["creation_time"] = datetime.now().isoformat()
+        obj["modification_time"] = obj["creation_time"]
+        if build_state:
+            obj[BUILD_STATE_FIELD] = build_state
+        return True, None
+
+    if doc.get(HASH_FIELD) == lims_hash:
+        log.info("No modifications found for project {}".format(obj["project_id"]))
+        return False, {}
+
+    diffs = PROJECT_DIFF.diffs(doc, obj)
+    if not diffs:
+        log.info("No modifications found for project {}".format(obj["project_id"]))
+        return False, diffs
+
+    for field in FIELDS_SAVED:
+        if update_modification_time and field == "modification_time":
+            obj[field] = datetime.now().isoformat()
+            continue
+        if doc.get(field):
+            obj[field] = doc[field]
+
+    for field in DETAILS_SAVED:
+        if doc["details"].get(field):
+            obj["details"][field] = doc["details"][field]
+    if build_state:
+        obj[BUILD_STATE_FIELD] = build_state
+
+    # Don't overwrite order portal details if have not been able to fetch them this round
+    if obj["order_details"] == {} and doc["order_details"] != {}:
+        log.warn(
+            "Preventing order details to be overwritten since no details were fetched from order portal this round"
+        )
+        obj["order_details"] = doc["order_details"]
+    return True, diffs
+
+
+def project_delta(doc, obj):
+    """Changes turning a couch document into obj, for the apply_delta update handler
+    :returns: list of {"path": keys, "value": new value}, without value for a removed key
+    """
+    delta = []
+    for path, _, value in DELTA_DIFF.iter_diffs(doc, obj):
+        change = {"path": list(path)}
+        if value is not MISSING:
+            change["value"] = value
+        delta.append(change)
+    return delta
+
+
+def sends_delta(obj, doc, delta_min_size):
+    """Whether obj is saved as a delta of the couch document doc
+    :param int delta_min_size: size in bytes of the JSON of the documents sent as a delta, None for none
+    """
+    if not doc or delta_min_size is None:
+        return False
+    return len(json.dumps(obj, default=str)) >= delta_min_size
+
+
+def save_delta(db, obj, doc):
+    """Saves obj by sending its changes from doc to the apply_delta update handler
+    :param db: projects database, with the design document couch_views.PROJECTS_DESIGN_DOC
+    :param dict obj: document completed by prepare_project_doc, its _rev is updated
+    :param dict doc: couch document obj was prepared from
+    :returns: number of changes sent
+    """
+    delta = project_delta(doc, obj)
+    if not delta:
+        return 0
+    headers, response = db.update_doc(
+        DELTA_HANDLER,
+        doc["_id"],
+        body=json.dumps({"_rev": doc["_rev"], "delta": delta}, default=str),
+        headers={"Content-Type": "application/json"},
+    )
+    response.close()
+    obj["_rev"] = headers["X-Couch-Update-NewRev"]
+    return len(delta)
+
+
+def save_project_doc(db, obj, doc, log, delta_min_size=None):
+    """Saves a document completed by prepare_project_doc, as a delta if it is large
+    :param db: projects database
+    :param dict obj: document to save
+    :param doc: current couch document, or None
+    :param log: logger
+    :param int delta_min_size: size in bytes of the JSON of the documents sent as a delta, None for none
+    :returns: whether the document was sent as a delta
+    """
+    if sends_delta(obj, doc, delta_min_size):
+        changes = save_delta(db, obj, doc)
+        log.info(
+            "Saved {} changes of the document of project {}".format(
+                changes, obj["project_id"]
+            )
+        )
+        return True
+    db.save(obj)
+    return False
+
+
+def notify_project_saved(obj, diffs, genstat_proj_url=GENSTAT_PROJ_URL):
+    """Mails about the new applications projects and their contract updates
+    :param dict obj: saved document
+    :param diffs: diffs with the previous document, None for a new document
+    """
+    if obj.get("details", {}).get("type", "") != "Application":
+        return
+    genstat_url = f'{genstat_proj_url}{obj["project_id"]}'
+    lib_method_text = (
+        f"Library method: {obj['details'].get('library_construction_method', 'N/A')}"
+    )
+    if diffs is None:
+        msg = "New applications project created "
+        msg += f'<a href="{genstat_url}">{obj["project_id"]}, {obj["project_name"]}</a>[{lib_method_text}].'
+        send_mail(
+            f'GA Project created {obj["project_name"]}',
+            msg,
+            "ngi_ga_projects@scilifelab.se",
+        )
+        return
+    if "key  details contract_received" not in diffs:
+        return
+    application = obj.get("details", {}).get("application", "")
+    is_single_cell = application == "RNA-seq (single cell)"
+    single_cell_text = f"[Application: {application}]" if is_single_cell else ""
+    if diffs["key  details contract_received"][1] == "missing":
+        old_contract_received = diffs["key  details contract_received"][0]
+        msg = f"Contract received on {old_contract_received} deleted for applications project "
+        msg += f'<a href="{genstat_url}">{obj["project_id"]}, {obj["project_name"]}</a>[{lib_method_text}]\
+                            { single_cell_text }.'
+    else:
+        contract_received = diffs["key  details contract_received"][1]
+        msg = "Contract received for applications project "
+        msg += f'<a href="{genstat_url}">{obj["project_id"]}, {obj["project_name"]}</a>[{lib_method_text}]\
+                            { single_cell_text } on {contract_received}.'
+
+    if is_single_cell:
+        send_mail(
+            f'Contract updated for single cell Project {obj["project_name"]}',
+            msg,
+            "ngi_singlecell_projects@scilifelab.se",
+        )
+    else:
+        send_mail(
+            f'Contract updated for GA Project {obj["project_name"]}',
+            msg,
+            "ngi_ga_projects@scilifelab.se",
+        )
+
+
+def fetch_project_doc_ids(db, view="project/project_id", batch=10000):
+    """Ids of the documents of all the projects, read in batches
+    :param db: projects database
+    :param str view: view emitting the project luids
+    :returns: dict of the document ids by project luid
+    """
+    return {row.key: row.id for row in db.iterview(view, batch)}
+
+
+def fetch_project_hashes(db, pids):
+    """Stored content hashes of projects, with one request
+    :param db: projects database, with the design document couch_views.PROJECTS_DESIGN_DOC
+    :param pids: project luids
+    :returns: dict of the (document id, hash) by project luid, without the projects that have no document
+    """
+    return {
+        row.key: (row.id, row.value)
+        for row in db.view("lims2db/project_hash", keys=list(pids))
+    }
+
+
+def fetch_project_docs(db, pids, doc_ids=None):
+    """Current couch documents of projects, with two requests, one if all their ids are known
+    :param db: projects database
+    :param pids: project luids
+    :param dict doc_ids: known document ids by project luid, see fetch_project_doc_ids
+    :returns: dict of the documents by project luid, without the projects that have none
+    """
+    known = doc_ids or {}
+    doc_ids = {pid: known[pid] for pid in pids if pid in known}
+    unknown = [pid for pid in pids if pid not in known]
+    if unknown:
+        for row in db.view("project/project_id", keys=unknown):
+            doc_ids[row.key] = row.id
+    if not doc_ids:
+        return {}
+    docs = {}
+    for row in db.view("_all_docs", keys=list(doc_ids.values()), include_docs=True):
+        if row.doc:
+            docs[row.id] = row.doc
+    return {pid: docs[doc_id] for pid, doc_id in doc_ids.items() if doc_id in docs}
+
+
+def sample_doc_id(pid, sample_id):
+    return "{}:{}".format(pid, sample_id)
+
+
+def split_project_doc(obj):
+    """Project document without samples and the documents of its samples
+    :param dict obj: built project document
+    :returns: (project document, list of sample documents), the hash of the project document covers
+        the hashes of its samples
+    """
+    header = {key: value for key, value in obj.items() if key != "samples"}
+    samples = obj.get("samples", {})
+    header[SAMPLES_FIELD] = list(samples)
+    sample_docs = []
+    for sample_id, sample in samples.items():
+        sample_doc = {
+            "_id": sample_doc_id(obj["project_id"], sample_id),
+            "entity_type": "project_sample",
+            "project_id": obj["project_id"],
+            "sample_id": sample_id,
+            "sample": sample,
+        }
+        sample_doc[HASH_FIELD] = content_hash(sample_doc)
+        sample_docs.append(sample_doc)
+    header[HASH_FIELD] = content_hash(
+        dict(header, samples=[sample_doc[HASH_FIELD] for sample_doc in sample_docs])
+    )
+    return header, sample_docs
+
+
+def save_sample_docs(db, pid, sample_docs, log, batch_size=500):
+    """Writes the changed sample documents of a project and deletes the ones of its removed samples
+    :param db: project_samples database, with the design document couch_views.SAMPLES_DESIGN_DOC
+    :param str pid: project luid
+    :param list sample_docs: documents of the samples of the project, see split_project_doc
+    :param log: logger
+    :param int batch_size: number of documents per _bulk_docs request
+    :returns: number of documents written
+    """
+    stored = {row.id: row.value for row in db.view("lims2db/sample_hash", key=pid)}
+    to_save = []
+    for sample_doc in sample_docs:
+        rev, stored_hash = stored.pop(sample_doc["_id"], (None, None))
+        if stored_hash == sample_doc[HASH_FIELD]:
+            continue
+        if rev:
+            sample_doc["_rev"] = rev
+        to_save.append(sample_doc)
+    to_save.extend(
+        {"_id": doc_id, "_rev": rev, "_deleted": True}
+        for doc_id, (rev, _) in stored.items()
+    )
+    failed = []
+    for start in range(0, len(to_save), batch_size):
+        for success, doc_id, rev_or_exc in db.update(
+            to_save[start : start + batch_size]
+        ):
+            if not success:
+                failed.append(doc_id)
+                log.error(
+                    "Could not save the sample document {}: {!r}".format(
+                        doc_id, rev_or_exc
+                    )
+                )
+    if failed:
+        raise RuntimeError(
+            "{} sample documents of project {} not saved".format(len(failed), pid)
+        )
+    log.info(
+        "Saved {} of the {} sample documents of project {}, deleted {}".format(
+            len(to_save) - len(stored), len(sample_docs), pid, len(stored)
+        )
+    )
+    return len(to_save)
+
+
+def assemble_project_doc(header, db):
+    """Project document with its samples, from a project document whose samples are split
+    :param dict header: project document, returned as is if its samples are not split
+    :param db: project_samples database, with the design document couch_views.SAMPLES_DESIGN_DOC
+    :raises RuntimeError: if documents of samples of the project are missing
+    """
+    if SAMPLES_FIELD not in header:
+        return header
+    samples = {
+        row.doc["sample_id"]: row.doc["sample"]
+        for row in db.view(
+            "lims2db/sample_hash", key=header["project_id"], include_docs=True
+        )
+    }
+    missing = [
+        sample_id for sample_id in header[SAMPLES_FIELD] if sample_id not in samples
+    ]
+    if missing:
+        raise RuntimeError(
+            "{} sample documents of project {} are missing: {}".format(
+                len(missing), header["project_id"], " ".join(missing[:10])
+            )
+        )
+    obj = {key: value for key, value in header.items() if key != SAMPLES_FIELD}
+    obj["samples"] = {
+        sample_id: samples[sample_id] for sample_id in header[SAMPLES_FIELD]
+    }
+    return obj
+
+
+class BulkProjectWriter:
+    """Saves project documents in _bulk_docs batches
+    :param db: projects database
+    :param log: logger
+    :param int batch_size: number of documents collected before a batch is written
+    :param bool update_modification_time: set the modification time of the changed documents to now
+    :param dict doc_ids: document ids by project luid, see fetch_project_doc_ids
+    :param bool hash_view: read the stored hashes from the lims2db/project_hash view first
+    :param int delta_min_size: size in bytes of the JSON of the documents sent as a delta, None for none
+    :param samples_db: project_samples database, to save the samples in their own documents
+    """
+
+    def __init__(
+        self,
+        db,
+        log,
+        batch_size=50,
+        update_modification_time=True,
+        doc_ids=None,
+        hash_view=False,
+        delta_min_size=None,
+        samples_db=None,
+    ):
+        self.db = db
+        self.log = log
+        self.batch_size = batch_size
+        self.update_modification_time = update_modification_time
+        self.doc_ids = doc_ids
+        self.hash_view = hash_view
+        self.delta_min_size = delta_min_size
+        self.samples_db = samples_db
+        self.pending = []
+        # build states of the pending documents by project luid
+        self.build_states = {}
+        # pending projects whose sample documents are saved even if their document is unchanged
+        self.sample_docs_missing = set()
+        self.saved = 0
+        self.deltas = 0
+        self.unchanged = 0
+        self.failed = 0
+
+    def add(self, obj, build_state=None, sample_docs_missing=False):
+        """Collects a built project document, writes the batch once it is full
+        :param dict build_state: see prepare_project_doc
+        :param bool sample_docs_missing: some sample documents of the project are missing in couch
+        """
+        self.pending.append(obj)
+        self.build_states[obj["project_id"]] = build_state
+        if sample_docs_missing:
+            self.sample_docs_missing.add(obj["project_id"])
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the collected documents"""
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        counts = self.saved, self.deltas, self.unchanged, self.failed
+        try:
+            self.save_batch(batch)
+        except Exception as e:
+            self.log.error(
+                "Could not save the documents of projects {} together, saving them one by one: {!r}".format(
+                    " ".join(obj["project_id"] for obj in batch), e
+                )
+            )
+            # the documents saved before the error are found unchanged by their retry
+            self.saved, self.deltas, self.unchanged, self.failed = counts
+            for obj in batch:
+                try:
+                    self.save_one(obj)
+                except Exception as e:
+                    self.failed += 1
+                    self.log.error(
+                        "Could not save the document of project {}: {!r}".format(
+                            obj["project_id"], e
+                        )
+                    )
+        finally:
+            for obj in batch:
+                self.build_states.pop(obj["project_id"], None)
+                self.sample_docs_missing.discard(obj["project_id"])
+
+    def save_one(self, obj):
+        """Saves a single document, used when its batch could not be written"""
+        pid = obj["project_id"]
+        sample_docs = None
+        if self.samples_db is not None:
+            obj, sample_docs = split_project_doc(obj)
+        doc = fetch_project_docs(self.db, [pid], self.doc_ids).get(pid)
+        save, diffs = prepare_project_doc(
+            obj,
+            doc,
+            self.log,
+            self.update_modification_time,
+            self.build_states.get(pid),
+        )
+        if sample_docs is not None and (save or pid in self.sample_docs_missing):
+            save_sample_docs(self.samples_db, pid, sample_docs, self.log)
+        if not save:
+            self.unchanged += 1
+            return
+        if save_project_doc(self.db, obj, doc, self.log, self.delta_min_size):
+            self.deltas += 1
+        self.saved += 1
+        if self.doc_ids is not None:
+            self.doc_ids[pid] = obj["_id"]
+        notify_project_saved(obj, diffs)
+
+    def save_batch(self, batch):
+        sample_docs = {}
+        if self.samples_db is not None:
+            headers = []
+            for obj in batch:
+                header, sample_docs[obj["project_id"]] = split_project_doc(obj)
+                headers.append(header)
+            batch = headers
+        doc_ids = self.doc_ids
+        if self.hash_view:
+            hashes = fetch_project_hashes(self.db, [obj["project_id"] for obj in batch])
+            # the view also gives the ids of the documents to fetch
+            doc_ids = ChainMap(
+                {pid: doc_id for pid, (doc_id, _) in hashes.items()}, doc_ids or {}
+            )
+            changed = []
+            for obj in batch:
+                stored = hashes.get(obj["project_id"], (None, None))[1]
+                if stored and stored == set_content_hash(obj):
+                    self.log.info(
+                        "No modifications found for project {}".format(
+                            obj["project_id"]
+                        )
+                    )
+                    self.unchanged += 1
+                    self.repair_samples(obj, sample_docs)
+                else:
+                    changed.append(obj)
+            batch = changed
+            if not batch:
+                return
+        docs = fetch_project_docs(
+            self.db, [obj["project_id"] for obj in batch], doc_ids
+        )
+        to_save = []
+        for obj in batch:
+            doc = docs.get(obj["project_id"])
+            save, diffs = prepare_project_doc(
+                obj,
+                doc,
+                self.log,
+                self.update_modification_time,
+                self.build_states.get(obj["project_id"]),
+            )
+            if not save:
+                self.unchanged += 1
+                self.repair_samples(obj, sample_docs)
+                continue
+            if obj["project_id"] in sample_docs and not self.save_samples(
+                obj, sample_docs[obj["project_id"]]
+            ):
+                continue
+            if sends_delta(obj, doc, self.delta_min_size):
+                self.save_delta(obj, doc, diffs)
+            else:
+                to_save.append((obj, diffs))
+        if not to_save:
+            return
+        self.log.info(
+            "Saving {} project documents: {}".format(
+                len(to_save), " ".join(obj["project_id"] for obj, diffs in to_save)
+            )
+        )
+        results = self.db.update([obj for obj, diffs in to_save])
+        for (obj, diffs), (success, doc_id, rev_or_exc) in zip(to_save, results):
+            if not success:
+                self.failed += 1
+                self.log.error(
+                    "Could not save the document {} of project {}: {!r}".format(
+                        doc_id, obj["project_id"], rev_or_exc
+                    )
+                )
+                continue
+            self.saved += 1
+            if self.doc_ids is not None:
+                self.doc_ids[obj["project_id"]] = doc_id
+            notify_project_saved(obj, diffs)
+
+    def repair_samples(self, obj, sample_docs):
+        """Saves the sample documents of an unchanged project if some of them are missing"""
+        if (
+            obj["project_id"] in self.sample_docs_missing
+            and obj["project_id"] in sample_docs
+        ):
+            self.save_samples(obj, sample_docs[obj["project_id"]])
+
+    def save_samples(self, obj, sample_docs):
+        try:
+            save_sample_docs(self.samples_db, obj["project_id"], sample_docs, self.log)
+        except Exception as e:
+            self.failed += 1
+            self.log.error(
+                "Could not save the sample documents of project {}: {!r}".format(
+                    obj["project_id"], e
+                )
+            )
+            return False
+        return True
+
+    def save_delta(self, obj, doc, diffs):
+        try:
+            changes = save_delta(self.db, obj, doc)
+        except Exception as e:
+            self.failed += 1
+            self.log.error(
+                "Could not save the changes of the document {} of project {}: {!r}".format(
+                    doc["_id"], obj["project_id"], e
+                )
+            )
+            return
+        self.log.info(
+            "Saved {} changes of the document of project {}".format(
+                changes, obj["project_id"]
+            )
+        )
+        self.saved += 1
+        self.deltas += 1
+        notify_project_saved(obj, diffs)
+
+    def stats(self):
+        return (
+            "{} documents saved, {} of them as deltas, {} unchanged, {} failed".format(
+                self.saved, self.deltas, self.unchanged, self.failed
+            )
+        )
@@ -0,0 +1,73 @@
+"""Design documents of the couch views used by LIMS2DB itself"""
+
+# applies a delta of couch_bulk.project_delta to the document, creating the intermediate objects
+# of a path. The body is {"_rev": revision the delta was computed from, "delta": [...]}, a delta
+# computed from another revision is rejected as a conflict
+APPLY_DELTA = """function(doc, req) {
+    if (!doc) {
+        return [null, {code: 404, json: {error: "not_found", reason: "missing"}}];
+    }
+    var body = JSON.parse(req.body);
+    if (body._rev !== doc._rev) {
+        return [null, {code: 409, json: {error: "conflict", reason: "Document update conflict."}}];
+    }
+    body.delta.forEach(function(change) {
+        var node = doc;
+        var last = change.path.length - 1;
+        for (var i = 0; i < last; i++) {
+            var key = change.path[i];
+            if (typeof node[key] !== "object" || node[key] === null || Array.isArray(node[key])) {
+                node[key] = {};
+            }
+            node = node[key];
+        }
+        if ("value" in change) {
+            node[change.path[last]] = change.value;
+        } else {
+            delete node[change.path[last]];
+        }
+    });
+    return [doc, {json: {ok: true, id: doc._id}}];
+}"""
+
+PROJECTS_DESIGN_DOC = {
+    "_id": "_design/lims2db",
+    "language": "javascript",
+    "views": {
+        # content hash of the LIMS part of the project documents, see couch_bulk.content_hash
+        "project_hash": {
+            "map": "function(doc) { if (doc.project_id) { emit(doc.project_id, doc.lims_hash || null); } }"
+        }
+    },
+    "updates": {"apply_delta": APPLY_DELTA},
+}
+
+SAMPLES_DESIGN_DOC = {
+    "_id": "_design/lims2db",
+    "language": "javascript",
+    "views": {
+        # revision and content hash of the sample documents of a project, see couch_bulk.split_project_doc
+        "sample_hash": {
+            "map": "function(doc) { if (doc.entity_type === 'project_sample') { emit(doc.project_id, [doc._rev, doc.lims_hash]); } }"
+        }
+    },
+}
+
+
+def ensure_design_doc(db, design_doc, log=None):
+    """Saves a design document if it is missing or differs from the one in couch
+    :param db: couch database
+    :param dict design_doc: design document, with its _id
+    :returns: True if the design document was saved
+    """
+    current = db.get(design_doc["_id"])
+    if current is not None:
+        if all(current.get(key) == value for key, value in design_doc.items()):
+            return False
+        updated = dict(design_doc, _rev=current["_rev"])
+    else:
+        updated = dict(design_doc)
+    db.save(updated)
+    if log:
+        log.info("Saved the design document {}".format(design_doc["_id"]))
+    return True
@@ -3,15 +3,21 @@ from genologics_sql.utils import get_session, get_configuration
 import six.moves.http_client as http_client
 
 
-def diff_project_objects(pj_id, couch, proj_db, logfile, oconf):
+def diff_project_objects(pj_id, couch, proj_db, logfile, oconf, doc_ids=None):
+    """:param dict doc_ids: optional document ids by project id, read once from projects/lims_followed"""
     # Import is put here to defer circular imports
     from LIMS2DB.classes import ProjectSQL
+    from LIMS2DB.couch_bulk import SAMPLES_DB, SAMPLES_FIELD, assemble_project_doc
 
     log = setupLog("diff - {}".format(pj_id), logfile)
 
     view = proj_db.view("projects/lims_followed")
 
     def fetch_project(pj_id):
+        if doc_ids is not None:
+            if pj_id not in doc_ids:
+                log.error("No such project {}".format(pj_id))
+            return doc_ids.get(pj_id)
         try:
             old_project_couchid = view[pj_id].rows[0].value
         except (KeyError, IndexError):
@@ -30,43 +36,142 @@ def diff_project_objects(pj_id, couch, proj_db, logfile, oconf):
         return None
 
     old_project = proj_db.get(old_project_couchid)
-    old_project.pop("_id", None)
-    old_project.pop("_rev", None)
-    old_project.pop("modification_time", None)
-    old_project.pop("creation_time", None)
-    old_project["details"].pop("running_notes", None)
-    old_project["details"].pop("snic_checked", None)
+    if SAMPLES_FIELD in old_project:
+        try:
+            old_project = assemble_project_doc(old_project, couch[SAMPLES_DB])
+        except RuntimeError as e:
+            log.error("Cannot compare project {}: {}".format(pj_id, e))
+            return None
 
     session = get_session()
     host = get_configuration()["url"]
     new_project = ProjectSQL(session, log, pj_id, host, couch, oconf)
 
-    fediff = diff_objects(old_project, new_project.obj)
+    fediff = PROJECT_VALIDATION_DIFF.diffs(old_project, new_project.obj)
 
     return (fediff, old_project, new_project.obj)
 
 
-def diff_objects(o1, o2, parent=""):
-    diffs = {}
-
-    for key in o1:
-        if key in o2:
-            if isinstance(o1[key], dict):
-                more_diffs = diff_objects(o1[key], o2[key], "{} {}".format(parent, key))
-                diffs.update(more_diffs)
+# value of the missing keys yielded by DiffEngine.iter_diffs, rendered "missing" by the diffs
+MISSING = object()
+# rules of the compiled paths: ignored in both documents, removed from the first one
+_IGNORED = object()
+_REMOVED = object()
+
+
+class _Rules(dict):
+    # whether a path below is removed from the first document, equal subtrees can then differ
+    removes = False
+
+
+class DiffEngine:
+    """Differences between two documents, walked iteratively with tuple paths.
+    As diff_objects, a key missing on one side only counts if its value is truthy.
+    Paths are tuples of keys in which "*" matches any key, e.g. ("samples", "*", "details").
+    :param ignore: paths not compared
+    :param remove_first: paths of the first document compared as if they were missing from it,
+        as the fields popped from a couch document before comparing it with a new build
+    :param bool strict: a missing key counts whatever its value, as for a delta that has to give
+        exactly the second document
+    """
+
+    def __init__(self, ignore=(), remove_first=(), strict=False):
+        self.strict = strict
+        self.rules = _Rules()
+        for paths, rule in ((ignore, _IGNORED), (remove_first, _REMOVED)):
+            for path in paths:
+                node = self.rules
+                for key in path[:-1]:
+                    if rule is _REMOVED:
+                        node.removes = True
+                    node = node.setdefault(key, _Rules())
+                    if not isinstance(node, _Rules):
+                        break
+                else:
+                    if rule is _REMOVED:
+                        node.removes = True
+                    node[path[-1]] = rule
+
+    def iter_diffs(self, o1, o2):
+        """Yields (path, value in o1, value in o2) for each difference, MISSING for a missing key"""
+        # dicts being compared, their path, their rules and the iterator over the keys of the first one
+        strict = self.strict
+        stack = [(o1, o2, (), self.rules, iter(o1))]
+        while stack:
+            d1, d2, path, rules, keys = stack[-1]
+            for key in keys:
+                sub_rules = None
+                if rules:
+                    sub_rules = rules.get(key, rules.get("*"))
+                    if sub_rules is _IGNORED or sub_rules is _REMOVED:
+                        continue
+                if key in d2:
+                    v1 = d1[key]
+                    v2 = d2[key]
+                    # equal subtrees are compared in C, without walking them
+                    if v1 == v2 and not (sub_rules and sub_rules.removes):
+                        continue
+                    if isinstance(v1, dict) and isinstance(v2, dict):
+                        stack.append((v1, v2, path + (key,), sub_rules, iter(v1)))
+                        break
+                    if v1 != v2:
+                        yield path + (key,), v1, v2
+                elif strict or d1[key]:
+                    yield path + (key,), d1[key], MISSING
             else:
-                if o1[key] != o2[key]:
-                    diffs["{} {}".format(parent, key)] = [o1[key], o2[key]]
-
-        else:
-            if o1[key]:
-                diffs["key {} {}".format(parent, key)] = [o1[key], "missing"]
+                stack.pop()
+                for key in d2:
+                    if rules:
+                        rule = rules.get(key, rules.get("*"))
+                        if rule is _IGNORED:
+                            continue
+                        if rule is _REMOVED:
+                            if strict or d2[key]:
+                                yield path + (key,), MISSING, d2[key]
+                            continue
+                    if key not in d1 and (strict or d2[key]):
+                        yield path + (key,), MISSING, d2[key]
+
+    def differs(self, o1, o2):
+        """Whether the documents differ, stops at the first difference"""
+        for _ in self.iter_diffs(o1, o2):
+            return True
+        return False
+
+    def diffs(self, o1, o2, parent=""):
+        """Differences keyed as by diff_objects, " details name" for a changed value
+        and "key  details name" for a missing key or a dict replaced by another value.
+        """
+        diffs = {}
+        for path, v1, v2 in self.iter_diffs(o1, o2):
+            key = "{} {}".format(parent, " ".join(path))
+            if v1 is MISSING or v2 is MISSING or isinstance(v1, dict):
+                key = "key " + key
+            diffs[key] = [
+                "missing" if v1 is MISSING else v1,
+                "missing" if v2 is MISSING else v2,
+            ]
+        return diffs
+
+
+_DEFAULT_ENGINE = DiffEngine()
+
+# fields of the couch documents that are not compared with a new build
+PROJECT_VALIDATION_DIFF = DiffEngine(
+    ignore=[("lims_hash",), ("lims2db_build_state",)],
+    remove_first=[
+        ("_id",),
+        ("_rev",),
+        ("modification_time",),
+        ("creation_time",),
+        ("details", "running_notes"),
+        ("details", "snic_checked"),
+    ],
+)
 
-    for key in o2:
-        if key not in o1 and o2[key]:
-            diffs["key {} {}".format(parent, key)] = ["missing", o2[key]]
 
-    return diffs
+def diff_objects(o1, o2, parent=""):
+    return _DEFAULT_ENGINE.diffs(o1, o2, parent)
 
 
 if __name__ == "__main__":
@@ -7,21 +7,29 @@ from genologics_sql.utils import *
 from genologics_sql.queries import get_last_modified_processes
 
 import LIMS2DB.objectsDB.process_categories as pc_cg
+from LIMS2DB import statements
 
-from sqlalchemy import text
 
-
-def create_lims_data_obj(session, pro):
+def create_lims_data_obj(session, pro, graph=None):
+    """Builds the lims_data part of a flowcell document.
+    :param session: genologics_sql session
+    :param pro: sequencing Process
+    :param graph: optional LineageGraph holding the io of pro, to avoid querying it
+    """
     obj = {}
     obj["step_id"] = pro.luid
 
     # which container is used in this step ?
-    query = "select distinct ct.* from container ct\
-             inner join containerplacement cp on cp.containerid=ct.containerid \
-             inner join processiotracker piot on piot.inputartifactid=cp.processartifactid \
-             where piot.processid = {pid}::integer;".format(pid=pro.processid)
-
-    cont = session.query(Container).from_statement(text(query)).first()
+    if graph:
+        cont = None
+        for art in graph.inputs_of(pro):
+            if art.containerplacement:
+                cont = art.containerplacement.container
+                break
+    else:
+        cont = statements.fetch_first(
+            session, Container, "flowcell_container", processid=pro.processid
+        )
     obj["container_id"] = cont.luid
     obj["container_name"] = cont.name
 
@@ -29,34 +37,35 @@ def create_lims_data_obj(session, pro):
     if pc_cg.SEQUENCING.get(str(pro.typeid), "") in ["MiSeq Run (MiSeq) 4.0"]:
         obj["run_type"] = pro.udf_dict["Run Type"]
 
-    if pc_cg.SEQUENCING.get(str(pro.typeid), "") in [
+    lane_outputs = pc_cg.SEQUENCING.get(str(pro.typeid), "") in [
         "AUTOMATED - NovaSeq Run (NovaSeq 6000 v2.0)",
         "AVITI Run v1.0",
         "Illumina Sequencing (NextSeq) v1.0",
         "NovaSeqXPlus Run v1.0",
-    ]:
+    ]
+    if lane_outputs:
         # NovaSeq flowcell have the individual stats as output artifact
-        query = "select art.* from artifact art \
-                 inner join outputmapping omap on omap.outputartifactid=art.artifactid \
-                 inner join processiotracker piot on piot.trackerid=omap.trackerid \
-                 where art.name LIKE 'Lane%' and piot.processid = {pid}::integer;".format(
-            pid=pro.processid
-        )
+        statement = "flowcell_lane_outputs"
     else:
         # Which artifacts are updated in this step ?
-        query = "select distinct art.* from artifact art\
-                 inner join processiotracker piot on piot.inputartifactid=art.artifactid \
-                 where piot.processid = {pid}::integer;".format(pid=pro.processid)
+        statement = "process_distinct_inputs"
 
     obj["run_summary"] = {}
-    arts = session.query(Artifact).from_statement(text(query)).all()
+    if graph:
+        if lane_outputs:
+            arts = [
+                art
+                for art in graph.outputs_of(pro)
+                if art.name and art.name.startswith("Lane")
+            ]
+        else:
+            arts = graph.inputs_of(pro)
+    else:
+        arts = statements.fetch_all(
+            session, Artifact, statement, processid=pro.processid
+        )
     for art in arts:
-        if pc_cg.SEQUENCING.get(str(pro.typeid), "") in [
-            "AUTOMATED - NovaSeq Run (NovaSeq 6000 v2.0)",
-            "AVITI Run v1.0",
-            "Illumina Sequencing (NextSeq) v1.0",
-            "NovaSeqXPlus Run v1.0",
-        ]:
+        if lane_outputs:
             lane = art.name.replace("Lane ", "")
         else:
             lane = art.containerplacement.api_string.split(":")[0]
@@ -0,0 +1,65 @@
+"""Incremental JSON output of the project documents"""
+
+import json
+
+
+class ProjectJSONWriter:
+    """Writes a project document as JSON, one sample at a time
+    :param out: text file object, e.g. sys.stdout
+    """
+
+    def __init__(self, out):
+        self.out = out
+        # keys of the document already written, None until the samples are started
+        self.written = None
+        self.nb_samples = 0
+
+    @property
+    def streaming(self):
+        return self.written is not None
+
+    def _write_item(self, key, value):
+        if self.written:
+            self.out.write(", ")
+        self.written.append(key)
+        self.out.write("{}: {}".format(json.dumps(key), json.dumps(value)))
+
+    def start_samples(self, doc):
+        """Writes the fields of the document up to the samples, and opens the samples object
+        :param dict doc: project document, with its samples key set
+        """
+        self.written = []
+        self.out.write("{")
+        for key, value in doc.items():
+            if key == "samples":
+                if self.written:
+                    self.out.write(", ")
+                self.written.append(key)
+                self.out.write("{}: {{".format(json.dumps(key)))
+                break
+            self._write_item(key, value)
+
+    def write_sample(self, name, sample):
+        """Writes one sample into the samples object
+        :param str name: sample name
+        :param dict sample: sample document
+        """
+        if self.nb_samples:
+            self.out.write(", ")
+        self.out.write("{}: {}".format(json.dumps(name), json.dumps(sample)))
+        self.nb_samples += 1
+
+    def finish(self, doc):
+        """Writes the rest of the document. If the samples were not started, writes it whole.
+        :param dict doc: project document, without the samples already written
+        """
+        if not self.streaming:
+            self.out.write(json.dumps(doc))
+            return
+        for name, sample in doc.get("samples", {}).items():
+            self.write_sample(name, sample)
+        self.out.write("}")
+        for key, value in doc.items():
+            if key not in self.written:
+                self._write_item(key, value)
+        self.out.write("}")
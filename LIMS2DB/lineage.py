@@ -0,0 +1,400 @@
+from datetime import datetime
+import copy
+
+from genologics_sql.tables import Artifact, Process
+import LIMS2DB.objectsDB.process_categories as pc_cg
+from LIMS2DB import statements
+
+# Library prep starts, the processes get_library_preps looks for children of
+LINEAGE_STARTS = list(pc_cg.WORKSET.keys()) + list(pc_cg.PREPSTARTFINLIB.keys())
+# Processes looked up among the children of the library prep starts
+LINEAGE_CHILDREN = (
+    list(pc_cg.PREPSTART.keys())
+    + list(pc_cg.PREPEND.keys())
+    + list(pc_cg.AGRLIBVAL.keys())
+    + list(pc_cg.SEQUENCING.keys())
+)
+# Processes looked up in the history of the sequencing runs
+LINEAGE_HISTORY = list(pc_cg.SEQSTART.keys()) + list(pc_cg.DILSTART.keys())
+
+
+def sort_processes(processes, orderby=None):
+    """Sorts processes like postgres would, nulls are last in ascending order and first in descending order.
+    :param list processes: Process objects
+    :param str orderby: None, "daterun" or "daterun desc"
+    """
+    processes = sorted(processes, key=lambda p: p.processid)
+    if orderby == "daterun":
+        processes.sort(key=lambda p: (p.daterun is None, p.daterun or datetime.min))
+    elif orderby == "daterun desc":
+        processes.sort(
+            key=lambda p: (p.daterun is None, p.daterun or datetime.min), reverse=True
+        )
+    elif orderby:
+        raise ValueError("Unsupported ordering {}".format(orderby))
+    return processes
+
+
+class ProjectLineage:
+    """Descendant processes of the library prep starts and ancestor processes of the sequencing runs
+    of a project, fetched once with one query each, and bucketed by (process, sample) and process typeid.
+
+    Answers the same questions as genologics_sql.queries.get_children_processes and
+    get_processes_in_history for these categories, without a query per call.
+    artifact_ancestor_map already holds the transitive closure, so no recursion is needed.
+    """
+
+    def __init__(self, session, project):
+        self.session = session
+        self.project = project
+        self.processes = {}
+        # (parent processid, sample processid) -> typeid -> set of processids
+        self.children_map = self.fetch(
+            "lineage_children",
+            parents=statements.typeids(LINEAGE_STARTS),
+            typeids=statements.typeids(LINEAGE_CHILDREN),
+        )
+        self.history_map = self.fetch(
+            "lineage_history",
+            parents=statements.typeids(pc_cg.SEQUENCING),
+            typeids=statements.typeids(LINEAGE_HISTORY),
+        )
+
+    def fetch(self, name, **params):
+        rows = statements.fetch_rows(
+            self.session, name, projectid=self.project.projectid, **params
+        )
+        self.load_processes(set(row[2] for row in rows))
+        lineage = {}
+        for parentid, sampleid, processid in rows:
+            typeid = str(self.processes[processid].typeid)
+            lineage.setdefault((parentid, sampleid), {}).setdefault(typeid, set()).add(
+                processid
+            )
+        return lineage
+
+    def load_processes(self, processids):
+        new_ids = set(processids) - set(self.processes)
+        if new_ids:
+            for pro in statements.fetch_all(
+                self.session, Process, "processes_by_id", processids=sorted(new_ids)
+            ):
+                self.processes[pro.processid] = pro
+
+    def with_session(self, session, samples=None):
+        """Copy of the lineage using another session, e.g. in another thread. The maps are shared,
+        the processes are loaded again.
+        :param samples: sample processids whose processes are loaded, all by default
+        """
+        lineage = copy.copy(self)
+        lineage.session = session
+        lineage.processes = {}
+        lineage.load_samples(samples)
+        return lineage
+
+    def load_samples(self, samples=None):
+        """Loads the processes of the lineage of some samples, the ones already loaded are kept
+        :param samples: sample processids, all by default
+        """
+        processids = set()
+        for lineage_map in (self.children_map, self.history_map):
+            for (parentid, sampleid), by_type in lineage_map.items():
+                if samples is None or sampleid in samples:
+                    for ids in by_type.values():
+                        processids.update(ids)
+        self.load_processes(processids)
+
+    def lookup(self, lineage, fetched, parent_process, ptypes, sample, orderby):
+        by_type = lineage.get((parent_process, sample), {})
+        found = set()
+        for ptype in ptypes:
+            if str(ptype) not in fetched:
+                raise ValueError("Process type {} was not prefetched".format(ptype))
+            found.update(by_type.get(str(ptype), ()))
+        return sort_processes([self.processes[pid] for pid in found], orderby)
+
+    def children(self, parent_process, ptypes, sample, orderby=None):
+        """Processes of types ptypes found in the children of parent_process, for the given sample.
+        :param int parent_process: processid of a library prep start
+        :param ptypes: process typeids, a dict from process_categories can be used
+        :param int sample: sample processid
+        :param str orderby: None, "daterun" or "daterun desc"
+        """
+        return self.lookup(
+            self.children_map, LINEAGE_CHILDREN, parent_process, ptypes, sample, orderby
+        )
+
+    def history(self, parent_process, ptypes, sample, orderby=None):
+        """Processes of types ptypes found in the history of parent_process, for the given sample.
+        :param int parent_process: processid of a sequencing run
+        :param ptypes: process typeids, a dict from process_categories can be used
+        :param int sample: sample processid
+        :param str orderby: None, "daterun" or "daterun desc"
+        """
+        return self.lookup(
+            self.history_map, LINEAGE_HISTORY, parent_process, ptypes, sample, orderby
+        )
+
+
+def process_id(process):
+    """Accepts a Process or a processid"""
+    return getattr(process, "processid", process)
+
+
+class LineageGraph:
+    """In memory graph of the processes and artifacts around a project or a set of processes.
+
+    The io trackers, output mappings, ancestor map and sample map are loaded with a handful of
+    bulk queries, after which the traversals are dictionary lookups instead of a query per node.
+    Processes are loaded at once, artifacts are loaded in bulk the first time one is asked for.
+    """
+
+    def __init__(self, session, artifact_loads=()):
+        self.session = session
+        # loader options of the artifacts, e.g. selectinload of the relationships the caller reads
+        self.artifact_loads = artifact_loads
+        self.processes = {}
+        self.artifacts = {}
+        # processid -> {trackerid: input artifactid}
+        self.process_inputs = {}
+        # trackerid -> set of output artifactids
+        self.tracker_outputs = {}
+        # artifactid -> set of processids using it as input
+        self.consumers = {}
+        # artifactid -> set of ancestor artifactids, and the reverse
+        self.ancestors = {}
+        self.descendants = {}
+        # artifactid -> set of sample processids
+        self.artifact_samples = {}
+
+    @classmethod
+    def for_project(cls, session, project):
+        """Loads all the processes having an input artifact belonging to the project, with their io
+        and the ancestry of the project artifacts.
+        :param session: genologics_sql session
+        :param project: genologics_sql Project
+        """
+        graph = cls(session)
+        processids = [
+            row[0]
+            for row in statements.fetch_rows(
+                session, "graph_project_processes", projectid=project.projectid
+            )
+        ]
+        graph.load_samples(
+            statements.fetch_rows(
+                session, "graph_project_samples", projectid=project.projectid
+            )
+        )
+        graph.load_io(processids)
+        graph.load_ancestry(
+            statements.fetch_rows(
+                session, "graph_project_ancestry", projectid=project.projectid
+            )
+        )
+        graph.load_processes(processids)
+        return graph
+
+    def with_session(self, session):
+        """Copy of the graph using another session, e.g. in another thread. The io, ancestry and sample
+        maps are shared, the processes are loaded again and the artifacts when they are first asked for.
+        """
+        graph = copy.copy(self)
+        graph.session = session
+        graph.processes = {}
+        graph.artifacts = {}
+        graph.load_processes(sorted(self.processes))
+        return graph
+
+    @classmethod
+    def for_processes(
+        cls,
+        session,
+        processes,
+        descendants=True,
+        ancestor_index=None,
+        artifact_loads=(),
+    ):
+        """Loads the given processes with their io. If descendants is set, also loads the artifacts
+        descending from their inputs and outputs, and the processes using those.
+        :param session: genologics_sql session
+        :param list processes: Process objects or processids
+        :param bool descendants: whether to load the downstream part of the graph
+        :param AncestorIndex ancestor_index: optional local index of the ancestry, replaces the
+            artifact_ancestor_map query
+        :param artifact_loads: loader options of the artifacts
+        """
+        graph = cls(session, artifact_loads)
+        seeds = sorted(set(int(process_id(p)) for p in processes))
+        if not seeds:
+            return graph
+        graph.load_io(seeds)
+        if descendants:
+            seed_artifacts = set(graph.consumers)
+            for outputs in graph.tracker_outputs.values():
+                seed_artifacts.update(outputs)
+            if ancestor_index is not None:
+                graph.load_ancestry(
+                    (artifactid, ancestorid)
+                    for ancestorid in sorted(seed_artifacts)
+                    for artifactid in ancestor_index.descendants(ancestorid)
+                )
+            else:
+                graph.load_ancestry(
+                    statements.fetch_rows(
+                        session,
+                        "graph_descendants",
+                        artifactids=sorted(seed_artifacts),
+                    )
+                )
+            consumers = statements.fetch_rows(
+                session, "graph_consumers", artifactids=sorted(graph.ancestors)
+            )
+            graph.load_io(
+                sorted(set(row[0] for row in consumers) - set(graph.process_inputs))
+            )
+        artifactids = set(graph.consumers)
+        for outputs in graph.tracker_outputs.values():
+            artifactids.update(outputs)
+        if artifactids:
+            graph.load_samples(
+                statements.fetch_rows(
+                    session, "graph_artifact_samples", artifactids=sorted(artifactids)
+                )
+            )
+        graph.load_processes(sorted(graph.process_inputs))
+        return graph
+
+    def load_io(self, processids):
+        if not processids:
+            return
+        for trackerid, processid, artifactid in statements.fetch_rows(
+            self.session, "graph_inputs", processids=processids
+        ):
+            self.process_inputs.setdefault(processid, {})[trackerid] = artifactid
+            self.consumers.setdefault(artifactid, set()).add(processid)
+        for trackerid, artifactid in statements.fetch_rows(
+            self.session, "graph_outputs", processids=processids
+        ):
+            self.tracker_outputs.setdefault(trackerid, set()).add(artifactid)
+
+    def load_ancestry(self, rows):
+        for artifactid, ancestorid in rows:
+            self.ancestors.setdefault(artifactid, set()).add(ancestorid)
+            self.descendants.setdefault(ancestorid, set()).add(artifactid)
+
+    def load_samples(self, rows):
+        for artifactid, sampleid in rows:
+            self.artifact_samples.setdefault(artifactid, set()).add(sampleid)
+
+    def load_processes(self, processids):
+        if not processids:
+            return
+        for pro in statements.fetch_all(
+            self.session, Process, "processes_by_id", processids=processids
+        ):
+            self.processes[pro.processid] = pro
+
+    def load_artifacts(self, artifactids):
+        missing = set(artifactids) - set(self.artifacts)
+        if missing:
+            # Fetch everything the graph knows about at once, the next calls will be free
+            missing.update(set(self.consumers) - set(self.artifacts))
+            for outputs in self.tracker_outputs.values():
+                missing.update(outputs - set(self.artifacts))
+            for art in (
+                self.session.query(Artifact)
+                .options(*self.artifact_loads)
+                .filter(Artifact.artifactid.in_(missing))
+                .all()
+            ):
+                self.artifacts[art.artifactid] = art
+        return [
+            self.artifacts[a] for a in sorted(artifactids) if a in self.artifacts
+        ]
+
+    def input_ids(self, process):
+        return set(self.process_inputs.get(process_id(process), {}).values())
+
+    def output_ids(self, process, input_artifact=None):
+        outputs = set()
+        for trackerid, artifactid in self.process_inputs.get(
+            process_id(process), {}
+        ).items():
+            if input_artifact is None or artifactid == input_artifact:
+                outputs.update(self.tracker_outputs.get(trackerid, ()))
+        return outputs
+
+    def inputs_of(self, process):
+        """Input artifacts of a process
+        :param process: Process or processid
+        """
+        return self.load_artifacts(self.input_ids(process))
+
+    def outputs_of(self, process, input_artifact=None):
+        """Output artifacts of a process, optionally only the ones generated from one input
+        :param process: Process or processid
+        :param int input_artifact: artifactid of an input of the process
+        """
+        return self.load_artifacts(self.output_ids(process, input_artifact))
+
+    def consuming(self, artifactids, categories, sample):
+        types = set(str(c) for c in categories)
+        found = set()
+        for artifactid in artifactids:
+            if (
+                sample is not None
+                and sample not in self.artifact_samples.get(artifactid, ())
+            ):
+                continue
+            for pid in self.consumers.get(artifactid, ()):
+                pro = self.processes.get(pid)
+                if pro is not None and str(pro.typeid) in types:
+                    found.add(pid)
+        return found
+
+    def children(self, process, categories, sample=None, orderby=None):
+        """Processes of the given categories using an artifact that descends from an input of process.
+        Same semantics as genologics_sql.queries.get_children_processes.
+        :param process: Process or processid
+        :param categories: process typeids, a dict from process_categories can be used
+        :param int sample: only consider artifacts of this sample processid
+        :param str orderby: None, "daterun" or "daterun desc"
+        """
+        descendants = set()
+        for artifactid in self.input_ids(process):
+            descendants.update(self.descendants.get(artifactid, ()))
+        found = self.consuming(descendants, categories, sample)
+        return sort_processes([self.processes[pid] for pid in found], orderby)
+
+    def history(self, process, categories, sample=None, orderby=None):
+        """Processes of the given categories using an artifact that is an ancestor of an input of process.
+        Same semantics as genologics_sql.queries.get_processes_in_history.
+        :param process: Process or processid
+        :param categories: process typeids, a dict from process_categories can be used
+        :param int sample: only consider artifacts of this sample processid
+        :param str orderby: None, "daterun" or "daterun desc"
+        """
+        ancestors = set()
+        for artifactid in self.input_ids(process):
+            ancestors.update(self.ancestors.get(artifactid, ()))
+        found = self.consuming(ancestors, categories, sample)
+        return sort_processes([self.processes[pid] for pid in found], orderby)
+
+    def descendant_consumers(self, artifact, categories, orderby=None):
+        """Processes of the given categories using an artifact that descends from artifact
+        :param int artifact: artifactid
+        :param categories: process typeids, a dict from process_categories can be used
+        :param str orderby: None, "daterun" or "daterun desc"
+        """
+        found = self.consuming(self.descendants.get(artifact, ()), categories, None)
+        return sort_processes([self.processes[pid] for pid in found], orderby)
+
+    def descendant_inputs(self, process, artifact):
+        """Input artifacts of process that descend from artifact
+        :param process: Process or processid
+        :param int artifact: artifactid of the ancestor
+        """
+        return self.load_artifacts(
+            self.input_ids(process) & self.descendants.get(artifact, set())
+        )
@@ -0,0 +1,272 @@
+"""Client of the order portal API used by the project builds"""
+
+import calendar
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from LIMS2DB import profiling
+
+# order fields kept in the project documents, the dicts filter the nested fields
+ORDER_FIELDS = [
+    "created",
+    "modified",
+    "site",
+    "title",
+    "identifier",
+    {
+        "owner": ["name", "email"],
+        "fields": [
+            "seq_readlength_hiseqx",
+            "library_readymade",
+            "bx_exp",
+            "seq_instrument",
+            "project_lab_email",
+            "project_bx_email",
+            "project_lab_name",
+            "bx_data_delivery",
+            "sample_no",
+            "bioinformatics",
+            "sequencing",
+            "project_pi_name",
+            "bx_bp",
+            "project_desc",
+            "project_pi_email",
+        ],
+    },
+]
+
+# fraction of the time since the last modification of an order during which its response is used
+FRESHNESS_FACTOR = 0.1
+
+# one client per process, the pooled connections cannot be shared with forked workers
+_clients = {}
+
+CachedResponse = namedtuple(
+    "CachedResponse", ["body", "etag", "last_modified", "modified", "fetched"]
+)
+
+
+def _epoch(timestamp):
+    """Seconds since epoch of an ISO 8601 UTC timestamp, as in the modified field of the orders, or None"""
+    try:
+        dt = datetime.fromisoformat(timestamp.rstrip("Z"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return calendar.timegm(dt.utctimetuple())
+
+
+class OrderCache:
+    """Order portal responses kept in a sqlite file
+    :param str path: sqlite file, created if missing
+    :param float max_age: longest time in seconds a response is used without revalidation
+    :param float ttl: seconds after which the responses not used are evicted
+    """
+
+    def __init__(self, path, max_age=86400, ttl=30 * 86400):
+        self.max_age = max_age
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("pragma journal_mode=wal")
+            self.connection.execute(
+                "create table if not exists responses (url text primary key, body text not null, "
+                "etag text, last_modified text, modified text, fetched real not null, used real not null)"
+            )
+        self.evict()
+
+    def get(self, url):
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "select body, etag, last_modified, modified, fetched from responses where url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "update responses set used = ? where url = ?", (time.time(), url)
+            )
+        return CachedResponse(*row)
+
+    def put(self, url, body, etag=None, last_modified=None, modified=None):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "insert or replace into responses values (?, ?, ?, ?, ?, ?, ?)",
+                (url, body, etag, last_modified, modified, now, now),
+            )
+
+    def revalidated(self, url):
+        """The order portal answered that the response of url did not change"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "update responses set fetched = ? where url = ?", (time.time(), url)
+            )
+
+    def is_fresh(self, response, now=None):
+        """Whether the response can be used without asking the order portal"""
+        now = time.time() if now is None else now
+        lifetime = self.max_age
+        modified = _epoch(response.modified)
+        if modified is not None:
+            lifetime = min(
+                lifetime, max(0, response.fetched - modified) * FRESHNESS_FACTOR
+            )
+        return now - response.fetched < lifetime
+
+    def evict(self):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "delete from responses where used < ?", (time.time() - self.ttl,)
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+class OrderPortalClient:
+    """
+    :param dict oconf: order_portal section of the configuration, api_get_order_url, api_token and
+        optionally timeout, retries, backoff_factor, cache (sqlite file), cache_max_age and cache_ttl
+    :param int pool_size: number of connections kept open
+    """
+
+    def __init__(self, oconf, pool_size=10):
+        self.order_url = oconf["api_get_order_url"].rstrip("/")
+        self.timeout = oconf.get("timeout", 10)
+        self.cache = None
+        if oconf.get("cache"):
+            self.cache = OrderCache(
+                oconf["cache"],
+                max_age=oconf.get("cache_max_age", 86400),
+                ttl=oconf.get("cache_ttl", 30 * 86400),
+            )
+        # responses served from the cache without request, and after a conditional request
+        self.requests = 0
+        self.cache_hits = 0
+        self.not_modified = 0
+        self.session = requests.Session()
+        self.session.headers["X-OrderPortal-API-key"] = oconf["api_token"]
+        retry = Retry(
+            total=oconf.get("retries", 3),
+            backoff_factor=oconf.get("backoff_factor", 0.5),
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=("GET",),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_json(self, url):
+        cached = self.cache.get(url) if self.cache is not None else None
+        if cached is not None and self.cache.is_fresh(cached):
+            self.cache_hits += 1
+            return json.loads(cached.body)
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+        profiling.count_http()
+        self.requests += 1
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if cached is not None and response.status_code == 304:
+            self.not_modified += 1
+            self.cache.revalidated(url)
+            return json.loads(cached.body)
+        data = response.json()
+        if self.cache is not None and response.status_code == 200:
+            self.cache.put(
+                url,
+                response.text,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                data.get("modified") if isinstance(data, dict) else None,
+            )
+        return data
+
+    def fill_order_info(self, portal_id, order_info):
+        """Fills order_info with the fields of the order and the affiliation of its owner.
+        If a request fails, order_info keeps what was filled before the exception.
+        :param str portal_id: order identifier, the Portal ID udf of the project
+        :param dict order_info: details to fill
+        """
+        full_order_info = self.get_json("{}/{}".format(self.order_url, portal_id))
+        for fk in ORDER_FIELDS:
+            if isinstance(fk, dict):
+                for k, vals in fk.items():
+                    if k not in order_info:
+                        order_info[k] = {}
+                    for vk in vals:
+                        order_info[k][vk] = full_order_info.get(k, {}).get(vk)
+            else:
+                order_info[fk] = full_order_info.get(fk)
+        owner_url = full_order_info["owner"]["links"]["api"]["href"]
+        order_info["owner"]["affiliation"] = self.get_json(owner_url).get(
+            "university", ""
+        )
+        return order_info
+
+    def stats(self):
+        return "{} requests, {} responses from the cache, {} not modified".format(
+            self.requests, self.cache_hits, self.not_modified
+        )
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+def client(oconf):
+    """The client of the current process"""
+    key = (os.getpid(), oconf["api_get_order_url"], oconf["api_token"])
+    if key not in _clients:
+        _clients[key] = OrderPortalClient(oconf)
+    return _clients[key]
+
+
+def prefetch_orders(oconf, portal_ids, workers=8, log=None):
+    """Fetches the details of many orders concurrently
+    :param dict oconf: order_portal section of the configuration
+    :param portal_ids: order identifiers
+    :param int workers: number of concurrent requests
+    :param log: logger of the orders that could not be fetched
+    :returns: dict of the order details by portal id, without the orders that could not be fetched
+    """
+    portal_client = OrderPortalClient(oconf, pool_size=workers)
+
+    def fetch(portal_id):
+        try:
+            return portal_id, portal_client.fill_order_info(portal_id, {})
+        except Exception as e:
+            if log:
+                log.warning("Not able to prefetch order {}: {}".format(portal_id, e))
+            return portal_id, None
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            orders = {
+                portal_id: order_info
+                for portal_id, order_info in executor.map(fetch, set(portal_ids))
+                if order_info is not None
+            }
+    finally:
+        portal_client.close()
+    if log:
+        log.info("Order portal prefetch: {}".format(portal_client.stats()))
+    return orders
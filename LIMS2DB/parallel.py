@@ -2,6 +2,7 @@ import logging
 import logging.handlers
 import LIMS2DB.classes as lclasses
 import LIMS2DB.utils as lutils
+from LIMS2DB import slow_queries, statements
 import multiprocessing as mp
 import statusdb.db as sdb
 
@@ -128,7 +129,7 @@ def stillRunning(processList):
     return ret
 
 
-def masterProcessSQL(args, wslist, logger):
+def masterProcessSQL(args, wslist, logger, ancestor_index=None):
     worksetQueue = mp.JoinableQueue()
     logQueue = mp.Queue()
     childs = []
@@ -140,7 +141,10 @@ def masterProcessSQL(args, wslist, logger):
 
     # spawn a pool of processes, and pass them queue instance
     for i in range(procs_nb):
-        p = mp.Process(target=processWSULSQL, args=(args, worksetQueue, logQueue))
+        p = mp.Process(
+            target=processWSULSQL,
+            args=(args, worksetQueue, logQueue, ancestor_index),
+        )
         p.start()
         childs.append(p)
     # populate queue with data
@@ -159,7 +163,7 @@ def masterProcessSQL(args, wslist, logger):
                 break
 
 
-def processWSULSQL(args, queue, logqueue):
+def processWSULSQL(args, queue, logqueue, ancestor_index=None):
     work = True
     session = get_session()
     with open(args.conf) as conf_file:
@@ -173,6 +177,8 @@ def processWSULSQL(args, queue, logqueue):
     mft = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
     mfh.setFormatter(mft)
     proclog.addHandler(mfh)
+    if args.slow_query_threshold is not None:
+        slow_queries.enable(proclog, args.slow_query_threshold)
 
     while work:
         # grabs project from queue
@@ -189,14 +195,17 @@ def processWSULSQL(args, queue, logqueue):
                 .filter(gt.Process.processid == int(ws_id))
                 .one()
             )
-            ws = lclasses.Workset_SQL(session, proclog, step)
+            with slow_queries.building("workset {}".format(step.luid)):
+                ws = lclasses.Workset_SQL(
+                    session, proclog, step, ancestor_index=ancestor_index
+                )
             doc = {}
             for row in db.view("worksets/lims_id")[ws.obj["id"]]:
                 doc = db.get(row.id)
             if doc:
-                final_doc = lutils.merge(ws.obj, doc)
+                final_doc, changed = lutils.DEFAULT_MERGE.merge(ws.obj, doc)
             else:
-                final_doc = ws.obj
+                final_doc, changed = ws.obj, True
             # clean possible name duplicates
             for row in db.view("worksets/name")[ws.obj["name"]]:
                 doc = db.get(row.id)
@@ -207,9 +216,15 @@ def processWSULSQL(args, queue, logqueue):
                         )
                     )
                     db.delete(doc)
-            db.save(final_doc)
-            proclog.info("updating {0}".format(ws.obj["name"]))
+            if changed:
+                db.save(final_doc)
+                proclog.info("updating {0}".format(ws.obj["name"]))
+            else:
+                proclog.info("not modifying {0}".format(ws.obj["name"]))
             queue.task_done()
+    proclog.info("Statement statistics:\n{}".format(statements.format_stats()))
+    if args.slow_query_threshold is not None:
+        proclog.info("Slowest queries:\n{}".format(slow_queries.report()))
 
 
 class QueueHandler(logging.Handler):
@@ -0,0 +1,188 @@
+"""Per phase profile of the project builds: wall time, SQL statements, rows fetched and HTTP calls"""
+
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+COUNTERS = ("calls", "seconds", "statements", "rows", "http_calls")
+
+# counters of the phases open in the current thread, innermost last
+_local = threading.local()
+_listening = False
+# the counters of the phases inherited by other threads are updated concurrently
+_count_lock = threading.Lock()
+
+
+def _open_phases():
+    if not hasattr(_local, "phases"):
+        _local.phases = []
+    return _local.phases
+
+
+def _count(counter, n=1):
+    with _count_lock:
+        for counters in _open_phases():
+            counters[counter] += n
+
+
+def current_phases():
+    """Counters of the phases open in the current thread, to pass to inherited_phases in another thread"""
+    return list(_open_phases())
+
+
+@contextmanager
+def inherited_phases(phases):
+    """Counts what runs in the block in the given phases of another thread too
+    :param list phases: see current_phases
+    """
+    previous = _open_phases()
+    _local.phases = list(phases)
+    try:
+        yield
+    finally:
+        _local.phases = previous
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _count("statements")
+    # psycopg2 fetches the whole result of a select, so rowcount is the number of rows
+    if cursor.rowcount > 0:
+        _count("rows", cursor.rowcount)
+
+
+def count_http():
+    """Counts an HTTP call in the open phases"""
+    _count("http_calls")
+
+
+def _new_counters():
+    return dict.fromkeys(COUNTERS, 0)
+
+
+def _add(total, counters):
+    for counter in COUNTERS:
+        total[counter] = total.get(counter, 0) + counters[counter]
+
+
+class BuildProfile:
+    """Counters per phase, and per phase of each sample, of the build of a project
+    :param str pid: project luid
+    """
+
+    def __init__(self, pid):
+        global _listening
+        if not _listening:
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+            _listening = True
+        self.pid = pid
+        self.phases = {}
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, sample=None):
+        """Counts what runs in the block as a phase, of a sample if one is given"""
+        counters = _new_counters()
+        counters["calls"] = 1
+        open_phases = _open_phases()
+        open_phases.append(counters)
+        start = time.perf_counter()
+        try:
+            yield counters
+        finally:
+            counters["seconds"] = time.perf_counter() - start
+            open_phases.pop()
+            with self.lock:
+                _add(self.phases.setdefault(name, {}), counters)
+                if sample is not None:
+                    _add(
+                        self.samples.setdefault(sample, {}).setdefault(name, {}),
+                        counters,
+                    )
+
+    def as_dict(self):
+        """Structured record of the profile, picklable and JSON serializable"""
+        return {
+            "project": self.pid,
+            "seconds": self.phases.get("build", {}).get("seconds", 0.0),
+            "phases": self.phases,
+            "samples": self.samples,
+        }
+
+    def summary(self, top=5):
+        """One line of the counters per phase, and the slowest samples"""
+        return "{}; slowest samples: {}".format(
+            format_phases(self.phases),
+            ", ".join(
+                "{} {:.3f}s".format(name, seconds)
+                for name, seconds in slowest_samples(self.samples, top)
+            ),
+        )
+
+
+def slowest_samples(samples, top):
+    """(sample, seconds) of the samples taking the longest over all their phases"""
+    totals = [
+        (name, sum(counters["seconds"] for counters in phases.values()))
+        for name, phases in samples.items()
+    ]
+    return sorted(totals, key=lambda x: x[1], reverse=True)[:top]
+
+
+def format_phases(phases):
+    return ", ".join(
+        "{}: {calls} calls {seconds:.3f}s {statements} statements {rows} rows {http_calls} http".format(
+            name, **counters
+        )
+        for name, counters in phases.items()
+    )
+
+
+def phase(method):
+    """Runs a method of a builder with a profile attribute as a phase named after it"""
+
+    @functools.wraps(method)
+    def profiled(self, *args, **kwargs):
+        with self.profile.phase(method.__name__):
+            return method(self, *args, **kwargs)
+
+    return profiled
+
+
+def sample_phase(method):
+    """Same as phase, for a method taking the sample as first argument, also counted for the sample"""
+
+    @functools.wraps(method)
+    def profiled(self, sample, *args, **kwargs):
+        with self.profile.phase(method.__name__, sample.name):
+            return method(self, sample, *args, **kwargs)
+
+    return profiled
+
+
+class ProfileAggregate:
+    """Sums the profiles of the projects built by the workers of masterProcess"""
+
+    def __init__(self):
+        self.phases = {}
+        self.projects = {}
+
+    def add(self, profile):
+        """:param dict profile: BuildProfile.as_dict() of a project"""
+        for name, counters in profile["phases"].items():
+            _add(self.phases.setdefault(name, {}), counters)
+        self.projects[profile["project"]] = profile["seconds"]
+
+    def format(self, top=10):
+        slowest = sorted(self.projects.items(), key=lambda x: x[1], reverse=True)
+        return "{} projects\nphases: {}\nslowest projects: {}".format(
+            len(self.projects),
+            format_phases(self.phases),
+            ", ".join(
+                "{} {:.3f}s".format(pid, seconds) for pid, seconds in slowest[:top]
+            ),
+        )
@@ -0,0 +1,172 @@
+"""Record and replay of the LIMS queries of a build"""
+
+import gzip
+import pickle
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# disables the psycopg2 connection setup that needs a real connection
+REPLAY_ENGINE_OPTIONS = {"use_native_hstore": False, "use_native_uuid": False}
+
+
+class QueryNotRecorded(Exception):
+    pass
+
+
+def _key(statement, parameters):
+    return (statement, repr(parameters))
+
+
+class QueryRecording:
+    """Result rows of the statements of a build
+    :param str what: what is built, e.g. "project P12345"
+    """
+
+    def __init__(self, what=None):
+        self.what = what
+        self.date = datetime.now()
+        # statement and parameters: description and rows of each of their executions
+        self.results = {}
+        self.statements = 0
+        # document built from these results
+        self.obj = None
+
+    def add(self, statement, parameters, description, rows):
+        self.statements += 1
+        self.results.setdefault(_key(statement, parameters), []).append(
+            (description, rows)
+        )
+
+    def save(self, path):
+        with gzip.open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, "rb") as f:
+            return pickle.load(f)
+
+
+def _recording_cursor(recording):
+    from psycopg2.extensions import cursor
+
+    class RecordingCursor(cursor):
+        def execute(self, query, vars=None):
+            super().execute(query, vars)
+            if self.description is None:
+                rows = None
+            else:
+                rows = self.fetchall()
+                # the result is buffered client side, the caller fetches it again
+                if rows:
+                    self.scroll(0, mode="absolute")
+            description = (
+                [tuple(column) for column in self.description]
+                if self.description is not None
+                else None
+            )
+            recording.add(query, vars, description, rows)
+
+    return RecordingCursor
+
+
+def recording_session(recording, url=None):
+    """Session on the LIMS database recording the results of its statements.
+    Only this session is recorded, the projects are built with sample_workers=1.
+    :param QueryRecording recording: where the results are kept
+    :param url: database url, the one of the genologics_sql configuration by default
+    """
+    if url is None:
+        from genologics_sql.utils import get_engine
+
+        url = get_engine().url
+    engine = create_engine(
+        url, connect_args={"cursor_factory": _recording_cursor(recording)}
+    )
+    return sessionmaker(bind=engine)()
+
+
+class ReplayCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rowcount = -1
+        self.rows = []
+        self.position = 0
+        self.arraysize = 1
+
+    def execute(self, statement, parameters=None):
+        key = _key(statement, parameters)
+        results = self.connection.recording.results.get(key)
+        if not results:
+            raise QueryNotRecorded(
+                "{} with {}".format(" ".join(statement.split()), parameters)
+            )
+        # the executions of a statement are served in order, the last one is repeated
+        served = self.connection.served.get(key, 0)
+        self.connection.served[key] = served + 1
+        self.description, rows = results[min(served, len(results) - 1)]
+        self.rows = rows or []
+        self.rowcount = len(self.rows) if rows is not None else -1
+        self.position = 0
+
+    def executemany(self, statement, seq_of_parameters):
+        for parameters in seq_of_parameters:
+            self.execute(statement, parameters)
+
+    def fetchone(self):
+        if self.position >= len(self.rows):
+            return None
+        self.position += 1
+        return self.rows[self.position - 1]
+
+    def fetchmany(self, size=None):
+        size = size or self.arraysize
+        rows = self.rows[self.position : self.position + size]
+        self.position += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.rows[self.position :]
+        self.position = len(self.rows)
+        return rows
+
+    def close(self):
+        pass
+
+
+class ReplayConnection:
+    def __init__(self, recording, served):
+        self.recording = recording
+        # number of executions served per statement
+        self.served = served
+        self.autocommit = False
+        self.closed = False
+        self.notices = []
+
+    def cursor(self, *args, **kwargs):
+        return ReplayCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def replay_session(recording):
+    """Session serving the recorded results, without a database
+    :param QueryRecording recording: recorded results, see QueryRecording.load
+    """
+    served = {}
+    engine = create_engine(
+        "postgresql+psycopg2://",
+        creator=lambda: ReplayConnection(recording, served),
+        **REPLAY_ENGINE_OPTIONS
+    )
+    return sessionmaker(bind=engine)()
@@ -0,0 +1,61 @@
+"""Process wide cache of the LIMS researchers, looked up by principalid"""
+
+import time
+from collections import namedtuple
+
+from LIMS2DB import statements
+
+CachedResearcher = namedtuple(
+    "CachedResearcher", ["researcherid", "firstname", "lastname", "email", "initials"]
+)
+
+
+class ResearcherCache:
+    """principalid -> CachedResearcher
+    :param int ttl: seconds after which the cache is loaded again
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.researchers = {}
+        self.loaded_at = None
+
+    def load(self, session):
+        self.researchers = {
+            row[0]: CachedResearcher(*row[1:])
+            for row in statements.fetch_rows(session, "principal_researchers")
+        }
+        self.loaded_at = time.monotonic()
+
+    def get(self, session, principalid):
+        """Returns the researcher of a principal, or None if there is none
+        :param session: genologics_sql session
+        :param int principalid: e.g. the ownerid of a process or an escalation
+        """
+        if principalid is None:
+            return None
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+            self.load(session)
+        if principalid not in self.researchers:
+            row = statements.fetch_rows(
+                session, "principal_researcher", pid=principalid
+            )
+            self.researchers[principalid] = (
+                CachedResearcher(*row[0][1:]) if row else None
+            )
+        return self.researchers[principalid]
+
+    def clear(self):
+        self.researchers = {}
+        self.loaded_at = None
+
+
+RESEARCHERS = ResearcherCache()
+
+
+def get_researcher(session, principalid):
+    """Researcher of a principal from the process wide cache, or None
+    :param session: genologics_sql session
+    :param int principalid: e.g. the ownerid of a process or an escalation
+    """
+    return RESEARCHERS.get(session, principalid)
@@ -0,0 +1,162 @@
+"""Opt-in log of the slow LIMS queries"""
+
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds of the latency buckets, in seconds
+BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0, float("inf"))
+BUCKET_LABELS = ("<1ms", "<10ms", "<100ms", "<1s", "<10s", ">=10s")
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+# psycopg2 and prepared statement placeholders, and :name but not the :: casts
+_PARAM_RE = re.compile(r"%\(\w+\)s|%s|\$\d+|(?<!:):\w+")
+_NUMBER_RE = re.compile(r"(?<![\w$.])-?\d+(?:\.\d+)?\b")
+_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_ARRAY_RE = re.compile(r"\[\s*\?(?:\s*,\s*\?)+\s*\]")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    """Statement text without its values, so that all the calls of a query share it
+    :param str statement: SQL as sent to the database
+    """
+    sql = _STRING_RE.sub("?", statement)
+    sql = _PARAM_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    # lists of any length
+    sql = _LIST_RE.sub("(?)", sql)
+    sql = _ARRAY_RE.sub("[?]", sql)
+    return _SPACE_RE.sub(" ", sql).strip().lower()
+
+
+class FingerprintStats:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = [0] * len(BUCKETS)
+
+    def add(self, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds < bound:
+                self.histogram[i] += 1
+                break
+
+    def format_histogram(self):
+        return " ".join(
+            "{}:{}".format(label, count)
+            for label, count in zip(BUCKET_LABELS, self.histogram)
+            if count
+        )
+
+
+class SlowQueryLog:
+    """Times the statements run by the engines
+    :param log: logger of the slow statements
+    :param float threshold: seconds above which a statement is logged
+    """
+
+    def __init__(self, log, threshold=1.0):
+        self.log = log
+        self.threshold = threshold
+        self.stats = {}
+        # project or workset being built
+        self.context = None
+        self.lock = threading.Lock()
+
+    def attach(self, target=Engine):
+        """:param target: an engine, all of them by default"""
+        event.listen(target, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(target, "after_cursor_execute", self.after_cursor_execute)
+
+    def detach(self, target=Engine):
+        event.remove(target, "before_cursor_execute", self.before_cursor_execute)
+        event.remove(target, "after_cursor_execute", self.after_cursor_execute)
+
+    def before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        started = conn.info.get("slow_query_start")
+        if not started:
+            return
+        seconds = time.perf_counter() - started.pop()
+        with self.lock:
+            self.stats.setdefault(fingerprint(statement), FingerprintStats()).add(
+                seconds
+            )
+        if seconds > self.threshold:
+            self.log.warning(
+                "Slow query ({:.3f}s) while building {}: {} with {}".format(
+                    seconds,
+                    self.context,
+                    " ".join(statement.split()),
+                    str(parameters)[:200],
+                )
+            )
+
+    @contextmanager
+    def building(self, what):
+        previous = self.context
+        self.context = what
+        try:
+            yield
+        finally:
+            self.context = previous
+
+    def report(self, top=20):
+        """The fingerprints taking the most time, with their latency histograms"""
+        slowest = sorted(self.stats.items(), key=lambda x: x[1].seconds, reverse=True)
+        return "\n".join(
+            "{:.3f}s {} calls, max {:.3f}s [{}] {}".format(
+                stats.seconds,
+                stats.calls,
+                stats.max_seconds,
+                stats.format_histogram(),
+                key,
+            )
+            for key, stats in slowest[:top]
+        )
+
+
+QUERY_LOG = None
+
+
+def enable(log, threshold=1.0):
+    """Starts timing the statements of all the engines of the current process
+    :param log: logger of the slow statements
+    :param float threshold: seconds above which a statement is logged
+    """
+    global QUERY_LOG
+    if QUERY_LOG is None:
+        QUERY_LOG = SlowQueryLog(log, threshold)
+        QUERY_LOG.attach()
+    return QUERY_LOG
+
+
+@contextmanager
+def building(what):
+    """Names what the statements run in the block are building, does nothing unless enabled
+    :param str what: e.g. "project P12345"
+    """
+    if QUERY_LOG is None:
+        yield
+    else:
+        with QUERY_LOG.building(what):
+            yield
+
+
+def report(top=20):
+    return QUERY_LOG.report(top) if QUERY_LOG is not None else ""
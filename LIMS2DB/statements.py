@@ -0,0 +1,584 @@
+"""Registry of the named, parameterized SQL statements used by the builders"""
+
+import re
+import time
+
+from sqlalchemy import bindparam, text
+
+STATEMENTS = {}
+SERVER_SIDE_PREPARE = False
+
+_BIND_RE = re.compile(r"(?<![:\w]):(\w+)")
+
+
+class Statement:
+    def __init__(self, name, sql, expanding=()):
+        self.name = name
+        self.sql = " ".join(sql.split())
+        self.expanding = tuple(expanding)
+        self.clause = text(self.sql)
+        if self.expanding:
+            self.clause = self.clause.bindparams(
+                *[bindparam(param, expanding=True) for param in self.expanding]
+            )
+        self.calls = 0
+        self.seconds = 0.0
+        self.prepare_clause = None
+        self.execute_clause = None
+        self.positional = []
+
+    def build_prepared(self):
+        """Builds the PREPARE and EXECUTE statements, expanding lists become arrays"""
+        sql = self.sql
+        for param in self.expanding:
+            sql = re.sub(
+                r"\bin\s+:{}\b".format(param),
+                "= any(:{})".format(param),
+                sql,
+                flags=re.IGNORECASE,
+            )
+        positional = []
+
+        def to_positional(match):
+            if match.group(1) not in positional:
+                positional.append(match.group(1))
+            return "${}".format(positional.index(match.group(1)) + 1)
+
+        sql = _BIND_RE.sub(to_positional, sql).rstrip(";")
+        self.positional = positional
+        self.prepare_clause = text(
+            "PREPARE lims2db_{name} AS {sql}".format(name=self.name, sql=sql)
+        )
+        self.execute_clause = text(
+            "EXECUTE lims2db_{name}{args}".format(
+                name=self.name,
+                args=(
+                    "({})".format(", ".join(":{}".format(p) for p in positional))
+                    if positional
+                    else ""
+                ),
+            )
+        )
+
+    def bind(self, session, params):
+        """Returns the clause to run and its parameters, preparing the statement on the connection if needed"""
+        if not SERVER_SIDE_PREPARE:
+            return self.clause, params
+        if self.prepare_clause is None:
+            self.build_prepared()
+        connection = session.connection()
+        prepared = connection.info.setdefault("lims2db_prepared", set())
+        if self.name not in prepared:
+            connection.execute(self.prepare_clause)
+            prepared.add(self.name)
+        return self.execute_clause, {
+            param: list(value) if param in self.expanding else value
+            for param, value in params.items()
+        }
+
+    def timed(self, func):
+        start = time.perf_counter()
+        try:
+            return func()
+        finally:
+            self.calls += 1
+            self.seconds += time.perf_counter() - start
+
+
+def register(name, sql, expanding=()):
+    """Declares a statement.
+    :param str name: unique name, also used for the server side prepared statement
+    :param str sql: statement with :named parameters
+    :param expanding: names of the parameters that are lists, written `column in :param`
+    """
+    if name in STATEMENTS:
+        raise ValueError("Statement {} is already registered".format(name))
+    STATEMENTS[name] = Statement(name, sql, expanding)
+
+
+def register_descending(name, sql, column, expanding=()):
+    """Declares a statement restricting column to the descendants of an artifact.
+    The {descends} placeholder of sql becomes an artifact_ancestor_map lookup of :ancestor for name,
+    and a :descendants list for name_indexed, to use with a local AncestorIndex.
+    :param str name: unique name
+    :param str sql: statement with :named parameters and a {descends} placeholder
+    :param str column: qualified column holding the artifactid, e.g. piot.inputartifactid
+    :param expanding: names of the other parameters that are lists
+    """
+    register(
+        name,
+        sql.format(
+            descends="{col} in (select aam.artifactid from artifact_ancestor_map aam \
+                where aam.ancestorartifactid = :ancestor)".format(col=column)
+        ),
+        expanding,
+    )
+    register(
+        "{}_indexed".format(name),
+        sql.format(descends="{col} in :descendants".format(col=column)),
+        tuple(expanding) + ("descendants",),
+    )
+
+
+def descending(name, ancestorid, index=None):
+    """Returns the statement name and parameters to use for a statement declared with register_descending
+    :param str name: name given to register_descending
+    :param int ancestorid: artifactid of the ancestor
+    :param AncestorIndex index: optional local index of the ancestry
+    """
+    if index is None:
+        return name, {"ancestor": ancestorid}
+    return "{}_indexed".format(name), {
+        "descendants": index.descendants(int(ancestorid))
+    }
+
+
+def typeids(*categories):
+    """Sorted integer typeids of one or more process_categories dicts or lists"""
+    return sorted(set(int(typeid) for category in categories for typeid in category))
+
+
+def use_server_side_prepare(enabled=True):
+    global SERVER_SIDE_PREPARE
+    SERVER_SIDE_PREPARE = enabled
+
+
+def fetch_all(session, entity, name, **params):
+    """Runs a statement and returns all the results mapped to entity"""
+    stmt = STATEMENTS[name]
+    clause, params = stmt.bind(session, params)
+    return stmt.timed(
+        lambda: session.query(entity).from_statement(clause).params(**params).all()
+    )
+
+
+def fetch_first(session, entity, name, **params):
+    """Runs a statement and returns the first result mapped to entity, or None"""
+    stmt = STATEMENTS[name]
+    clause, params = stmt.bind(session, params)
+    return stmt.timed(
+        lambda: session.query(entity).from_statement(clause).params(**params).first()
+    )
+
+
+def fetch_one(session, entity, name, **params):
+    """Runs a statement and returns its only result mapped to entity.
+    Raises NoResultFound or MultipleResultsFound otherwise."""
+    stmt = STATEMENTS[name]
+    clause, params = stmt.bind(session, params)
+    return stmt.timed(
+        lambda: session.query(entity).from_statement(clause).params(**params).one()
+    )
+
+
+def fetch_scalar(session, entity, name, **params):
+    """Runs a statement and returns the first column of its only result, or None"""
+    stmt = STATEMENTS[name]
+    clause, params = stmt.bind(session, params)
+    return stmt.timed(
+        lambda: session.query(entity).from_statement(clause).params(**params).scalar()
+    )
+
+
+def fetch_rows(session, name, **params):
+    """Runs a statement and returns the raw rows"""
+    stmt = STATEMENTS[name]
+    clause, params = stmt.bind(session, params)
+    return stmt.timed(lambda: session.execute(clause, params).fetchall())
+
+
+def stats():
+    """Returns (name, calls, cumulated seconds) of the statements run by this process, slowest first"""
+    return sorted(
+        ((s.name, s.calls, s.seconds) for s in STATEMENTS.values() if s.calls),
+        key=lambda x: x[2],
+        reverse=True,
+    )
+
+
+def format_stats():
+    return "\n".join(
+        "{name}: {calls} calls, {seconds:.3f}s".format(
+            name=name, calls=calls, seconds=seconds
+        )
+        for name, calls, seconds in stats()
+    )
+
+
+def reset_stats():
+    for stmt in STATEMENTS.values():
+        stmt.calls = 0
+        stmt.seconds = 0.0
+
+
+# Workset_SQL
+register(
+    "workset_container",
+    "select distinct co.* from processiotracker pio \
+    inner join outputmapping om on om.trackerid=pio.trackerid \
+    inner join containerplacement cp on cp.processartifactid=om.outputartifactid \
+    inner join container co on cp.containerid=co.containerid \
+    where pio.processid = :processid;",
+)
+register(
+    "process_inputs",
+    "select art.* from artifact art \
+    inner join processiotracker piot on piot.inputartifactid=art.artifactid \
+    where piot.processid = :processid",
+)
+register(
+    "workset_outputs",
+    "select art.* from artifact art \
+    inner join outputmapping om on om.outputartifactid=art.artifactid \
+    inner join processiotracker piot on piot.trackerid=om.trackerid \
+    where piot.inputartifactid=:inputid and art.artifacttypeid=2 and piot.processid=:processid;",
+)
+register_descending(
+    "processes_using_descendants",
+    "select pc.* from process pc \
+    inner join processiotracker piot on piot.processid=pc.processid \
+    where pc.typeid in :typeids and {descends} order by daterun;",
+    "piot.inputartifactid",
+    expanding=("typeids",),
+)
+register_descending(
+    "process_inputs_descending",
+    "select art.* from artifact art \
+    inner join processiotracker piot on piot.inputartifactid=art.artifactid \
+    where piot.processid=:processid and {descends};",
+    "art.artifactid",
+)
+
+# ProjectSQL
+register(
+    "project_summaries",
+    "select distinct pr.* from process pr \
+    inner join processiotracker piot on piot.processid=pr.processid \
+    inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.projectid = :projectid and pr.typeid = :typeid order by createddate desc;",
+)
+register(
+    "project_escalations",
+    "select distinct esc.* from escalationevent esc \
+    inner join processiotracker piot on piot.processid=esc.processid \
+    inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where esc.reviewdate is NULL and sa.projectid = :projectid;",
+)
+# the parts of the samples checked by genologics_sql.queries.get_last_modified_projectids
+register(
+    "project_modified_samples",
+    "select sa.processid from sample sa \
+    inner join processudfstorage pus on pus.processid=sa.processid \
+    where sa.projectid = :projectid and pus.lastmodifieddate > :since \
+    union select asm.processid from artifact_sample_map asm \
+    inner join sample sa on sa.processid=asm.processid \
+    inner join artifact art on art.artifactid=asm.artifactid \
+    where sa.projectid = :projectid and art.lastmodifieddate > :since \
+    union select asm.processid from artifact_sample_map asm \
+    inner join sample sa on sa.processid=asm.processid \
+    inner join artifactudfstorage aus on aus.artifactid=asm.artifactid \
+    where sa.projectid = :projectid and aus.lastmodifieddate > :since \
+    union select asm.processid from artifact_sample_map asm \
+    inner join sample sa on sa.processid=asm.processid \
+    inner join containerplacement cpl on cpl.processartifactid=asm.artifactid \
+    inner join container ct on ct.containerid=cpl.containerid \
+    where sa.projectid = :projectid and ct.lastmodifieddate > :since \
+    union select asm.processid from artifact_sample_map asm \
+    inner join sample sa on sa.processid=asm.processid \
+    inner join processiotracker piot on piot.inputartifactid=asm.artifactid \
+    inner join process pr on pr.processid=piot.processid \
+    where sa.projectid = :projectid and pr.lastmodifieddate > :since \
+    union select asm.processid from artifact_sample_map asm \
+    inner join sample sa on sa.processid=asm.processid \
+    inner join processiotracker piot on piot.inputartifactid=asm.artifactid \
+    inner join processudfstorage pus on pus.processid=piot.processid \
+    where sa.projectid = :projectid and pus.lastmodifieddate > :since;",
+)
+register(
+    "project_initial_artifacts",
+    "select sa.processid, art.artifactid from artifact art \
+    inner join artifact_sample_map asm on asm.artifactid=art.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.projectid = :projectid and art.isoriginal=True",
+)
+register(
+    "project_sample_processes",
+    "select sa.processid, pr.processid from process pr \
+    inner join processiotracker piot on piot.processid=pr.processid \
+    inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.projectid = :projectid and pr.typeid in :typeids \
+    order by pr.daterun;",
+    expanding=("typeids",),
+)
+register(
+    "project_sample_processes_desc",
+    "select sa.processid, pr.processid from process pr \
+    inner join processiotracker piot on piot.processid=pr.processid \
+    inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.projectid = :projectid and pr.typeid in :typeids \
+    order by pr.daterun desc;",
+    expanding=("typeids",),
+)
+register(
+    "project_result_files",
+    "select sa.processid, art2.artifactid as inputid, art2.isoriginal, pr.typeid, \
+    gf.fileid, gf.contenturi, art.name from glsfile gf \
+    inner join resultfile rf on rf.glsfileid=gf.fileid \
+    inner join artifact art on rf.artifactid=art.artifactid \
+    inner join outputmapping om on art.artifactid=om.outputartifactid \
+    inner join processiotracker piot on piot.trackerid=om.trackerid \
+    inner join artifact art2 on piot.inputartifactid=art2.artifactid \
+    inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
+    inner join process pr on piot.processid=pr.processid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.projectid = :projectid and pr.typeid in :typeids \
+    and (art.name like '%Fragment Analyzer%' or art.name like '%CaliperGX%') \
+    order by pr.daterun desc;",
+    expanding=("typeids",),
+)
+register(
+    "project_omnic_result_files",
+    "select sa.processid, gf.fileid, gf.contenturi, art.name from glsfile gf \
+    inner join resultfile rf on rf.glsfileid=gf.fileid \
+    inner join artifact art on rf.artifactid=art.artifactid \
+    inner join outputmapping om on art.artifactid=om.outputartifactid \
+    inner join processiotracker piot on piot.trackerid=om.trackerid \
+    inner join artifact art2 on piot.inputartifactid=art2.artifactid \
+    inner join artifact_sample_map asm on art2.artifactid=asm.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    inner join process pr on piot.processid=pr.processid \
+    inner join processtype pt on pt.typeid=pr.typeid \
+    inner join protocolstep ps on ps.processtypeid=pt.typeid \
+    inner join labprotocol lp on lp.protocolid=ps.protocolid \
+    where sa.projectid = :projectid and art.name like :pattern and pr.typeid in :typeids and lp.protocolname='Tissue and Lysate QC' \
+    order by pr.daterun desc;",
+    expanding=("typeids",),
+)
+register(
+    "sample_processes",
+    "select pr.* from process pr \
+    inner join processiotracker piot on piot.processid=pr.processid \
+    inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.processid = :sampleid and pr.typeid in :typeids \
+    order by pr.daterun;",
+    expanding=("typeids",),
+)
+register(
+    "sample_process_outputs",
+    "select art.* from artifact art \
+    inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
+    inner join outputmapping om  on om.outputartifactid=art.artifactid \
+    inner join processiotracker piot on piot.trackerid=om.trackerid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.processid = :sampleid and piot.processid = :processid and art.artifacttypeid = 2",
+)
+register(
+    "sample_process_inputs",
+    "select art.* from artifact art \
+    inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
+    inner join processiotracker piot on piot.inputartifactid=art.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.processid = :sampleid and piot.processid = :processid",
+)
+register_descending(
+    "sample_process_inputs_descending",
+    "select art.* from artifact art \
+    inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
+    inner join processiotracker piot on piot.inputartifactid=art.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.processid = :sampleid \
+    and piot.processid = :processid \
+    and {descends}",
+    "art.artifactid",
+)
+register(
+    "sample_original_artifact",
+    "select art.* from artifact art \
+    inner join artifact_sample_map asm on asm.artifactid=art.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.processid = :sampleid and art.isoriginal=True",
+)
+register_descending(
+    "distinct_processes_using_descendants",
+    "select distinct pro.* from process pro \
+    inner join processiotracker piot on piot.processid = pro.processid \
+    where pro.typeid in :typeids and {descends}",
+    "piot.inputartifactid",
+    expanding=("typeids",),
+)
+register(
+    "processes_using_artifact",
+    "select pr.* from process pr \
+    inner join processiotracker piot on piot.processid=pr.processid \
+    where pr.typeid in :typeids and piot.inputartifactid=:artifactid \
+    order by pr.daterun;",
+    expanding=("typeids",),
+)
+register(
+    "sample_artifacts_named",
+    "select art.* from artifact art \
+    inner join artifact_sample_map asm on art.artifactid=asm.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.processid=:sampleid and art.name like :pattern;",
+)
+register(
+    "sample_result_outputs_named",
+    "select art.* from artifact art \
+    inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
+    inner join outputmapping om on art.artifactid=om.outputartifactid \
+    inner join processiotracker piot on piot.trackerid=om.trackerid \
+    inner join sample sa on sa.processid=asm.processid \
+    where art.artifacttypeid = 1 \
+    and art.name like :pattern \
+    and sa.processid = :sampleid \
+    and piot.processid = :processid \
+    and piot.inputartifactid = :inputid",
+)
+register_descending(
+    "sample_result_outputs_named_descending",
+    "select art.* from artifact art \
+    inner join artifact_sample_map asm on  art.artifactid=asm.artifactid \
+    inner join outputmapping om on art.artifactid=om.outputartifactid \
+    inner join processiotracker piot on piot.trackerid=om.trackerid \
+    inner join sample sa on sa.processid=asm.processid \
+    where art.artifacttypeid = 1 \
+    and art.name like :pattern \
+    and sa.processid = :sampleid \
+    and piot.processid = :processid \
+    and {descends};",
+    "art.artifactid",
+)
+
+# project_summary_upload_LIMS
+register(
+    "projects_portal_ids",
+    "select pj.name, eudf.udfvalue from project pj \
+    inner join entity_udf_view eudf on eudf.attachtoid=pj.projectid \
+    where eudf.attachtoclassid = 83 and eudf.udfname = 'Portal ID' \
+    and pj.name in :names;",
+    expanding=("names",),
+)
+
+# researchers
+register(
+    "principal_researchers",
+    "select pr.principalid, r.researcherid, r.firstname, r.lastname, r.email, r.initials \
+    from principals pr \
+    inner join researcher r on r.researcherid=pr.researcherid;",
+)
+register(
+    "principal_researcher",
+    "select pr.principalid, r.researcherid, r.firstname, r.lastname, r.email, r.initials \
+    from principals pr \
+    inner join researcher r on r.researcherid=pr.researcherid \
+    where pr.principalid=:pid;",
+)
+
+# lineage
+register(
+    "lineage_children",
+    "select distinct piot2.processid, asm.processid, pro.processid from process pro \
+    inner join processiotracker piot on piot.processid=pro.processid \
+    inner join artifact_ancestor_map aam on piot.inputartifactid=aam.artifactid \
+    inner join processiotracker piot2 on piot2.inputartifactid=aam.ancestorartifactid \
+    inner join process pr2 on pr2.processid=piot2.processid \
+    inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.projectid = :projectid and pr2.typeid in :parents and pro.typeid in :typeids;",
+    expanding=("parents", "typeids"),
+)
+register(
+    "lineage_history",
+    "select distinct piot2.processid, asm.processid, pro.processid from process pro \
+    inner join processiotracker piot on piot.processid=pro.processid \
+    inner join artifact_ancestor_map aam on piot.inputartifactid=aam.ancestorartifactid \
+    inner join processiotracker piot2 on piot2.inputartifactid=aam.artifactid \
+    inner join process pr2 on pr2.processid=piot2.processid \
+    inner join artifact_sample_map asm on piot.inputartifactid=asm.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.projectid = :projectid and pr2.typeid in :parents and pro.typeid in :typeids;",
+    expanding=("parents", "typeids"),
+)
+register(
+    "processes_by_id",
+    "select pr.* from process pr where pr.processid in :processids",
+    expanding=("processids",),
+)
+register(
+    "graph_project_samples",
+    "select asm.artifactid, asm.processid from artifact_sample_map asm \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.projectid = :projectid",
+)
+register(
+    "graph_project_processes",
+    "select distinct piot.processid from processiotracker piot \
+    inner join artifact_sample_map asm on asm.artifactid=piot.inputartifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.projectid = :projectid",
+)
+register(
+    "graph_project_ancestry",
+    "select aam.artifactid, aam.ancestorartifactid from artifact_ancestor_map aam \
+    inner join artifact_sample_map asm on asm.artifactid=aam.artifactid \
+    inner join sample sa on sa.processid=asm.processid \
+    where sa.projectid = :projectid",
+)
+register(
+    "graph_inputs",
+    "select piot.trackerid, piot.processid, piot.inputartifactid from processiotracker piot \
+    where piot.processid in :processids",
+    expanding=("processids",),
+)
+register(
+    "graph_outputs",
+    "select om.trackerid, om.outputartifactid from outputmapping om \
+    inner join processiotracker piot on piot.trackerid=om.trackerid \
+    where piot.processid in :processids",
+    expanding=("processids",),
+)
+register(
+    "graph_descendants",
+    "select aam.artifactid, aam.ancestorartifactid from artifact_ancestor_map aam \
+    where aam.ancestorartifactid in :artifactids",
+    expanding=("artifactids",),
+)
+register(
+    "graph_consumers",
+    "select distinct piot.processid from processiotracker piot \
+    where piot.inputartifactid in :artifactids",
+    expanding=("artifactids",),
+)
+register(
+    "graph_artifact_samples",
+    "select asm.artifactid, asm.processid from artifact_sample_map asm \
+    where asm.artifactid in :artifactids",
+    expanding=("artifactids",),
+)
+
+# flowcell_sql
+register(
+    "flowcell_container",
+    "select distinct ct.* from container ct \
+    inner join containerplacement cp on cp.containerid=ct.containerid \
+    inner join processiotracker piot on piot.inputartifactid=cp.processartifactid \
+    where piot.processid = :processid;",
+)
+register(
+    "flowcell_lane_outputs",
+    "select art.* from artifact art \
+    inner join outputmapping omap on omap.outputartifactid=art.artifactid \
+    inner join processiotracker piot on piot.trackerid=omap.trackerid \
+    where art.name LIKE 'Lane%' and piot.processid = :processid;",
+)
+register(
+    "process_distinct_inputs",
+    "select distinct art.* from artifact art \
+    inner join processiotracker piot on piot.inputartifactid=art.artifactid \
+    where piot.processid = :processid;",
+)
@@ -2,26 +2,137 @@ import logging
 import logging.handlers
 import traceback
 import couchdb
+import re
 from email.mime.text import MIMEText
+from functools import lru_cache
 import smtplib
 
+# policies of the values found in both documents merged
+PREFER_NEW = "new"
+PREFER_OLD = "old"
+UNION = "union"
+
+
+class _Policies(dict):
+    # policy of the path, None to keep the one of the parent path
+    policy = None
+
+
+_NO_POLICIES = _Policies()
+
+
+class MergeEngine:
+    """Merges a new document with an old one, walking them iteratively.
+    The dicts found in both documents are merged key by key, the keys of only one of them are kept.
+    For the other values found in both, the policy of their path decides : PREFER_NEW keeps the new
+    value, PREFER_OLD the old one, and UNION appends the items of a new list missing from the old one,
+    keeping the new value if they are not lists.
+    Neither document is modified : the merged document is made of new dicts along the paths where the
+    documents differ, and shares all the other values with them.
+    :param dict policies: policy by path, a tuple of keys in which "*" matches any key,
+        applying to the whole subtree of the path
+    :param str default: policy of the paths without one
+    """
+
+    def __init__(self, policies=None, default=PREFER_NEW):
+        self.policies = _Policies()
+        self.policies.policy = default
+        for path, policy in (policies or {}).items():
+            node = self.policies
+            for key in path:
+                node = node.setdefault(key, _Policies())
+            node.policy = policy
+
+    def merge(self, new, old):
+        """
+        :returns: (merged document, paths whose merged value is not the old one)
+        """
+        merged = {}
+        changed = []
+        # dicts to merge, the merged dict they fill, their path, their policies
+        stack = [(new, old, merged, (), self.policies, self.policies.policy)]
+        while stack:
+            d_new, d_old, d_merged, path, policies, policy = stack.pop()
+            for key, v_new in d_new.items():
+                if key not in d_old:
+                    d_merged[key] = v_new
+                    changed.append(path + (key,))
+                    continue
+                v_old = d_old[key]
+                # equal subtrees are compared in C, without walking them
+                if v_new == v_old:
+                    d_merged[key] = v_new
+                    continue
+                sub_policies = policies.get(key)
+                if sub_policies is None:
+                    sub_policies = policies.get("*", _NO_POLICIES)
+                sub_policy = sub_policies.policy or policy
+                if isinstance(v_new, dict) and isinstance(v_old, dict):
+                    d_merged[key] = {}
+                    stack.append(
+                        (
+                            v_new,
+                            v_old,
+                            d_merged[key],
+                            path + (key,),
+                            sub_policies,
+                            sub_policy,
+                        )
+                    )
+                    continue
+                value = self.resolve(v_new, v_old, sub_policy)
+                d_merged[key] = value
+                if value is not v_old:
+                    changed.append(path + (key,))
+            for key, v_old in d_old.items():
+                if key not in d_new:
+                    d_merged[key] = v_old
+        return merged, changed
+
+    @staticmethod
+    def resolve(v_new, v_old, policy):
+        """Merged value of different values that are not both dicts"""
+        if policy == PREFER_OLD:
+            return v_old
+        if policy == UNION and isinstance(v_new, list) and isinstance(v_old, list):
+            added = [item for item in v_new if item not in v_old]
+            return v_old + added if added else v_old
+        return v_new
+
+
+DEFAULT_MERGE = MergeEngine()
+
 
 # merges d2 in d1, keeps values from d1
 def merge(d1, d2):
     """Will merge dictionary d2 into dictionary d1.
     On the case of finding the same key, the one in d1 will be used.
+    The dictionaries are not modified, the merged one shares their values.
     :param d1: Dictionary object
     :param s2: Dictionary object
     """
-    for key in d2:
-        if key in d1:
-            if isinstance(d1[key], dict) and isinstance(d2[key], dict):
-                merge(d1[key], d2[key])
-            elif d1[key] == d2[key]:
-                pass  # same leaf value
-        else:
-            d1[key] = d2[key]
-    return d1
+    return DEFAULT_MERGE.merge(d1, d2)[0]
+
+
+@lru_cache(maxsize=4096)
+def _compile_like(pattern):
+    regex = "".join(
+        ".*" if char == "%" else "." if char == "_" else re.escape(char)
+        for char in pattern
+    )
+    return re.compile(regex, re.DOTALL)
+
+
+def like_match(pattern, value):
+    """Matches value against a SQL LIKE pattern, the way postgres does it :
+    case sensitive, % for any string, _ for any single character.
+    Used to filter in python rows that were fetched with a broader query.
+    :param str pattern: LIKE pattern
+    :param str value: string to test
+    """
+    if value is None:
+        return False
+    return _compile_like(pattern).fullmatch(value) is not None
 
 
 def setupLog(name, logfile):
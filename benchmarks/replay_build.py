@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Records the LIMS queries of the build of a project, workset or flowcell, and replays them offline.
+
+    replay_build.py record --project P12345 P12345.rec.gz
+    replay_build.py replay P12345.rec.gz --repeat 5
+
+The recording holds the result rows of every statement of the build and the document it built. The
+replay builds the document again from these results, without a database, times the builds and checks
+that they give the recorded document.
+"""
+
+import logging
+import sys
+import time
+from argparse import ArgumentParser
+
+from genologics_sql.tables import Process
+
+from LIMS2DB.classes import ProjectSQL, Workset_SQL
+from LIMS2DB.diff import diff_objects
+from LIMS2DB.flowcell_sql import create_lims_data_obj
+from LIMS2DB.replay import QueryRecording, recording_session, replay_session
+
+
+def build(session, log, what, ident):
+    """The document of the project, or of the workset or flowcell step, with the given luid"""
+    if what == "project":
+        return ProjectSQL(session, log, ident).obj
+    step = session.query(Process).filter_by(luid=ident).one()
+    if what == "workset":
+        return Workset_SQL(session, log, step).obj
+    return create_lims_data_obj(session, step)
+
+
+def record(args, log):
+    what, ident = next(
+        (what, getattr(args, what))
+        for what in ("project", "workset", "flowcell")
+        if getattr(args, what)
+    )
+    recording = QueryRecording("{} {}".format(what, ident))
+    session = recording_session(recording, args.url)
+    recording.obj = build(session, log, what, ident)
+    session.close()
+    recording.save(args.file)
+    log.info(
+        "Recorded {} statements building {} in {}".format(
+            recording.statements, recording.what, args.file
+        )
+    )
+
+
+def replay(args, log):
+    recording = QueryRecording.load(args.file)
+    what, ident = recording.what.split(" ", 1)
+    status = 0
+    for _ in range(args.repeat):
+        session = replay_session(recording)
+        start = time.perf_counter()
+        obj = build(session, log, what, ident)
+        seconds = time.perf_counter() - start
+        session.close()
+        diffs = diff_objects(recording.obj, obj)
+        log.info(
+            "Built {} in {:.3f}s, {}".format(
+                recording.what,
+                seconds,
+                "{} differences".format(len(diffs)) if diffs else "identical",
+            )
+        )
+        for key, (recorded, built) in sorted(diffs.items()):
+            log.info("{}: recorded {!r}, built {!r}".format(key, recorded, built))
+        if diffs:
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="build and record the queries")
+    built = record_parser.add_mutually_exclusive_group(required=True)
+    built.add_argument("--project", help="project luid, e.g. P12345")
+    built.add_argument("--workset", help="luid of the workset setup step")
+    built.add_argument("--flowcell", help="luid of the sequencing step")
+    record_parser.add_argument(
+        "--url",
+        help="database url, the one of the genologics_sql configuration by default",
+    )
+    record_parser.add_argument("file", help="recording to write")
+
+    replay_parser = subparsers.add_parser(
+        "replay", help="build again from a recording and compare the documents"
+    )
+    replay_parser.add_argument("file", help="recording to read")
+    replay_parser.add_argument(
+        "--repeat", type=int, default=1, help="number of times the build is replayed"
+    )
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    log = logging.getLogger("replay")
+    if args.command == "record":
+        record(args, log)
+    else:
+        sys.exit(replay(args, log))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Times ProjectSQL, Workset_SQL and create_lims_data_obj end to end on a synthetic LIMS database.
+
+The database is generated by synthetic_lims.py at the requested scale, in sqlite by default or in any
+database sqlalchemy can reach with --url, e.g. a local postgres closer to production. The results are
+written as JSON, one record per builder with its timings and statement counts, along with the scale
+and the git revision, so that runs of different versions can be compared.
+"""
+
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+from genologics_sql.tables import Process
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from LIMS2DB.classes import ProjectSQL, Workset_SQL
+from LIMS2DB.flowcell_sql import create_lims_data_obj
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic_lims import SyntheticLims  # noqa: E402
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def after_cursor_execute(self, *args):
+        self.count += 1
+
+
+def git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+            )
+            .strip()
+            .decode("utf-8")
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_builder(session, counter, build, ids, repeat):
+    """Runs build(id) for every id, repeat times, in a fresh session state each time.
+    Returns the timings of the calls and the statements they ran.
+    """
+    seconds = []
+    errors = []
+    statements_before = counter.count
+    for _ in range(repeat):
+        for ident in ids:
+            session.expire_all()
+            start = time.perf_counter()
+            try:
+                build(ident)
+            except Exception as e:
+                errors.append("{}: {!r}".format(ident, e))
+                session.rollback()
+            seconds.append(time.perf_counter() - start)
+    calls = len(seconds)
+    return {
+        "calls": calls,
+        "errors": errors,
+        "seconds": sum(seconds),
+        "mean": sum(seconds) / calls if calls else None,
+        "min": min(seconds) if calls else None,
+        "max": max(seconds) if calls else None,
+        "statements": counter.count - statements_before,
+        "statements_per_call": (
+            (counter.count - statements_before) / calls if calls else None
+        ),
+    }
+
+
+def main(args):
+    log = logging.getLogger("benchmarks")
+    engine = create_engine(args.url)
+    lims = SyntheticLims(args.projects, args.samples, args.preps, args.runs).generate()
+    start = time.perf_counter()
+    lims.load(engine)
+    load_seconds = time.perf_counter() - start
+    session = sessionmaker(bind=engine)()
+    counter = StatementCounter(engine)
+    targets = lims.targets()
+
+    def process(processid):
+        return session.query(Process).filter(Process.processid == processid).one()
+
+    builders = {
+        "ProjectSQL": (
+            lambda luid: ProjectSQL(session, log, luid),
+            targets["projects"],
+        ),
+        "Workset_SQL": (
+            lambda processid: Workset_SQL(session, log, process(processid)),
+            targets["worksets"],
+        ),
+        "create_lims_data_obj": (
+            lambda processid: create_lims_data_obj(session, process(processid)),
+            targets["sequencing"],
+        ),
+    }
+    results = {}
+    for name, (build, ids) in builders.items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = time_builder(session, counter, build, ids, args.repeat)
+    session.close()
+
+    report = {
+        "date": datetime.now().isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "database": engine.dialect.name,
+        "scale": lims.scale,
+        "rows": {table: len(rows) for table, rows in sorted(lims.rows.items())},
+        "load_seconds": load_seconds,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--url",
+        default="sqlite:///lims_benchmark.sqlite",
+        help="sqlalchemy url of the database to generate, its LIMS tables are dropped first",
+    )
+    parser.add_argument("--projects", type=int, default=2)
+    parser.add_argument("--samples", type=int, default=24, help="samples per project")
+    parser.add_argument("--preps", type=int, default=1, help="library preps per sample")
+    parser.add_argument(
+        "--runs", type=int, default=1, help="sequencing runs per library prep"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="number of times each build is timed"
+    )
+    parser.add_argument(
+        "--only",
+        nargs="*",
+        choices=["ProjectSQL", "Workset_SQL", "create_lims_data_obj"],
+        help="builders to time, all by default",
+    )
+    parser.add_argument("--output", help="JSON results file, default stdout")
+
+    main(parser.parse_args())
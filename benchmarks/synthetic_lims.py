@@ -0,0 +1,407 @@
+"""Synthetic Clarity LIMS database for the benchmarks.
+
+Creates the genologics_sql schema in a local database and fills it with projects x samples x preps x runs,
+following the main path of a sample through the lab: initial QC and its aggregate, workset setup,
+library prep start and end, library validation aggregate, flowcell loading and a NovaSeq run with one
+output per lane. Columns that the builders do not read are filled with neutral values, and values for
+columns missing from the schema are dropped, so the generator does not depend on the exact version of
+the genologics_sql tables.
+"""
+
+import itertools
+from datetime import datetime, timedelta
+
+from genologics_sql.tables import Base
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    Numeric,
+    String,
+    Table,
+    Text,
+)
+
+BASE_DATE = datetime(2024, 1, 1)
+
+# one process type per step of the path, taken from LIMS2DB.objectsDB.process_categories
+TYPEIDS = {
+    "initial_qc": 63,  # Quant-iT QC (DNA) 4.0
+    "aggregate_qc": 7,  # Aggregate QC (DNA) 4.0
+    "workset": 204,  # Setup Workset/Plate
+    "prep_start": 33,  # Fragment DNA (TruSeq DNA) 4.0
+    "prep_end": 157,  # Applications Finish Prep
+    "aggregate_libval": 8,  # Aggregate QC (Library Validation) 4.0
+    "seq_start": 1458,  # Load to Flowcell (NovaSeq 6000 v2.0)
+    "sequencing": 1454,  # AUTOMATED - NovaSeq Run (NovaSeq 6000 v2.0)
+}
+ANALYTE = 2
+RESULT_FILE = 1
+# containertype rows: wells A:1 to H:12, and lanes 1:1 to 8:1
+PLATE = {
+    "typeid": 1,
+    "name": "96 well plate",
+    "numxpositions": 12,
+    "isxalpha": False,
+    "numypositions": 8,
+    "isyalpha": True,
+    "xindexstartsat": 1,
+    "yindexstartsat": 0,
+}
+FLOWCELL = {
+    "typeid": 2,
+    "name": "Flowcell",
+    "numxpositions": 1,
+    "isxalpha": False,
+    "numypositions": 8,
+    "isyalpha": False,
+    "xindexstartsat": 1,
+    "yindexstartsat": 1,
+}
+
+
+def neutral_value(column):
+    """Value of a NOT NULL column that the generator does not set"""
+    if isinstance(column.type, Boolean):
+        return False
+    if isinstance(column.type, (DateTime, Date)):
+        return BASE_DATE
+    if isinstance(column.type, Integer):
+        return 0
+    if isinstance(column.type, (Float, Numeric)):
+        return 0.0
+    if isinstance(column.type, (String, Text)):
+        return ""
+    return None
+
+
+class SyntheticLims:
+    """Generates the rows of a synthetic LIMS database
+    :param int projects: number of projects
+    :param int samples: samples per project
+    :param int preps: library preps per sample
+    :param int runs: sequencing runs per library prep
+    """
+
+    def __init__(self, projects=2, samples=24, preps=1, runs=1):
+        self.scale = {
+            "projects": projects,
+            "samples": samples,
+            "preps": preps,
+            "runs": runs,
+        }
+        # copy of the mapped tables without their foreign keys, which are not all valid DDL
+        self.metadata = MetaData()
+        for table in Base.metadata.sorted_tables:
+            Table(
+                table.name,
+                self.metadata,
+                *[
+                    Column(
+                        column.name,
+                        column.type,
+                        primary_key=column.primary_key,
+                        nullable=column.nullable,
+                    )
+                    for column in table.columns
+                ]
+            )
+        # tables queried by the builders that older genologics_sql versions do not map
+        if "protocolstep" not in self.metadata.tables:
+            Table(
+                "protocolstep",
+                self.metadata,
+                Column("stepid", Integer, primary_key=True),
+                Column("protocolid", Integer),
+                Column("processtypeid", Integer),
+            )
+        if "labprotocol" not in self.metadata.tables:
+            Table(
+                "labprotocol",
+                self.metadata,
+                Column("protocolid", Integer, primary_key=True),
+                Column("protocolname", String),
+            )
+        self.rows = {}
+        self.ids = itertools.count(1)
+        # artifactid -> ancestor artifactids, artifact_ancestor_map is transitive
+        self.ancestors = {}
+        # what the benchmarks build
+        self.project_luids = []
+        self.workset_ids = []
+        self.sequencing_ids = []
+
+    def add(self, table_name, **values):
+        """Adds a row, returns the value of the first column of its primary key"""
+        table = self.metadata.tables[table_name]
+        pk = list(table.primary_key.columns)
+        row = {}
+        for column in table.columns:
+            if column.name in values:
+                row[column.name] = values[column.name]
+            elif column.primary_key and isinstance(column.type, Integer):
+                row[column.name] = next(self.ids)
+            elif not column.nullable:
+                row[column.name] = neutral_value(column)
+            else:
+                row[column.name] = None
+        self.rows.setdefault(table_name, []).append(row)
+        return row[pk[0].name] if pk else None
+
+    def add_udfs(self, table_name, udfs, **key):
+        """Adds udfs to one of the udf views, if the schema maps it
+        :param dict key: columns identifying the entity, e.g. artifactid
+        """
+        if table_name not in self.metadata.tables:
+            return
+        for name, value in udfs.items():
+            self.add(
+                table_name,
+                udfname=name,
+                udfvalue=str(value),
+                udftype="Numeric" if isinstance(value, float) else "String",
+                **key
+            )
+
+    def add_artifact(self, name, samples, parents=(), artifacttypeid=ANALYTE):
+        """Adds an artifact derived from parents, mapped to the given sample processids"""
+        artifactid = next(self.ids)
+        stateid = next(self.ids)
+        self.add(
+            "artifact",
+            artifactid=artifactid,
+            luid="2-{}".format(artifactid),
+            name=name,
+            artifacttypeid=artifacttypeid,
+            isoriginal=not parents,
+            createddate=BASE_DATE,
+            lastmodifieddate=BASE_DATE,
+            currentstateid=stateid,
+        )
+        # qc_flag reads the latest state
+        self.add(
+            "artifactstate",
+            stateid=stateid,
+            artifactid=artifactid,
+            qcflag=0,
+            lastmodifieddate=BASE_DATE,
+        )
+        ancestors = set()
+        for parent in parents:
+            ancestors.add(parent)
+            ancestors.update(self.ancestors[parent])
+        self.ancestors[artifactid] = ancestors
+        for ancestor in sorted(ancestors):
+            self.add(
+                "artifact_ancestor_map",
+                artifactid=artifactid,
+                ancestorartifactid=ancestor,
+            )
+        for sample in samples:
+            self.add("artifact_sample_map", artifactid=artifactid, processid=sample)
+        return artifactid
+
+    def add_process(self, step, date, inputs, ownerid):
+        """Adds a process of one of the TYPEIDS steps, with a tracker per input.
+        Returns the processid and the trackerids by input.
+        """
+        processid = next(self.ids)
+        self.add(
+            "process",
+            processid=processid,
+            luid="24-{}".format(processid),
+            typeid=TYPEIDS[step],
+            daterun=date,
+            createddate=date,
+            lastmodifieddate=date,
+            workstatus="COMPLETE",
+            ownerid=ownerid,
+            techid=ownerid,
+        )
+        trackers = {}
+        for inp in inputs:
+            trackers[inp] = self.add(
+                "processiotracker", processid=processid, inputartifactid=inp
+            )
+        return processid, trackers
+
+    def add_output(self, tracker, artifactid):
+        self.add("outputmapping", trackerid=tracker, outputartifactid=artifactid)
+
+    def add_container(self, name, artifacts, containertype=PLATE):
+        """Places the artifacts in new containers, filled row by row"""
+        size = containertype["numxpositions"] * containertype["numypositions"]
+        for c in range(0, len(artifacts), size):
+            containerid = next(self.ids)
+            self.add(
+                "container",
+                containerid=containerid,
+                luid="27-{}".format(containerid),
+                name=name if c == 0 else "{}-{}".format(name, c // size + 1),
+                typeid=containertype["typeid"],
+            )
+            for i, artifactid in enumerate(artifacts[c : c + size]):
+                self.add(
+                    "containerplacement",
+                    containerid=containerid,
+                    processartifactid=artifactid,
+                    wellxposition=i % containertype["numxpositions"],
+                    wellyposition=i // containertype["numxpositions"],
+                )
+
+    def generate(self):
+        for containertype in [PLATE, FLOWCELL]:
+            self.add("containertype", **containertype)
+        if "processtype" in self.metadata.tables:
+            for typeid in sorted(set(TYPEIDS.values())):
+                self.add("processtype", typeid=typeid, displayname=str(typeid))
+        for p in range(self.scale["projects"]):
+            self.generate_project(p + 1)
+        return self
+
+    def generate_project(self, number):
+        start = BASE_DATE + timedelta(days=30 * number)
+        researcherid = self.add(
+            "researcher",
+            firstname="Researcher",
+            lastname=str(number),
+            email="researcher{}@example.com".format(number),
+            initials="R{}".format(number),
+        )
+        ownerid = self.add("principals", researcherid=researcherid)
+        pname = "P{}".format(number)
+        projectid = self.add(
+            "project",
+            name=pname,
+            luid=pname,
+            opendate=start,
+            researcherid=researcherid,
+            priority=5,
+            lastmodifieddate=start,
+        )
+        self.project_luids.append(pname)
+        # the project udfs are in the generic view, class 83
+        self.add_udfs(
+            "entity_udf_view",
+            {
+                "Application": "WG re-seq",
+                "Library construction method": "TruSeq DNA",
+                "Sequencing platform": "NovaSeq 6000",
+                "Sequencing setup": "2x150",
+            },
+            attachtoid=projectid,
+            attachtoclassid=83,
+        )
+
+        samples = []
+        roots = []
+        for s in range(self.scale["samples"]):
+            sname = "{}_{}".format(pname, 101 + s)
+            sampleid = next(self.ids)
+            self.add(
+                "sample",
+                processid=sampleid,
+                sampleid=sampleid,
+                luid="{}A{}".format(pname, s + 1),
+                name=sname,
+                projectid=projectid,
+                datereceived=start,
+            )
+            self.add_udfs(
+                "sample_udf_view",
+                {"Customer Name": "cust_{}".format(s)},
+                sampleid=sampleid,
+            )
+            samples.append(sampleid)
+            roots.append(self.add_artifact(sname, [sampleid]))
+        names = ["{}_{}".format(pname, 101 + s) for s in range(len(samples))]
+        self.add_container("{}_received".format(pname), roots)
+
+        day = itertools.count(1)
+        qc, trackers = self.add_process(
+            "initial_qc", start + timedelta(days=next(day)), roots, ownerid
+        )
+        for root, sampleid, sname in zip(roots, samples, names):
+            result = self.add_artifact(
+                "{} Quant-iT".format(sname), [sampleid], [root], RESULT_FILE
+            )
+            self.add_output(trackers[root], result)
+            self.add_udfs(
+                "artifact_udf_view", {"Concentration": 12.5}, artifactid=result
+            )
+        self.add_process(
+            "aggregate_qc", start + timedelta(days=next(day)), roots, ownerid
+        )
+
+        for k in range(self.scale["preps"]):
+            # each step outputs one analyte per input
+            current = roots
+            for step in ["workset", "prep_start", "prep_end"]:
+                processid, trackers = self.add_process(
+                    step, start + timedelta(days=next(day)), current, ownerid
+                )
+                outputs = []
+                for art, sampleid, sname in zip(current, samples, names):
+                    out = self.add_artifact(sname, [sampleid], [art])
+                    self.add_output(trackers[art], out)
+                    outputs.append(out)
+                if step == "workset":
+                    self.workset_ids.append(processid)
+                self.add_container("{}_{}{}".format(pname, step, k + 1), outputs)
+                current = outputs
+            libraries = current
+            self.add_process(
+                "aggregate_libval",
+                start + timedelta(days=next(day)),
+                libraries,
+                ownerid,
+            )
+            for r in range(self.scale["runs"]):
+                date = start + timedelta(days=next(day))
+                processid, trackers = self.add_process(
+                    "seq_start", date, libraries, ownerid
+                )
+                pool = self.add_artifact(
+                    "{} pool {}-{}".format(pname, k + 1, r + 1), samples, libraries
+                )
+                for lib in libraries:
+                    self.add_output(trackers[lib], pool)
+                self.add_container(
+                    "{}_FC{}-{}".format(pname, k + 1, r + 1), [pool], FLOWCELL
+                )
+                processid, trackers = self.add_process(
+                    "sequencing", date, [pool], ownerid
+                )
+                self.add_udfs(
+                    "process_udf_view",
+                    {"Finish Date": date.strftime("%Y-%m-%d"), "Run ID": "240101_A"},
+                    processid=processid,
+                    typeid=TYPEIDS["sequencing"],
+                )
+                lane = self.add_artifact("Lane 1", samples, [pool], RESULT_FILE)
+                self.add_output(trackers[pool], lane)
+                self.add_udfs(
+                    "artifact_udf_view", {"% Bases >=Q30": 92.0}, artifactid=lane
+                )
+                self.sequencing_ids.append(processid)
+
+    def load(self, engine):
+        """Creates the schema in an empty database and inserts the rows"""
+        self.metadata.drop_all(engine)
+        self.metadata.create_all(engine)
+        with engine.begin() as connection:
+            for table in self.metadata.sorted_tables:
+                rows = self.rows.get(table.name)
+                if rows:
+                    connection.execute(table.insert(), rows)
+
+    def targets(self):
+        return {
+            "projects": self.project_luids,
+            "worksets": self.workset_ids,
+            "sequencing": self.sequencing_ids,
+        }
@@ -14,6 +14,7 @@ import datetime
 import argparse
 import os
 from statusdb.db.utils import load_couch_server
+from LIMS2DB.researchers import get_researcher
 from LIMS2DB.utils import send_mail
 import markdown
 
@@ -23,17 +24,6 @@ def main(args):
     couch = load_couch_server(args.conf)
     db = couch["running_notes"]
 
-    def get_researcher(userid):
-        query = "select rs.* from principals pr \
-                    inner join researcher rs on rs.researcherid=pr.researcherid \
-                    where principalid=:pid;"
-        return (
-            session.query(tbls.Researcher)
-            .from_statement(text(query))
-            .params(pid=userid)
-            .first()
-        )
-
     def make_esc_running_note(
         researcher,
         reviewer,
@@ -104,7 +94,7 @@ def main(args):
             .first()
         )
         if res:
-            proj_coord = get_researcher(res.ownerid)
+            proj_coord = get_researcher(session, res.ownerid)
         else:
             proj_coord = "ngi-project-coordinators@scilifelab.se"
 
@@ -154,8 +144,8 @@ def main(args):
             f"and esc.processid={escalation.processid};"
         )
         step_name = session.execute(text(query)).first()[0]
-        owner = get_researcher(escalation.ownerid)
-        reviewer = get_researcher(escalation.reviewerid)
+        owner = get_researcher(session, escalation.ownerid)
+        reviewer = get_researcher(session, escalation.reviewerid)
         if (
             sample.projectid in projects.keys()
             and escalation.eventid in projects[sample.projectid]
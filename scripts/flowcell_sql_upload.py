@@ -21,6 +21,7 @@ from LIMS2DB.flowcell_sql import (
 )
 from LIMS2DB.utils import setupServer
 from LIMS2DB.classes import Process
+from LIMS2DB.lineage import LineageGraph
 
 from genologics_sql.utils import get_session
 from sqlalchemy import text
@@ -60,6 +61,9 @@ def main(args):
     else:
         seq_steps = get_sequencing_steps(db_session, interval)
 
+    # load the io of all the steps at once
+    graph = LineageGraph.for_processes(db_session, seq_steps, descendants=False)
+
     for step in seq_steps:
         for udf in step.udfs:
             if udf.udfname == "Run ID":
@@ -67,7 +71,7 @@ def main(args):
 
         mainlog.info("updating {}".format(fcid))
         # generate the lims_data dict key
-        lims_data = create_lims_data_obj(db_session, step)
+        lims_data = create_lims_data_obj(db_session, step, graph)
         # update the couch right couch document
         upload_to_couch(couch, fcid, lims_data, step)
 
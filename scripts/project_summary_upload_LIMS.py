@@ -14,9 +14,19 @@ from genologics_sql.queries import get_last_modified_projectids
 from genologics_sql.utils import get_session, get_configuration
 from genologics_sql.tables import Project as DBProject
 from LIMS2DB.classes import ProjectSQL
+from LIMS2DB.couch_bulk import SAMPLES_DB, BulkProjectWriter, fetch_project_doc_ids
+from LIMS2DB.couch_views import (
+    PROJECTS_DESIGN_DOC,
+    SAMPLES_DESIGN_DOC,
+    ensure_design_doc,
+)
+from LIMS2DB.json_stream import ProjectJSONWriter
+from LIMS2DB.order_portal import prefetch_orders
+from LIMS2DB.profiling import ProfileAggregate
+from LIMS2DB import slow_queries, statements
+from LIMS2DB.ancestor_index import AncestorIndex
 
 import yaml
-import json
 import logging
 import logging.handlers
 import multiprocessing as mp
@@ -37,6 +47,8 @@ def main(options):
     couch = load_couch_server(conf)
     mainlims = Lims(BASEURI, USERNAME, PASSWORD)
     lims_db = get_session()
+    if options.prepare_statements:
+        statements.use_server_side_prepare()
 
     mainlog = logging.getLogger("psullogger")
     mainlog.setLevel(level=logging.INFO)
@@ -57,8 +69,22 @@ def main(options):
             "Loading orderportal config {} failed due to {}, so order information "
             "for project will not be updated".format(options.oconf, e)
         )
+    if oconf is not None and options.order_cache:
+        oconf["cache"] = options.order_cache
+
+    # local copy of the artifact ancestry, opened before forking so that workers share it
+    ancestor_index = None
+    if options.ancestor_index:
+        ancestor_index = AncestorIndex.refresh(lims_db, options.ancestor_index)
+        mainlog.info(
+            "Using ancestor index {} with {} entries".format(
+                options.ancestor_index, len(ancestor_index)
+            )
+        )
 
     if options.project_name:
+        if options.slow_query_threshold is not None:
+            slow_queries.enable(mainlog, options.slow_query_threshold)
         host = get_configuration()["url"]
         pj_id = (
             lims_db.query(DBProject.luid)
@@ -67,19 +93,53 @@ def main(options):
         )
         if not pj_id:
             pj_id = options.project_name
-        P = ProjectSQL(lims_db, mainlog, pj_id, host, couch, oconf)
-        if options.upload:
-            P.save(update_modification_time=not options.no_new_modification_time)
-        else:
+        # without upload, the document is written while the samples are built
+        output = None
+        if not options.upload:
             if output_f is not None:
-                with open(output_f, "w") as f:
-                    f.write(json.dumps(P.obj))
+                output_file = open(output_f, "w")
+                output = ProjectJSONWriter(output_file)
             else:
-                print(json.dumps(P.obj))
+                output = ProjectJSONWriter(sys.stdout)
+        with slow_queries.building("project {}".format(pj_id)):
+            P = ProjectSQL(
+                lims_db,
+                mainlog,
+                pj_id,
+                host,
+                couch,
+                oconf,
+                lineage_graph=options.lineage_graph,
+                ancestor_index=ancestor_index,
+                incremental=options.incremental,
+                sample_workers=options.sample_workers,
+                output=output,
+            )
+        if options.upload:
+            delta_min_size = None
+            if options.delta_min_size > 0 and installDesignDoc(
+                couch["projects"], mainlog
+            ):
+                delta_min_size = options.delta_min_size
+            if options.split_samples:
+                ensure_design_doc(couch[SAMPLES_DB], SAMPLES_DESIGN_DOC, mainlog)
+            P.save(
+                update_modification_time=not options.no_new_modification_time,
+                delta_min_size=delta_min_size,
+                split_samples=options.split_samples,
+            )
+        elif output_f is not None:
+            output_file.close()
+        else:
+            print()
+        if options.slow_query_threshold is not None:
+            mainlog.info("Slowest queries:\n{}".format(slow_queries.report()))
 
     else:
         projects = create_projects_list(options, lims_db, mainlims, mainlog)
-        masterProcess(options, projects, mainlims, mainlog, oconf)
+        masterProcess(
+            options, projects, mainlims, mainlog, oconf, ancestor_index, lims_db
+        )
         lims_db.commit()
         lims_db.close()
 
@@ -115,7 +175,17 @@ def create_projects_list(options, db_session, lims, log):
         return projects
 
 
-def processPSUL(options, queue, logqueue, oconf=None):
+def processPSUL(
+    options,
+    queue,
+    logqueue,
+    oconf=None,
+    ancestor_index=None,
+    orders=None,
+    docs=None,
+    doc_ids=None,
+    delta_min_size=None,
+):
     couch = load_couch_server(options.conf)
     db_session = get_session()
     work = True
@@ -126,6 +196,8 @@ def processPSUL(options, queue, logqueue, oconf=None):
     mft = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
     mfh.setFormatter(mft)
     proclog.addHandler(mfh)
+    if options.slow_query_threshold is not None:
+        slow_queries.enable(proclog, options.slow_query_threshold)
     # Not completely sure what this does, maybe trying to load balance?
     try:
         time.sleep(int(procName[8:]))
@@ -155,6 +227,8 @@ def processPSUL(options, queue, logqueue, oconf=None):
                     open(lockfile, "w").close()
                 except:
                     proclog.error("cannot create lockfile {}".format(lockfile))
+                # the master process removes the lock once it has saved the document
+                keep_lock = False
                 try:
                     pj_id = (
                         db_session.query(DBProject.luid)
@@ -162,8 +236,32 @@ def processPSUL(options, queue, logqueue, oconf=None):
                         .scalar()
                     )
                     host = get_configuration()["url"]
-                    P = ProjectSQL(db_session, proclog, pj_id, host, couch, oconf)
-                    P.save()
+                    with slow_queries.building("project {}".format(pj_id)):
+                        P = ProjectSQL(
+                            db_session,
+                            proclog,
+                            pj_id,
+                            host,
+                            couch,
+                            oconf,
+                            lineage_graph=options.lineage_graph,
+                            ancestor_index=ancestor_index,
+                            incremental=options.incremental,
+                            sample_workers=options.sample_workers,
+                            orders=orders,
+                            doc_ids=doc_ids,
+                        )
+                        if docs is not None:
+                            # saved by the master process with the other documents
+                            docs.put(
+                                (projname, P.obj, P.build_state, P.sample_docs_missing)
+                            )
+                            keep_lock = True
+                        else:
+                            P.save(
+                                delta_min_size=delta_min_size,
+                                split_samples=options.split_samples,
+                            )
                 except:
                     error = sys.exc_info()
                     stack = traceback.extract_tb(error[2])
@@ -171,20 +269,32 @@ def processPSUL(options, queue, logqueue, oconf=None):
                         "{0}:{1}\n{2}".format(error[0], error[1], formatStack(stack))
                     )
 
-                try:
-                    os.remove(lockfile)
-                except:
-                    proclog.error("cannot remove lockfile {}".format(lockfile))
+                if not keep_lock:
+                    try:
+                        os.remove(lockfile)
+                    except:
+                        proclog.error("cannot remove lockfile {}".format(lockfile))
             else:
                 proclog.info("project {} is locked, skipping.".format(projname))
 
             # signals to queue job is done
             queue.task_done()
+    proclog.info("Statement statistics:\n{}".format(statements.format_stats()))
+    if options.slow_query_threshold is not None:
+        proclog.info("Slowest queries:\n{}".format(slow_queries.report()))
     db_session.commit()
     db_session.close()
 
 
-def masterProcess(options, projectList, mainlims, logger, oconf=None):
+def masterProcess(
+    options,
+    projectList,
+    mainlims,
+    logger,
+    oconf=None,
+    ancestor_index=None,
+    lims_db=None,
+):
     projectsQueue = mp.JoinableQueue()
     logQueue = mp.Queue()
     childs = []
@@ -196,10 +306,71 @@ def masterProcess(options, projectList, mainlims, logger, oconf=None):
         reverse=True,
     )
     logger.info("done ordering the project list")
+    # fetch the orders of all the projects at once, the workers get them with their arguments
+    orders = None
+    if oconf and lims_db is not None and options.order_workers > 0 and projectList:
+        start = time.time()
+        portal_ids = [
+            portal_id
+            for name, portal_id in statements.fetch_rows(
+                lims_db, "projects_portal_ids", names=[p.name for p in projectList]
+            )
+        ]
+        orders = prefetch_orders(oconf, portal_ids, options.order_workers, logger)
+        logger.info(
+            "Prefetched {} of {} orders in {:.1f}s".format(
+                len(orders), len(portal_ids), time.time() - start
+            )
+        )
+    # ids of the project documents, read once for all the workers
+    projects_db = load_couch_server(options.conf)["projects"]
+    start = time.time()
+    doc_ids = fetch_project_doc_ids(projects_db)
+    logger.info(
+        "Read the ids of {} project documents in {:.1f}s".format(
+            len(doc_ids), time.time() - start
+        )
+    )
+    # the view of the project hashes and the update handler of the deltas, only installed if used
+    design_doc = False
+    if options.bulk_size > 0 or options.delta_min_size > 0:
+        design_doc = installDesignDoc(projects_db, logger)
+    delta_min_size = None
+    if design_doc and options.delta_min_size > 0:
+        delta_min_size = options.delta_min_size
+    samples_db = None
+    if options.split_samples:
+        samples_db = load_couch_server(options.conf)[SAMPLES_DB]
+        ensure_design_doc(samples_db, SAMPLES_DESIGN_DOC, logger)
+    # the workers send the built documents back, to be saved in batches
+    docsQueue = None
+    writer = None
+    if options.bulk_size > 0:
+        docsQueue = mp.Queue()
+        writer = BulkProjectWriter(
+            projects_db,
+            logger,
+            options.bulk_size,
+            doc_ids=doc_ids,
+            hash_view=design_doc,
+            delta_min_size=delta_min_size,
+            samples_db=samples_db,
+        )
     # spawn a pool of processes, and pass them queue instance
     for i in range(options.processes):
         p = mp.Process(
-            target=processPSUL, args=(options, projectsQueue, logQueue, oconf)
+            target=processPSUL,
+            args=(
+                options,
+                projectsQueue,
+                logQueue,
+                oconf,
+                ancestor_index,
+                orders,
+                docsQueue,
+                doc_ids,
+                delta_min_size,
+            ),
         )
         p.start()
         childs.append(p)
@@ -208,15 +379,66 @@ def masterProcess(options, projectList, mainlims, logger, oconf=None):
         projectsQueue.put(proj.name)
 
     # wait on the queue until everything has been processed
+    # the build profiles of the projects come with their log records
+    profiles = ProfileAggregate()
+    # projects whose documents are collected, locked until they are saved
+    locked = []
     notDone = True
     while notDone:
+        if writer is not None:
+            collectDocs(docsQueue, writer, options.lockdir, locked, logger)
         try:
             log = logQueue.get(False)
             logger.handle(log)
+            if getattr(log, "profile", None):
+                profiles.add(log.profile)
         except Queue.Empty:
             if not stillRunning(childs):
                 notDone = False
                 break
+    if writer is not None:
+        collectDocs(docsQueue, writer, options.lockdir, locked, logger)
+        writer.flush()
+        releaseLocks(options.lockdir, locked, logger)
+        logger.info("Saved the project documents: {}".format(writer.stats()))
+    logger.info("Build profile of all projects: {}".format(profiles.format()))
+
+
+def installDesignDoc(projects_db, logger):
+    try:
+        ensure_design_doc(projects_db, PROJECTS_DESIGN_DOC, logger)
+        return True
+    except Exception as e:
+        logger.warning(
+            "Cannot install the design document {}, the unchanged documents will be fetched "
+            "and the changed ones saved in full: {}".format(
+                PROJECTS_DESIGN_DOC["_id"], e
+            )
+        )
+        return False
+
+
+def collectDocs(docsQueue, writer, lockdir, locked, logger):
+    while True:
+        try:
+            projname, obj, build_state, sample_docs_missing = docsQueue.get(False)
+        except Queue.Empty:
+            return
+        locked.append(projname)
+        writer.add(obj, build_state, sample_docs_missing)
+        if not writer.pending:
+            # the batch is written
+            releaseLocks(lockdir, locked, logger)
+
+
+def releaseLocks(lockdir, locked, logger):
+    for projname in locked:
+        lockfile = os.path.join(lockdir, projname)
+        try:
+            os.remove(lockfile)
+        except:
+            logger.error("cannot remove lockfile {}".format(lockfile))
+    del locked[:]
 
 
 def stillRunning(processList):
@@ -384,6 +606,106 @@ if __name__ == "__main__":
             "Slightly dangerous, but useful e.g. when all projects would be updated."
         ),
     )
+    parser.add_argument(
+        "--lineage_graph",
+        action="store_true",
+        help=(
+            "Load each project as an in-memory process/artifact graph and walk it "
+            "locally when resolving library preps."
+        ),
+    )
+
+    parser.add_argument(
+        "--ancestor_index",
+        default=None,
+        help=(
+            "Path of a local artifact ancestry index. It is built if missing, "
+            "refreshed with the recently modified artifacts otherwise."
+        ),
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Only rebuild the samples modified since the project document was last saved, "
+            "keep the other samples from that document."
+        ),
+    )
+
+    parser.add_argument(
+        "--sample_workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of threads building the samples of a project, each with its own LIMS database session. "
+            "Default 1 builds the samples sequentially."
+        ),
+    )
+
+    parser.add_argument(
+        "--slow_query_threshold",
+        type=float,
+        default=None,
+        help=(
+            "Time the LIMS queries, log the ones taking more than this many seconds "
+            "and the slowest query templates at the end."
+        ),
+    )
+
+    parser.add_argument(
+        "--order_workers",
+        type=int,
+        default=8,
+        help=(
+            "Number of concurrent requests fetching the orders of the projects from the order portal "
+            "before they are built, 0 lets each project fetch its own order."
+        ),
+    )
+
+    parser.add_argument(
+        "--order_cache",
+        default=None,
+        help=(
+            "Path of a local cache of the order portal responses, "
+            "overrides the cache of the order portal configuration."
+        ),
+    )
+
+    parser.add_argument(
+        "--bulk_size",
+        type=int,
+        default=0,
+        help=(
+            "Number of project documents saved together with _bulk_docs by the master process. "
+            "Default: 0, each worker saves its own documents."
+        ),
+    )
+
+    parser.add_argument(
+        "--delta_min_size",
+        type=int,
+        default=0,
+        help=(
+            "Size in bytes of the JSON of the changed project documents above which only their "
+            "changes are sent to couch, e.g. 262144. Default: 0, the whole documents are sent."
+        ),
+    )
+
+    parser.add_argument(
+        "--split_samples",
+        action="store_true",
+        help=(
+            "Save the samples of the projects in their own documents of the {} database, the "
+            "project documents only list their names.".format(SAMPLES_DB)
+        ),
+    )
+
+    parser.add_argument(
+        "--prepare_statements",
+        action="store_true",
+        help="PREPARE the LIMS queries once per database connection and EXECUTE them afterwards.",
+    )
 
     options = parser.parse_args()
 
@@ -1,4 +1,5 @@
 import LIMS2DB.diff as df
+from LIMS2DB.couch_bulk import fetch_project_doc_ids
 import datetime
 import argparse
 import os
@@ -41,15 +42,17 @@ def main(args):
                 closed_ids.append(row.key[1])
         nb = int(len(closed_ids) / 10)
         picked_ids = random.sample(closed_ids, nb)
+        doc_ids = fetch_project_doc_ids(proj_db, "projects/lims_followed")
         for one_id in picked_ids:
             diffs[one_id] = df.diff_project_objects(
-                one_id, couch, proj_db, args.log, oconf
+                one_id, couch, proj_db, args.log, oconf, doc_ids
             )
     else:
+        doc_ids = fetch_project_doc_ids(proj_db, "projects/lims_followed")
         view = proj_db.view("project/project_id")
         for row in view:
             proj_diff = df.diff_project_objects(
-                row.key, couch, proj_db, args.log, oconf
+                row.key, couch, proj_db, args.log, oconf, doc_ids
             )
             if proj_diff is not None:
                 diffs[row.key] = proj_diff
@@ -4,6 +4,8 @@ import LIMS2DB.classes as lclasses
 import LIMS2DB.parallel as lpar
 import LIMS2DB.utils as lutils
 import LIMS2DB.objectsDB.process_categories as pc_cg
+from LIMS2DB import slow_queries, statements
+from LIMS2DB.ancestor_index import AncestorIndex
 
 from genologics_sql.tables import *
 from genologics_sql.utils import *
@@ -14,9 +16,17 @@ from sqlalchemy import text
 def main(args):
     log = lutils.setupLog("worksetlogger", args.logfile)
     session = get_session()
+    if args.prepare_statements:
+        statements.use_server_side_prepare()
+    ancestor_index = None
+    if args.ancestor_index:
+        ancestor_index = AncestorIndex.refresh(session, args.ancestor_index)
     if args.ws:
+        if args.slow_query_threshold is not None:
+            slow_queries.enable(log, args.slow_query_threshold)
         step = session.query(Process).filter_by(luid=args.ws).one()
-        ws = lclasses.Workset_SQL(session, log, step)
+        with slow_queries.building("workset {}".format(args.ws)):
+            ws = lclasses.Workset_SQL(session, log, step, ancestor_index=ancestor_index)
         with open(args.conf) as conf_file:
             conf = yaml.load(conf_file, Loader=yaml.SafeLoader)
         couch = lutils.setupServer(conf)
@@ -25,9 +35,16 @@ def main(args):
         for row in db.view("worksets/lims_id")[ws.obj["id"]]:
             doc = db.get(row.id)
 
-        final_doc = lutils.merge(ws.obj, doc)
+        final_doc, changed = lutils.DEFAULT_MERGE.merge(ws.obj, doc)
 
-        db.save(final_doc)
+        if changed:
+            db.save(final_doc)
+            log.info("updating {0}".format(ws.obj["name"]))
+        else:
+            log.info("not modifying {0}".format(ws.obj["name"]))
+        log.info("Statement statistics:\n{}".format(statements.format_stats()))
+        if args.slow_query_threshold is not None:
+            log.info("Slowest queries:\n{}".format(slow_queries.report()))
 
     elif args.recent:
         recent_processes = get_last_modified_processes(
@@ -53,7 +70,7 @@ def main(args):
         log.info(
             "the following processes will be updated : {0}".format(processes_to_update)
         )
-        lpar.masterProcessSQL(args, processes_to_update, log)
+        lpar.masterProcessSQL(args, processes_to_update, log, ancestor_index)
 
 
 if __name__ == "__main__":
@@ -105,6 +122,25 @@ if __name__ == "__main__":
         default=os.path.join(os.environ["HOME"], "workset_upload.log"),
         help="log file.  Default: ~/workset_upload.log",
     )
+    parser.add_argument(
+        "--ancestor_index",
+        dest="ancestor_index",
+        default=None,
+        help="path of a local artifact ancestry index, built if missing",
+    )
+    parser.add_argument(
+        "--prepare_statements",
+        dest="prepare_statements",
+        action="store_true",
+        help="prepare the LIMS queries once per database connection",
+    )
+    parser.add_argument(
+        "--slow_query_threshold",
+        dest="slow_query_threshold",
+        type=float,
+        default=None,
+        help="log the LIMS queries slower than this many seconds, and the slowest query templates",
+    )
     args = parser.parse_args()
 
     main(args)
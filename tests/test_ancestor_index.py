@@ -0,0 +1,166 @@
+import os
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from LIMS2DB import ancestor_index
+from LIMS2DB.ancestor_index import AncestorIndex, IndexFile, delta_path, write_index
+
+START = datetime(2024, 1, 1)
+
+
+class Result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+class Session:
+    """Session over an artifact_ancestor_map whose pairs have the modification time of their artifact
+    :param dict modified: (ancestorid, artifactid) pairs with the lastmodifieddate of artifactid
+    """
+
+    def __init__(self, modified):
+        self.modified = modified
+        self.now = START
+
+    def connection(self):
+        return self
+
+    def execution_options(self, **options):
+        return self
+
+    def execute(self, query, params):
+        if "lastmodifieddate" in str(query):
+            rows = [
+                pair
+                for pair, modified in self.modified.items()
+                if modified > params["since"]
+            ]
+        else:
+            rows = sorted(self.modified)
+        return Result(rows)
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = Session({})
+    monkeypatch.setattr(ancestor_index, "database_time", lambda s: s.now)
+    return session
+
+
+def random_pairs(rnd, n):
+    return {(rnd.randint(1, 50), rnd.randint(1, 500)) for _ in range(n)}
+
+
+def expected_descendants(pairs):
+    descendants = {}
+    for ancestorid, artifactid in sorted(pairs):
+        descendants.setdefault(ancestorid, []).append(artifactid)
+    return descendants
+
+
+def check_index(index, pairs):
+    expected = expected_descendants(pairs)
+    for ancestorid in range(0, 52):
+        assert index.descendants(ancestorid) == expected.get(ancestorid, [])
+    assert sorted(set(index.pairs())) == sorted(pairs)
+
+
+def test_write_index_round_trip(tmp_path):
+    path = str(tmp_path / "index")
+    pairs = random_pairs(random.Random(5), 2000)
+    # duplicates are dropped
+    write_index(path, sorted(pairs) + [max(pairs)], 12.5)
+    index = IndexFile(path)
+    assert len(index) == len(pairs)
+    assert index.built_at == 12.5
+    assert list(index.pairs()) == sorted(pairs)
+    check_index(index, pairs)
+    index.close()
+    assert os.listdir(str(tmp_path)) == ["index"]
+
+
+def test_write_empty_index(tmp_path):
+    path = str(tmp_path / "index")
+    write_index(path, [], 0)
+    index = IndexFile(path)
+    assert len(index) == 0
+    assert index.descendants(1) == []
+    index.close()
+
+
+def test_write_index_failure_keeps_the_old_one(tmp_path):
+    path = str(tmp_path / "index")
+    write_index(path, [(1, 2)], 0)
+
+    def failing_pairs():
+        yield (1, 3)
+        raise RuntimeError("connection lost")
+
+    with pytest.raises(RuntimeError):
+        write_index(path, failing_pairs(), 1)
+    index = IndexFile(path)
+    assert list(index.pairs()) == [(1, 2)]
+    index.close()
+    assert sorted(os.listdir(str(tmp_path))) == ["index"]
+
+
+def test_refresh_delta_and_fold(tmp_path, session):
+    path = str(tmp_path / "index")
+    rnd = random.Random(6)
+    for pair in random_pairs(rnd, 2000):
+        session.modified[pair] = START - timedelta(days=1)
+    index = AncestorIndex.refresh(session, path)
+    assert index.delta is None
+    check_index(index, session.modified)
+    index.close()
+
+    # a few new pairs go to the delta file
+    session.now = START + timedelta(hours=1)
+    for pair in random_pairs(rnd, 20):
+        session.modified[pair] = START + timedelta(minutes=30)
+    index = AncestorIndex.refresh(session, path)
+    assert index.delta is not None
+    assert index.built_at == session.now.timestamp()
+    check_index(index, session.modified)
+    base_size = len(index.base)
+    index.close()
+
+    # nothing modified since, the index is unchanged
+    index = AncestorIndex.refresh(session, path)
+    assert len(index.base) == base_size
+    check_index(index, session.modified)
+    index.close()
+
+    # past DELTA_MAX_RATIO of the index, the delta is folded into it
+    session.now = START + timedelta(hours=2)
+    for pair in random_pairs(rnd, 500):
+        session.modified[pair] = START + timedelta(minutes=90)
+    index = AncestorIndex.refresh(session, path)
+    assert index.delta is None
+    assert not os.path.exists(delta_path(path))
+    check_index(index, session.modified)
+    index.close()
+
+
+def test_build_drops_the_delta(tmp_path, session):
+    path = str(tmp_path / "index")
+    session.modified = {
+        (1, artifactid): START - timedelta(days=1) for artifactid in range(2, 100)
+    }
+    AncestorIndex.build(session, path).close()
+    session.now = START + timedelta(hours=1)
+    session.modified[(2, 4)] = START + timedelta(minutes=30)
+    AncestorIndex.refresh(session, path).close()
+    assert os.path.exists(delta_path(path))
+    del session.modified[(1, 3)]
+    index = AncestorIndex.build(session, path)
+    assert index.delta is None
+    assert not os.path.exists(delta_path(path))
+    assert list(index.pairs()) == sorted(session.modified)
+    index.close()
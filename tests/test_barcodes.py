@@ -0,0 +1,77 @@
+import random
+
+import pytest
+from sqlalchemy.orm.exc import MultipleResultsFound
+
+from LIMS2DB.barcodes import BarcodeResolver
+from LIMS2DB.utils import like_match
+
+REAGENT_TYPES = [
+    ("A701-A501 (ATCACG-TATAGCCT)", "ATCACG-TATAGCCT"),
+    ("SmartSeq index 7", "Index GGACTCCT"),
+    ("IDT_UDI_0001", "index CCGCGGTT_AGCGCTAG"),
+    (None, "CCCC"),
+    ("Custom 12", None),
+]
+
+
+class Session:
+    """Session answering the query of the reagent types"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    def query(self, *columns):
+        self.queries += 1
+        return list(self.rows)
+
+
+def resolver(rows=REAGENT_TYPES):
+    return BarcodeResolver(Session(rows))
+
+
+def test_matching_is_like():
+    rnd = random.Random(4)
+    names = [
+        "".join(rnd.choice("AB_%x") for _ in range(rnd.randint(0, 8)))
+        for _ in range(200)
+    ]
+    index = resolver([(name, name) for name in names])
+    for _ in range(500):
+        barcode = "".join(rnd.choice("AB_x") for _ in range(rnd.randint(1, 3)))
+        pattern = "%{}%".format(barcode)
+        expected = [i for i, name in enumerate(names) if like_match(pattern, name)]
+        assert index.matching(barcode) == expected
+
+
+def test_extract():
+    index = resolver()
+    assert index.extract("NoIndex") == "NoIndex"
+    assert index.extract("SI-GA-A1") == "SI-GA-A1"
+    assert index.extract("SMARTSEQ-1A") == "SMARTSEQ-1A"
+    assert index.extract("A701-A501 (ATCACG-TATAGCCT)") == "ATCACG-TATAGCCT"
+    assert index.extract("ATCACG") == "ATCACG"
+    assert index.extract("SmartSeq index 7") == "GGACTCCT"
+    assert index.extract("IDT_UDI_0001", underscores=True) == "CCGCGGTT-AGCGCTAG"
+    assert index.extract("IDT_UDI_0001") == "CCGCGGTT"
+
+
+def test_meta_data_as_scalar():
+    index = resolver()
+    assert index.meta_data("Nothing") is None
+    assert index.meta_data("Custom") is None
+    with pytest.raises(MultipleResultsFound):
+        index.meta_data("1")
+    # a label matching no reagent type fails like the query it replaces
+    with pytest.raises(TypeError):
+        index.extract("Unknown label")
+
+
+def test_reagent_types_read_once():
+    session = Session(REAGENT_TYPES)
+    index = BarcodeResolver(session)
+    for _ in range(3):
+        index.extract("SmartSeq index 7")
+        index.meta_data("Custom")
+    assert session.queries == 1
@@ -0,0 +1,64 @@
+import copy
+import random
+
+from LIMS2DB.couch_bulk import project_delta
+
+
+def apply_delta(doc, delta):
+    """What the apply_delta update handler of couch_views does to a document"""
+    for change in delta:
+        node = doc
+        for key in change["path"][:-1]:
+            if not isinstance(node.get(key), dict):
+                node[key] = {}
+            node = node[key]
+        if "value" in change:
+            node[change["path"][-1]] = change["value"]
+        else:
+            del node[change["path"][-1]]
+    return doc
+
+
+def random_value(rnd, depth=0):
+    if depth > 3 or rnd.random() < 0.4:
+        return rnd.choice([0, 1, "", "a", None, [], [1, {"x": 2}], False, {}])
+    return {
+        rnd.choice("abcde"): random_value(rnd, depth + 1)
+        for _ in range(rnd.randint(0, 4))
+    }
+
+
+def test_project_delta_gives_the_new_document():
+    rnd = random.Random(1)
+    for _ in range(2000):
+        doc = {"_id": "d", "_rev": "1-a", "a": random_value(rnd)}
+        obj = {"_id": "d", "_rev": "1-a", "b": random_value(rnd)}
+        if rnd.random() < 0.5:
+            obj["a"] = random_value(rnd)
+        delta = project_delta(doc, obj)
+        assert apply_delta(copy.deepcopy(doc), delta) == obj
+
+
+def test_project_delta_changes():
+    doc = {
+        "_id": "d",
+        "_rev": "1-a",
+        "details": {"running_notes": "n", "application": "x"},
+        "samples": {"S1": {"status": "a"}, "S2": {"status": "a"}},
+    }
+    obj = {
+        "details": {"running_notes": "n", "application": ""},
+        "samples": {"S1": {"status": "b"}, "S3": {"status": "a"}},
+    }
+    delta = project_delta(doc, obj)
+    assert sorted(delta, key=lambda change: change["path"]) == [
+        {"path": ["details", "application"], "value": ""},
+        {"path": ["samples", "S1", "status"], "value": "b"},
+        {"path": ["samples", "S2"]},
+        {"path": ["samples", "S3"], "value": {"status": "a"}},
+    ]
+
+
+def test_project_delta_of_equal_documents():
+    doc = {"_id": "d", "_rev": "1-a", "samples": {"S1": {"status": "a"}}}
+    assert project_delta(doc, copy.deepcopy(doc)) == []
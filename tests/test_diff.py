@@ -0,0 +1,137 @@
+import copy
+import random
+
+from LIMS2DB.diff import PROJECT_VALIDATION_DIFF, DiffEngine, diff_objects
+
+
+def recursive_diff_objects(o1, o2, parent=""):
+    """diff_objects as it was written before DiffEngine"""
+    diffs = {}
+    for key in o1:
+        if key in o2:
+            if isinstance(o1[key], dict):
+                diffs.update(
+                    recursive_diff_objects(
+                        o1[key], o2[key], "{} {}".format(parent, key)
+                    )
+                )
+            elif o1[key] != o2[key]:
+                diffs["{} {}".format(parent, key)] = [o1[key], o2[key]]
+        elif o1[key]:
+            diffs["key {} {}".format(parent, key)] = [o1[key], "missing"]
+    for key in o2:
+        if key not in o1 and o2[key]:
+            diffs["key {} {}".format(parent, key)] = ["missing", o2[key]]
+    return diffs
+
+
+def random_doc(rnd, depth=0):
+    doc = {}
+    for key in rnd.sample("abcde", rnd.randint(0, 4)):
+        if depth < 3 and rnd.random() < 0.3:
+            doc[key] = random_doc(rnd, depth + 1)
+        else:
+            doc[key] = rnd.choice([0, 1, "", "x", None, [], [1]])
+    return doc
+
+
+def same_shape(o1, o2):
+    """Whether no dict is replaced by another value, where the recursive diff_objects differs"""
+    for key in o1:
+        if key in o2:
+            if isinstance(o1[key], dict) != isinstance(o2[key], dict):
+                return False
+            if isinstance(o1[key], dict) and not same_shape(o1[key], o2[key]):
+                return False
+    return True
+
+
+def test_diff_objects_matches_recursive_version():
+    rnd = random.Random(1)
+    compared = 0
+    for _ in range(5000):
+        o1, o2 = random_doc(rnd), random_doc(rnd)
+        if not same_shape(o1, o2):
+            continue
+        compared += 1
+        assert diff_objects(o1, o2) == recursive_diff_objects(o1, o2)
+        assert diff_objects(o1, o2, "parent") == recursive_diff_objects(
+            o1, o2, "parent"
+        )
+    assert compared > 1000
+
+
+def test_diff_objects_keys():
+    o1 = {"a": 1, "b": 2, "c": {"d": 3, "e": {"f": 5}}, "g": "x"}
+    o2 = {"a": 1, "b": 7, "c": {"d": 4, "e": {"f": 4}}, "h": "y"}
+    assert diff_objects(o1, o2) == {
+        " b": [2, 7],
+        " c d": [3, 4],
+        " c e f": [5, 4],
+        "key  g": ["x", "missing"],
+        "key  h": ["missing", "y"],
+    }
+
+
+def test_dict_replaced_by_another_value():
+    assert diff_objects({"g": {"a": 1}}, {"g": []}) == {"key  g": [{"a": 1}, []]}
+    assert diff_objects({"s": {"g": {"a": 1}}}, {"s": {"g": None}}) == {
+        "key  s g": [{"a": 1}, None]
+    }
+    assert diff_objects({"g": []}, {"g": {"a": 1}}) == {" g": [[], {"a": 1}]}
+
+
+def test_falsy_missing_values_are_not_differences():
+    assert diff_objects({"a": None, "b": {}}, {"c": ""}) == {}
+    assert DiffEngine(strict=True).diffs({"a": None}, {}) == {
+        "key  a": [None, "missing"]
+    }
+
+
+def test_ignore_and_remove_first():
+    o1 = {
+        "_id": "1",
+        "_rev": "2",
+        "modification_time": "t1",
+        "lims_hash": "h1",
+        "details": {"running_notes": "n", "x": 1},
+        "samples": {"S1": {"status": "a"}},
+    }
+    o2 = {
+        "lims_hash": "h2",
+        "details": {"x": 1},
+        "samples": {"S1": {"status": "a"}},
+    }
+    assert not PROJECT_VALIDATION_DIFF.differs(o1, o2)
+    o2["details"]["running_notes"] = "m"
+    assert PROJECT_VALIDATION_DIFF.diffs(o1, o2) == {
+        "key  details running_notes": ["missing", "m"]
+    }
+
+
+def test_remove_first_matches_popped_fields():
+    engine = DiffEngine(remove_first=[("x",), ("details", "rn")])
+    rnd = random.Random(2)
+    for _ in range(2000):
+        o1, o2 = random_doc(rnd), random_doc(rnd)
+        o1["x"] = rnd.choice([0, 1, 5])
+        o1["details"] = random_doc(rnd)
+        o1["details"]["rn"] = rnd.choice([0, 1, "n"])
+        o2["details"] = random_doc(rnd)
+        if rnd.random() < 0.5:
+            o2["x"] = rnd.choice([0, 1])
+        if rnd.random() < 0.5:
+            o2["details"]["rn"] = rnd.choice([0, 1, "n"])
+        if not same_shape(o1, o2):
+            continue
+        popped = copy.deepcopy(o1)
+        popped.pop("x")
+        popped["details"].pop("rn")
+        assert engine.diffs(o1, o2) == recursive_diff_objects(popped, o2)
+
+
+def test_wildcard_paths():
+    engine = DiffEngine(ignore=[("samples", "*", "date")])
+    o1 = {"samples": {"S1": {"date": 1, "status": "a"}, "S2": {"date": 2}}}
+    o2 = {"samples": {"S1": {"date": 3, "status": "b"}, "S2": {"date": 4}}}
+    assert engine.diffs(o1, o2) == {" samples S1 status": ["a", "b"]}
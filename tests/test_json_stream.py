@@ -0,0 +1,44 @@
+import io
+import json
+
+from LIMS2DB.json_stream import ProjectJSONWriter
+
+
+def test_document_written_whole():
+    out = io.StringIO()
+    doc = {"project_id": "P1", "samples": {"S1": {"status": "a"}}}
+    writer = ProjectJSONWriter(out)
+    writer.finish(doc)
+    assert not writer.streaming
+    assert out.getvalue() == json.dumps(doc)
+
+
+def test_samples_streamed():
+    out = io.StringIO()
+    writer = ProjectJSONWriter(out)
+    doc = {"project_id": "P1", "details": {"a": 1}, "samples": {}}
+    writer.start_samples(doc)
+    assert writer.streaming
+    samples = {"S1": {"status": "a"}, "S2": {"status": "b", "library": [1, 2]}}
+    for name, sample in samples.items():
+        writer.write_sample(name, sample)
+    # the fields set after the samples follow them, the samples left are written by finish
+    doc["samples"] = {"S3": {"status": "c"}}
+    doc["order_details"] = {"x": None}
+    writer.finish(doc)
+    expected = {
+        "project_id": "P1",
+        "details": {"a": 1},
+        "samples": dict(samples, S3={"status": "c"}),
+        "order_details": {"x": None},
+    }
+    assert out.getvalue() == json.dumps(expected)
+    assert writer.nb_samples == 3
+
+
+def test_no_samples_streamed():
+    out = io.StringIO()
+    writer = ProjectJSONWriter(out)
+    writer.start_samples({"samples": {}})
+    writer.finish({"samples": {}, "project_id": "P1"})
+    assert out.getvalue() == json.dumps({"samples": {}, "project_id": "P1"})
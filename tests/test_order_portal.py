@@ -0,0 +1,112 @@
+import json
+import time
+
+from LIMS2DB.order_portal import CachedResponse, OrderCache, OrderPortalClient
+
+URL = "https://portal/api/v1/order/NGI123"
+
+
+class Response:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class Session:
+    """Session answering with the responses given, recording the headers of the requests"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def get(self, url, headers, timeout):
+        self.sent.append(headers)
+        return self.responses.pop(0)
+
+
+def test_cache_round_trip(tmp_path):
+    path = str(tmp_path / "orders.sqlite")
+    cache = OrderCache(path)
+    assert cache.get(URL) is None
+    cache.put(
+        URL, '{"a": 1}', "etag", "Mon, 01 Jan 2024 00:00:00 GMT", "2024-01-01T00:00:00Z"
+    )
+    cache.close()
+    # the file is shared by the processes of the runs
+    cache = OrderCache(path)
+    cached = cache.get(URL)
+    assert cached[:4] == (
+        '{"a": 1}',
+        "etag",
+        "Mon, 01 Jan 2024 00:00:00 GMT",
+        "2024-01-01T00:00:00Z",
+    )
+    assert time.time() - cached.fetched < 60
+    cache.close()
+
+
+def test_freshness(tmp_path):
+    cache = OrderCache(str(tmp_path / "orders.sqlite"), max_age=1000)
+    now = time.time()
+    # modified 100 days ago, fresh for 10 days but at most max_age
+    old_order = CachedResponse("{}", None, None, "2000-01-01T00:00:00Z", now)
+    assert cache.is_fresh(old_order, now + 999)
+    assert not cache.is_fresh(old_order, now + 1001)
+    # modified 100 seconds before it was fetched, fresh for 10 seconds
+    modified = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now - 100))
+    new_order = CachedResponse("{}", None, None, modified, now)
+    assert cache.is_fresh(new_order, now + 5)
+    assert not cache.is_fresh(new_order, now + 20)
+    cache.close()
+
+
+def test_revalidated_and_evict(tmp_path):
+    cache = OrderCache(str(tmp_path / "orders.sqlite"), ttl=100)
+    cache.put(URL, "{}")
+    fetched = cache.get(URL).fetched
+    cache.revalidated(URL)
+    assert cache.get(URL).fetched >= fetched
+    cache.evict()
+    assert cache.get(URL) is not None
+    cache.ttl = -1
+    cache.evict()
+    assert cache.get(URL) is None
+    cache.close()
+
+
+def test_client_revalidates_stale_responses(tmp_path):
+    client = OrderPortalClient(
+        {
+            "api_get_order_url": "https://portal/api/v1/order/",
+            "api_token": "token",
+            "cache": str(tmp_path / "orders.sqlite"),
+            "cache_max_age": 0,
+        }
+    )
+    order = {"identifier": "NGI123", "modified": "2024-01-01T00:00:00Z"}
+    client.session = Session(
+        Response(200, order, {"ETag": "v1"}), Response(304, headers={"ETag": "v1"})
+    )
+    assert client.get_json(URL) == order
+    assert client.get_json(URL) == order
+    assert client.session.sent == [{}, {"If-None-Match": "v1"}]
+    assert (client.requests, client.cache_hits, client.not_modified) == (2, 0, 1)
+
+
+def test_client_uses_fresh_responses(tmp_path):
+    client = OrderPortalClient(
+        {
+            "api_get_order_url": "https://portal/api/v1/order/",
+            "api_token": "token",
+            "cache": str(tmp_path / "orders.sqlite"),
+        }
+    )
+    order = {"identifier": "NGI123", "modified": "2000-01-01T00:00:00Z"}
+    client.session = Session(Response(200, order))
+    assert client.get_json(URL) == order
+    assert client.get_json(URL) == order
+    assert (client.requests, client.cache_hits) == (1, 1)
@@ -0,0 +1,85 @@
+import copy
+import random
+
+from LIMS2DB.utils import (
+    DEFAULT_MERGE,
+    PREFER_OLD,
+    UNION,
+    MergeEngine,
+    merge,
+)
+
+
+def recursive_merge(d1, d2):
+    """merge as it was written before MergeEngine, filling d1 in place"""
+    for key in d2:
+        if key in d1:
+            if isinstance(d1[key], dict) and isinstance(d2[key], dict):
+                recursive_merge(d1[key], d2[key])
+        else:
+            d1[key] = d2[key]
+    return d1
+
+
+def random_doc(rnd, depth=0):
+    doc = {}
+    for key in rnd.sample("abcdef", rnd.randint(0, 5)):
+        if depth < 3 and rnd.random() < 0.35:
+            doc[key] = random_doc(rnd, depth + 1)
+        else:
+            doc[key] = rnd.choice([0, 1, "x", None, [1], [1, 2]])
+    return doc
+
+
+def key_order(doc):
+    return [
+        (key, key_order(value) if isinstance(value, dict) else None)
+        for key, value in doc.items()
+    ]
+
+
+def test_merge_matches_recursive_version():
+    rnd = random.Random(3)
+    for _ in range(5000):
+        new, old = random_doc(rnd), random_doc(rnd)
+        new_copy, old_copy = copy.deepcopy(new), copy.deepcopy(old)
+        expected = recursive_merge(copy.deepcopy(new), copy.deepcopy(old))
+        merged, changed = DEFAULT_MERGE.merge(new, old)
+        assert merged == expected
+        assert key_order(merged) == key_order(expected)
+        assert bool(changed) == (merged != old)
+        assert merge(new, old) == expected
+        # neither document is modified
+        assert new == new_copy and old == old_copy
+
+
+def test_merge_changed_paths():
+    new = {"a": 1, "b": {"c": 2, "d": 3}, "e": 5}
+    old = {"a": 1, "b": {"c": 4, "d": 3}, "f": 6}
+    merged, changed = DEFAULT_MERGE.merge(new, old)
+    assert merged == {"a": 1, "b": {"c": 2, "d": 3}, "e": 5, "f": 6}
+    assert sorted(changed) == [("b", "c"), ("e",)]
+
+
+def test_merge_shares_unchanged_values():
+    new = {"a": {"x": [1]}, "b": {"y": 1}}
+    old = {"a": {"x": [1]}, "b": {"y": 2}, "c": {"z": 3}}
+    merged, _ = DEFAULT_MERGE.merge(new, old)
+    assert merged["a"] is new["a"]
+    assert merged["c"] is old["c"]
+    assert merged["b"] is not new["b"]
+
+
+def test_merge_policies():
+    engine = MergeEngine(
+        policies={("keep",): PREFER_OLD, ("lists", "*"): UNION},
+    )
+    new = {"keep": {"a": 1, "b": 2}, "lists": {"s": [1, 3], "t": "x"}, "v": 1}
+    old = {"keep": {"a": 0}, "lists": {"s": [1, 2], "t": "y"}, "v": 0}
+    merged, changed = engine.merge(new, old)
+    assert merged == {
+        "keep": {"a": 0, "b": 2},
+        "lists": {"s": [1, 2, 3], "t": "x"},
+        "v": 1,
+    }
+    assert sorted(changed) == [("keep", "b"), ("lists", "s"), ("lists", "t"), ("v",)]